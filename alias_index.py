@@ -0,0 +1,86 @@
+"""
+Alias index mapping product codes to canonical serial numbers
+"""
+import logging
+import threading
+from typing import Optional, Dict, Any
+
+logger = logging.getLogger(__name__)
+
+# Longest alias chain (code -> serial -> serial ...) the resolver will follow
+MAX_ALIAS_HOPS = 3
+
+
+class AliasIndex:
+    """Remembers which canonical serial a code resolves to.
+
+    Entries come from the relaxed product search (a code whose product page
+    404s -> the serial it found) and from the communication codes in l2s
+    payloads. Lookups are served from memory; when bound to a
+    DatabaseManager the index is loaded from and written through to the
+    product_alias table so every worker shares what was learned.
+    """
+
+    def __init__(self):
+        self.db_manager = None
+        self._aliases = {}
+        self._lock = threading.Lock()
+        self.stats_counters = {'hits': 0, 'misses': 0, 'stored_hits': 0, 'learned': 0}
+
+    def bind_database(self, db_manager):
+        """Load stored aliases and persist new ones through the database"""
+        self.db_manager = db_manager
+        stored = db_manager.get_all_product_aliases()
+        with self._lock:
+            for alias_code, serial_number in stored.items():
+                self._aliases.setdefault(alias_code, serial_number)
+        logger.info(f"Loaded {len(stored)} product aliases")
+
+    def resolve(self, code: str) -> str:
+        """Follow known aliases from ``code`` to its canonical serial"""
+        serial_number = code
+        visited = {code}
+        with self._lock:
+            for _ in range(MAX_ALIAS_HOPS):
+                target = self._aliases.get(serial_number)
+                if target is None or target in visited:
+                    break
+                visited.add(target)
+                serial_number = target
+            self.stats_counters['hits' if serial_number != code else 'misses'] += 1
+        return serial_number
+
+    def lookup_stored(self, code: str) -> Optional[str]:
+        """Check the database for an alias another worker may have learned"""
+        if self.db_manager is None:
+            return None
+        serial_number = self.db_manager.get_product_alias(code)
+        if serial_number and serial_number != code:
+            with self._lock:
+                self._aliases[code] = serial_number
+                self.stats_counters['stored_hits'] += 1
+            return serial_number
+        return None
+
+    def remember(self, aliases: Dict[str, str], source: str):
+        """Record alias code -> serial mappings; identity and known mappings are skipped"""
+        with self._lock:
+            new_aliases = {
+                alias_code: serial_number for alias_code, serial_number in aliases.items()
+                if alias_code and alias_code != serial_number
+                and self._aliases.get(alias_code) != serial_number
+            }
+            self._aliases.update(new_aliases)
+            self.stats_counters['learned'] += len(new_aliases)
+
+        if new_aliases and self.db_manager is not None:
+            self.db_manager.save_product_aliases(new_aliases, source)
+        return new_aliases
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'aliases': len(self._aliases), **self.stats_counters}
+
+
+# Global alias index instance
+alias_index = AliasIndex()
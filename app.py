@@ -1,11 +1,14 @@
 import os
 import sys
+import json
 import hashlib
-from flask import (Flask, render_template, request, abort, jsonify, session, send_from_directory, send_file)
+import threading
+from datetime import datetime, timedelta, timezone
+from flask import (Flask, Response, render_template, request, abort, jsonify, session, send_from_directory, send_file,
+                   stream_with_context)
 from flask_cors import CORS
 from linebot.v3 import (
-    WebhookParser,
-    WebhookHandler
+    WebhookParser
 )
 from linebot.v3.exceptions import (
     InvalidSignatureError
@@ -18,15 +21,21 @@ from linebot.v3.webhooks import (
 from linebot.v3.messaging import (
     Configuration,
     ApiClient,
-    MessagingApi,
-    ReplyMessageRequest,
-    TextMessage,
-    ImageMessage
+    MessagingApi
 )
 
-from crawl import product_crawl
+from crawl import product_crawl, product_crawl_many
 from database import db_manager
-from reply import reply_message
+from http_client import upstream_client, async_upstream_client
+from exchange_rate import exchange_rate_service
+from alias_index import alias_index
+from singleflight import crawl_flight
+from revalidate import price_refresher
+from prewarm import prewarm_scheduler
+from price_history import price_history
+from line_webhook import line_dispatcher
+from reply import reply_message, reply_unavailable, reply_example, delivery_stats
+from resilience import UpstreamUnavailableError
 
 
 app = Flask(__name__)
@@ -38,6 +47,9 @@ app.secret_key = os.getenv('FLASK_SECRET_KEY', 'uniqlo-price-finder-secret-key-2
 # Ensure proper JSON encoding for Japanese characters
 app.config['JSON_AS_ASCII'] = False
 
+# Upper bound on product IDs accepted by one /api/search/batch request
+BATCH_SEARCH_MAX_ITEMS = int(os.getenv('BATCH_SEARCH_MAX_ITEMS', '50'))
+
 # Database initialization
 def init_db():
     """Initialize the database - now handled by DatabaseManager"""
@@ -89,48 +101,102 @@ def save_search_to_history(user_id, product_id, result):
         is_successful=True
     )
 
+def store_crawl_result(product_id, result):
+    """Cache a crawl outcome: price data when found, a negative entry otherwise"""
+    if result is None:
+        # Uniqlo was unavailable; nothing was learned about the product
+        return
+    if result == -1:
+        db_manager.cache_negative_result(product_id)
+    else:
+        # 1 hour cache
+        db_manager.cache_price_data(product_id, result, cache_hours=1)
+        price_history.record(result)
+
+def crawl_and_cache(product_id):
+    """Crawl a product and cache the outcome, once for all concurrent lookups of it"""
+    def fetch():
+        if crawl_flight.lease is not None:
+            # Another worker may have filled the cache while we waited for the lease
+            cached_result = db_manager.get_cached_price(product_id)
+            if cached_result:
+                return cached_result
+        # Background refreshes and lookups that raced a not-found crawl don't crawl again
+        if db_manager.is_negative_cached(product_id):
+            return -1
+
+        result = product_crawl(product_id)
+        store_crawl_result(product_id, result)
+        return result
+
+    return crawl_flight.do(product_id, fetch)
+
+def lookup_cached(product_id):
+    """Cached entry for a product, fresh or stale (stale-while-revalidate).
+
+    A stale entry is returned right away and a background refresh is
+    queued for it; None means the caller has to crawl.
+    """
+    return lookup_cached_many([product_id]).get(product_id)
+
+def lookup_cached_many(product_ids):
+    """``lookup_cached`` for many products, with one cache request per tier"""
+    entries = db_manager.get_cached_price_entries(product_ids)
+    # A stale price of a product since found missing is neither served nor refreshed
+    stale_ids = [product_id for product_id, entry in entries.items() if entry['is_stale']]
+    for product_id in db_manager.get_negative_cached_ids(stale_ids):
+        del entries[product_id]
+    for product_id in product_ids:
+        entry = entries.get(product_id)
+        if entry and entry['is_stale']:
+            price_refresher.schedule(product_id, lambda product_id=product_id: crawl_and_cache(product_id))
+        prewarm_scheduler.record_lookup(product_id, fresh_hit=bool(entry) and not entry['is_stale'])
+    return entries
+
 def get_user_search_history(user_id, limit=50):
     """Get user's search history using the new database manager"""
     try:
         with db_manager.get_session() as session:
             from database import SearchHistory
             
-            # Get recent searches for this user
-            searches = session.query(SearchHistory).filter(
+            # Get recent searches for this user; only the summary columns are
+            # read, never the full product_data JSON
+            searches = session.query(
+                SearchHistory.id,
+                SearchHistory.variant_count,
+                SearchHistory.product_id,
+                SearchHistory.page_title,
+                SearchHistory.colors,
+                SearchHistory.in_stock_sizes,
+                SearchHistory.jp_price,
+                SearchHistory.product_url,
+                SearchHistory.search_timestamp
+            ).filter(
                 SearchHistory.user_id == user_id,
                 SearchHistory.is_successful == True
             ).order_by(SearchHistory.search_timestamp.desc()).limit(limit).all()
-            
-            history = []
-            for search in searches:
-                # Extract data from stored JSON
-                data = search.product_data or {}
-                colors = []
-                sizes = []
-                
-                if data.get('product_list'):
-                    colors = list(set([item['color'] for item in data['product_list'] if item.get('color')]))
-                    sizes = []
-                    for item in data['product_list']:
-                        if item.get('size') and item.get('stock') == 'IN_STOCK':
-                            sizes.append(item['size'])
-                    sizes = list(set(sizes))
-                
-                # Extract page title from stored JSON data
-                page_title = data.get('page_title', '')
-                
-                history.append({
-                    'product_id': search.product_id,
-                    'product_name': page_title,  # Use the scraped page title
-                    'price': f"¥{search.jp_price:,}" if search.jp_price else '',
-                    'colors': colors,
-                    'sizes': sizes,
-                    'image_url': '',  # Not available
-                    'product_url': search.product_url or '',
-                    'searched_at': search.search_timestamp.isoformat()
-                })
-            
-            return history
+        
+        # Rows from before the summary columns are summarized (and stored) on first read
+        summaries = db_manager.summarize_history_rows(
+            [search.id for search in searches if search.variant_count is None])
+        history = []
+        for search in searches:
+            summary = summaries.get(search.id) or {
+                'page_title': search.page_title,
+                'colors': search.colors,
+                'in_stock_sizes': search.in_stock_sizes
+            }
+            history.append({
+                'product_id': search.product_id,
+                'product_name': summary['page_title'] or '',  # The scraped page title
+                'price': f"¥{search.jp_price:,}" if search.jp_price else '',
+                'colors': summary['colors'] or [],
+                'sizes': summary['in_stock_sizes'] or [],
+                'image_url': '',  # Not available
+                'product_url': search.product_url or '',
+                'searched_at': search.search_timestamp.isoformat()
+            })
+        return history
     except Exception as e:
         print(f"Error getting search history: {e}")
         return []
@@ -138,6 +204,29 @@ def get_user_search_history(user_id, limit=50):
 # Initialize database on startup
 init_db()
 
+# Load the last stored exchange rate and keep it fresh in the background
+exchange_rate_service.bind_database(db_manager)
+exchange_rate_service.start()
+
+# Share resolved product codes between crawls and workers
+alias_index.bind_database(db_manager)
+
+# Coalesce concurrent crawls of one product (optionally across workers)
+crawl_flight.bind_database(db_manager)
+
+# Drop LINE webhook redeliveries (optionally across workers)
+line_dispatcher.bind_database(db_manager)
+
+# Keep the most searched products warm in the cache (PREWARM_ENABLED=true)
+prewarm_scheduler.bind_database(db_manager)
+if prewarm_scheduler.enabled:
+    prewarm_scheduler.start(crawl_and_cache)
+
+# Record per-variant price/stock changes and downsample them as they age
+price_history.bind_database(db_manager)
+if price_history.enabled and price_history.downsample_enabled:
+    price_history.start()
+
 # get channel_secret and channel_access_token from your environment variable
 channel_secret = os.getenv('LINE_CHANNEL_SECRET', None)
 channel_access_token = os.getenv('LINE_CHANNEL_ACCESS_TOKEN', None)
@@ -149,12 +238,22 @@ if channel_access_token is None:
     sys.exit(1)
 
 parser = WebhookParser(channel_secret)
-handler = WebhookHandler(channel_secret)
 
 configuration = Configuration(
     access_token=channel_access_token
 )
 
+# Each webhook worker keeps one MessagingApi (and its connection pool) for
+# its lifetime instead of building an ApiClient per event
+_line_clients = threading.local()
+
+def get_line_bot_api():
+    """This worker thread's long-lived MessagingApi"""
+    api = getattr(_line_clients, 'api', None)
+    if api is None:
+        api = _line_clients.api = MessagingApi(ApiClient(configuration))
+    return api
+
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
@@ -241,32 +340,52 @@ def find_product():
     body = request.get_data(as_text=True)
     app.logger.info("Request body: " + body)
 
-    # parse webhook body
+    # verify the signature and parse the webhook body; events are handled
+    # by the worker pool so LINE gets its 200 without waiting on a crawl
     try:
-        handler.handle(body, signature)
+        events = parser.parse(body, signature)
     except InvalidSignatureError:
         abort(400)
 
+    line_dispatcher.submit_batch(events, handle_line_event)
+
     return 'OK'
 
-@handler.add(MessageEvent, message=TextMessageContent)
+def handle_line_event(event):
+    """Route one webhook event (runs on a line_dispatcher worker)"""
+    if isinstance(event, MessageEvent) and isinstance(event.message, TextMessageContent):
+        message_text(event)
+
 def message_text(event):
     message_input = event.message.text
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        if message_input == "1":
-            print("User ask for example!")
-            img_url = "https://i.imgur.com/HLw9BhO.jpg"
-            reply = ImageMessage(original_content_url=img_url, preview_image_url=img_url)
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                replyToken=event.reply_token,
-                messages=[reply]))
-        else:
-            print("Start crawling!")
-            result = product_crawl(message_input)
+    line_bot_api = get_line_bot_api()
+    if message_input == "1":
+        print("User ask for example!")
+        reply_example(event, line_bot_api)
+    else:
+        # Cached (or stale, refreshed in the background) prices answer right away
+        entry = lookup_cached(message_input)
+        if entry:
+            reply_message(entry['data'], event, line_bot_api,
+                          age_seconds=entry['age_seconds'] if entry['is_stale'] else None)
+            return 'OK'
+
+        # Known-unknown products are answered without touching Uniqlo
+        if db_manager.is_negative_cached(message_input):
+            reply_message(-1, event, line_bot_api)
+            return 'OK'
+
+        print("Start crawling!")
+        try:
+            result = crawl_and_cache(message_input)
+        except UpstreamUnavailableError as e:
+            print(f"Uniqlo unavailable: {e}")
+            result = db_manager.get_cached_price(message_input, allow_stale=True)
+        if result:
             reply_message(result, event, line_bot_api)
-                    
+        else:
+            reply_unavailable(event, line_bot_api)
+
     return 'OK'
 
 @app.route("/api/search", methods=['POST'])
@@ -284,10 +403,11 @@ def api_search():
         
         print(f"API Search for product ID: {product_id} by user: {user_id}")
         
-        # Try to get cached data first
-        cached_result = db_manager.get_cached_price(product_id)
-        if cached_result:
-            print(f"Using cached data for product {product_id}")
+        # Try to get cached data first; a stale entry is served while it is refreshed
+        entry = lookup_cached(product_id)
+        if entry:
+            cached_result = entry['data']
+            print(f"Using {'stale ' if entry['is_stale'] else ''}cached data for product {product_id}")
             # Save cache hit to history
             db_manager.save_search_history(
                 product_id=product_id,
@@ -296,10 +416,27 @@ def api_search():
                 user_id=user_id,
                 is_successful=True
             )
-            return jsonify(cached_result)
+            response = jsonify(cached_result)
+            response.headers['Age'] = str(int(entry['age_seconds']))
+            response.headers['X-Cache'] = 'STALE' if entry['is_stale'] else 'HIT'
+            return response
         
-        # No cache, fetch fresh data
-        result = product_crawl(product_id)
+        # Known-unknown products are answered without touching Uniqlo
+        if db_manager.is_negative_cached(product_id):
+            result = -1
+        else:
+            # No cache, fetch fresh data (and cache it)
+            try:
+                result = crawl_and_cache(product_id)
+            except UpstreamUnavailableError as e:
+                print(f"Uniqlo unavailable for {product_id}: {e}")
+                # Better an expired price than no answer while Uniqlo is down
+                stale_result = db_manager.get_cached_price(product_id, allow_stale=True)
+                if not stale_result:
+                    return jsonify({'error': 'Upstream temporarily unavailable'}), 503
+                response = jsonify(stale_result)
+                response.headers['X-Cache'] = 'STALE'
+                return response
         
         if result == -1:
             # Save failed search
@@ -313,18 +450,152 @@ def api_search():
             )
             return jsonify({'error': 'Product not found'}), 404
         
-        # Cache the successful result (1 hour cache)
-        db_manager.cache_price_data(product_id, result, cache_hours=1)
-        
         # Save successful search to history
         save_search_to_history(user_id, product_id, result)
         
-        return jsonify(result)
+        response = jsonify(result)
+        response.headers['X-Cache'] = 'MISS'
+        return response
         
     except Exception as e:
         print(f"API Error: {str(e)}")
         return jsonify({'error': 'Internal server error'}), 500
 
+@app.route("/api/search/batch", methods=['POST'])
+def api_search_batch():
+    """API endpoint for searching many products, streamed back as NDJSON.
+
+    Cached products are answered first, misses are crawled concurrently and
+    each result is written as one JSON line as soon as it is ready.
+    """
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Request body must be a JSON object'}), 400
+    product_ids = data.get('product_ids')
+    if not isinstance(product_ids, list) or not product_ids:
+        return jsonify({'error': 'product_ids must be a non-empty list'}), 400
+
+    product_ids = list(dict.fromkeys(str(product_id).strip() for product_id in product_ids
+                                     if str(product_id).strip()))
+    if not product_ids:
+        return jsonify({'error': 'product_ids must be a non-empty list'}), 400
+    if len(product_ids) > BATCH_SEARCH_MAX_ITEMS:
+        return jsonify({'error': f'At most {BATCH_SEARCH_MAX_ITEMS} product IDs per request'}), 400
+
+    user_id = get_user_id()
+    print(f"API batch search for {len(product_ids)} products by user: {user_id}")
+
+    def ndjson_line(payload):
+        return json.dumps(payload, ensure_ascii=False) + '\n'
+
+    def not_found_entry(product_id):
+        return {
+            'product_id': product_id,
+            'search_data': {},
+            'source': 'api',
+            'user_id': user_id,
+            'is_successful': False,
+            'error_message': "Product not found"
+        }
+
+    def generate():
+        history_entries = []
+        try:
+            misses = []
+            cached = lookup_cached_many(product_ids)
+            for product_id in product_ids:
+                entry = cached.get(product_id)
+                if entry:
+                    history_entries.append({
+                        'product_id': product_id,
+                        'search_data': entry['data'],
+                        'source': 'api_cached',
+                        'user_id': user_id
+                    })
+                    yield ndjson_line({'product_id': product_id, 'status': 'ok', 'cached': True,
+                                       'stale': entry['is_stale'], 'age_seconds': int(entry['age_seconds']),
+                                       'result': entry['data']})
+                elif db_manager.is_negative_cached(product_id):
+                    history_entries.append(not_found_entry(product_id))
+                    yield ndjson_line({'product_id': product_id, 'status': 'not_found',
+                                       'cached': True, 'error': 'Product not found'})
+                else:
+                    misses.append(product_id)
+
+            # Lead the crawl of misses nobody else is fetching; wait for the rest
+            leading, following = {}, {}
+            for product_id in misses:
+                is_leader, flight = crawl_flight.claim(product_id)
+                (leading if is_leader else following)[product_id] = flight
+
+            def crawl_outcomes():
+                try:
+                    for product_id, result in product_crawl_many(list(leading)):
+                        store_crawl_result(product_id, result)
+                        if result is None:
+                            # Followers take their own stale/unavailable path, as after crawl_and_cache
+                            crawl_flight.complete(product_id, leading.pop(product_id),
+                                                  error=UpstreamUnavailableError(f"Could not crawl {product_id}"))
+                        else:
+                            crawl_flight.complete(product_id, leading.pop(product_id), result=result)
+                        yield product_id, result
+                finally:
+                    for product_id, flight in list(leading.items()):
+                        crawl_flight.complete(product_id, flight, error=RuntimeError("Batch crawl aborted"))
+                for product_id, flight in following.items():
+                    try:
+                        yield product_id, crawl_flight.wait(flight)
+                    except (UpstreamUnavailableError, TimeoutError):
+                        yield product_id, None
+                    except Exception as e:
+                        # The leader failed on its own (e.g. its batch was aborted);
+                        # that is this product's outcome, not this stream's
+                        yield product_id, e
+
+            for product_id, result in crawl_outcomes():
+                if isinstance(result, Exception):
+                    print(f"Batch lookup of {product_id} failed: {result}")
+                    yield ndjson_line({'product_id': product_id, 'status': 'error',
+                                       'cached': False, 'error': 'Internal server error'})
+                    continue
+
+                if result is None:
+                    # Uniqlo unavailable: fall back to an expired entry if there is one
+                    stale_result = db_manager.get_cached_price(product_id, allow_stale=True)
+                    if stale_result:
+                        history_entries.append({
+                            'product_id': product_id,
+                            'search_data': stale_result,
+                            'source': 'api_cached',
+                            'user_id': user_id
+                        })
+                        yield ndjson_line({'product_id': product_id, 'status': 'ok', 'cached': True,
+                                           'stale': True, 'result': stale_result})
+                    else:
+                        yield ndjson_line({'product_id': product_id, 'status': 'unavailable',
+                                           'cached': False, 'error': 'Upstream temporarily unavailable'})
+                    continue
+
+                if result == -1:
+                    history_entries.append(not_found_entry(product_id))
+                    yield ndjson_line({'product_id': product_id, 'status': 'not_found',
+                                       'cached': False, 'error': 'Product not found'})
+                    continue
+
+                history_entries.append({
+                    'product_id': product_id,
+                    'search_data': result,
+                    'source': 'web',
+                    'user_id': user_id
+                })
+                yield ndjson_line({'product_id': product_id, 'status': 'ok',
+                                   'cached': False, 'result': result})
+        finally:
+            # One bulk insert for the whole batch, even if the client went away
+            db_manager.save_search_history_bulk(history_entries)
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 @app.route("/api/history", methods=['GET'])
 def api_get_history():
     """API endpoint to get user's search history"""
@@ -349,11 +620,8 @@ def api_clear_history():
     try:
         user_id = get_user_id()
         
-        # Clear search history using database manager
-        with db_manager.get_session() as session:
-            from database import SearchHistory
-            session.query(SearchHistory).filter(SearchHistory.user_id == user_id).delete()
-            session.commit()
+        # Queued searches are written first so none of them reappear after the delete
+        db_manager.delete_user_history(user_id)
         
         return jsonify({'message': 'Search history cleared successfully'})
         
@@ -371,6 +639,61 @@ def api_get_stats():
         print(f"Stats API Error: {str(e)}")
         return jsonify({'error': 'Internal server error'}), 500
 
+def parse_utc(value):
+    """Naive UTC datetime from an ISO 8601 timestamp (naive ones are taken as UTC)"""
+    moment = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return moment.astimezone(timezone.utc).replace(tzinfo=None) if moment.tzinfo else moment
+
+@app.route("/api/products/<product_id>/history", methods=['GET'])
+def api_get_price_history(product_id):
+    """API endpoint to get a product's per-variant price and stock history.
+
+    ``from``/``to`` are ISO timestamps (UTC, default: the last 30 days);
+    ``l2_id`` narrows the result to one variant.
+    """
+    try:
+        try:
+            end = parse_utc(request.args['to']) if 'to' in request.args else datetime.utcnow()
+            start = parse_utc(request.args['from']) if 'from' in request.args else end - timedelta(days=30)
+        except ValueError:
+            return jsonify({'error': 'from/to must be ISO 8601 timestamps'}), 400
+        if start >= end:
+            return jsonify({'error': 'from must be before to'}), 400
+
+        serial_number = alias_index.resolve(product_id.strip())
+        return jsonify({
+            'product_id': serial_number,
+            'from': start.isoformat(),
+            'to': end.isoformat(),
+            'variants': price_history.history(serial_number, start, end, l2_id=request.args.get('l2_id'))
+        })
+    except Exception as e:
+        print(f"Price History API Error: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route("/api/metrics", methods=['GET'])
+def api_get_metrics():
+    """API endpoint to get runtime metrics"""
+    try:
+        return jsonify({
+            'upstream': upstream_client.stats(),
+            'upstream_async': async_upstream_client.stats(),
+            'exchange_rate': exchange_rate_service.stats(),
+            'negative_cache': dict(db_manager.negative_cache_stats),
+            'price_cache': db_manager.price_cache_stats(),
+            'history_queue': db_manager.get_history_queue_stats(),
+            'line_webhook': {**line_dispatcher.stats(), **delivery_stats},
+            'aliases': alias_index.stats(),
+            'single_flight': crawl_flight.stats(),
+            'resilience': async_upstream_client.resilience_stats(),
+            'revalidation': price_refresher.stats(),
+            'prewarm': prewarm_scheduler.stats(),
+            'price_history': price_history.stats()
+        })
+    except Exception as e:
+        print(f"Metrics API Error: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
 # Frontend routes - serve React app
 @app.route('/frontend')
 @app.route('/frontend/')
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Benchmark: the original per-variant l2s loop (if/elif colors, size dict
+rebuilt per call, stdlib json) vs variant_decoder.decode_l2s with the
+lookup arrays and http_client.json_loads (orjson when installed).
+
+Run from the repository root:
+    python benchmarks/bench_l2s_decode.py [--colors 30] [--sizes 20] [--rounds 200]
+    python benchmarks/bench_l2s_decode.py --payload recorded_l2s.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from http_client import json_loads, orjson
+from variant_decoder import decode_l2s
+
+
+def legacy_color_name(color_code):
+    color_code = int(color_code)
+    if color_code <= 1:
+        return 'White 白'
+    elif color_code < 9:
+        return 'Gray 灰'
+    elif color_code == 9:
+        return 'Black 黑'
+    elif color_code <= 19:
+        return 'Red 紅'
+    elif color_code <= 29:
+        return 'Orange 橘'
+    elif color_code <= 39:
+        return 'Brown 棕'
+    elif color_code <= 49:
+        return 'Yellow 黃'
+    elif color_code <= 59:
+        return 'Green 綠'
+    elif color_code < 69:
+        return 'Blue 藍'
+    elif color_code == 69:
+        return 'Navy 海軍藍'
+    elif color_code <= 79:
+        return 'Purple 紫'
+    return 'Others 其他'
+
+
+def legacy_size_name(size_code):
+    size_dict = {
+        1: "XXS", 2: "XS", 3: "S", 4: "M", 5: "L", 6: "XL", 7: "XXL",
+        8: "3XL", 9: "4XL", 23: "23-25", 25: "25-27", 27: "27-29",
+        60: "60", 70: "70", 80: "80", 90: "90", 100: "100", 110: "110",
+        120: "120", 130: "130", 140: "140", 150: "150", 160: "160",
+        499: "AA 65/70", 500: "AB 65/70", 501: "CD 65/70", 502: "EF 65/70",
+        503: "AB 75/80", 504: "CD 75/80", 505: "EF 75/80",
+        506: "AB 85/90", 507: "CD 85/90", 508: "EF 85/90"
+    }
+    return size_dict.get(int(size_code), "")
+
+
+def legacy_decode(raw, serial_number):
+    """The crawl.py loop before variant_decoder"""
+    detail_resp = json.loads(raw)
+    price_jp = None
+    product_list = []
+    for item in detail_resp['result']['l2s']:
+        l2_id = item['l2Id']
+        color = legacy_color_name(item['color']['code'][-2:])
+        size = legacy_size_name(item['size']['code'][-3:])
+
+        stock = detail_resp['result']['stocks'].get(l2_id, {}).get('statusCode', 0)
+        price = detail_resp['result']['prices'].get(l2_id, {}).get('base', {}).get('value', 0)
+
+        if price_jp is None:
+            price_jp = price
+
+        product_list.append({
+            "serial": serial_number,
+            "serial_alt": item['communicationCode'][:6],
+            "id": l2_id,
+            "color": color,
+            "size": size,
+            "stock": stock,
+            "price": price
+        })
+    return price_jp, product_list
+
+
+def table_decode(raw, serial_number):
+    variants = decode_l2s(json_loads(raw))
+    return variants.first_price, variants.to_product_list(serial_number)
+
+
+def columnar_only(raw, serial_number):
+    """Decode without materializing dicts (e.g. for stock summaries)"""
+    variants = decode_l2s(json_loads(raw))
+    return variants.first_price, len(variants)
+
+
+def make_l2s_payload(serial_number, colors, sizes):
+    """Build an l2s response shaped like a recorded one: every color x size
+    variant with a stock entry, a price entry and the extra fields Uniqlo
+    sends (flags, alteration info, sales dates)"""
+    size_codes = [1, 2, 3, 4, 5, 6, 7, 8, 9, 23, 25, 27, 60, 70, 80, 90, 100, 110, 120, 130, 499, 500, 501]
+    l2s, stocks, prices = [], {}, {}
+    for color in range(colors):
+        for size in size_codes[:sizes]:
+            l2_id = f"{serial_number}{color:02d}{size:03d}"
+            l2s.append({
+                'l2Id': l2_id,
+                'communicationCode': f"{serial_number}-{color:02d}",
+                'color': {'code': f"COL{color * 3 % 100:02d}", 'displayCode': f"{color:02d}"},
+                'size': {'code': f"SMA{size:03d}", 'displayCode': f"{size:03d}"},
+                'pld': {'code': 'UNI000', 'displayCode': '000'},
+                'flags': {'productFlags': [], 'priceFlags': []},
+                'sales': True,
+                'alterationInfo': {'isAlterable': False},
+            })
+            stocks[l2_id] = {'statusCode': 'IN_STOCK' if (color + size) % 3 else 'STOCK_OUT',
+                             'quantity': (color * size) % 17, 'transitStatus': 'NONE'}
+            prices[l2_id] = {'base': {'currency': {'code': 'JPY', 'symbol': '¥'}, 'value': 2990},
+                             'promo': None, 'isDualPrice': False}
+    return json.dumps({'status': 'ok', 'result': {'l2s': l2s, 'stocks': stocks, 'prices': prices}},
+                      ensure_ascii=False).encode('utf-8')
+
+
+def measure(func, raw, serial_number, rounds):
+    func(raw, serial_number)
+    started = time.perf_counter()
+    for _ in range(rounds):
+        func(raw, serial_number)
+    return (time.perf_counter() - started) / rounds * 1000
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('--colors', type=int, default=30)
+    arg_parser.add_argument('--sizes', type=int, default=20)
+    arg_parser.add_argument('--rounds', type=int, default=200)
+    arg_parser.add_argument('--payload', help='recorded l2s response (JSON file) to decode instead')
+    args = arg_parser.parse_args()
+
+    serial_number = '474479'
+    if args.payload:
+        with open(args.payload, 'rb') as f:
+            raw = f.read()
+    else:
+        raw = make_l2s_payload(serial_number, args.colors, args.sizes)
+
+    legacy_result = legacy_decode(raw, serial_number)
+    assert table_decode(raw, serial_number) == legacy_result, "Decoders disagree"
+
+    print(f"l2s payload: {len(legacy_result[1])} variants, {len(raw) / 1024:.0f} KB, "
+          f"{args.rounds} rounds, JSON parser: {'orjson' if orjson else 'json (stdlib)'}\n")
+    print(f"{'method':<32}{'ms/call':>10}{'speedup':>10}")
+    baseline = None
+    for name, func in (('legacy loop + json', legacy_decode),
+                       ('decode_l2s + product_list', table_decode),
+                       ('decode_l2s (columnar only)', columnar_only)):
+        per_call_ms = measure(func, raw, serial_number, args.rounds)
+        baseline = baseline or per_call_ms
+        print(f"{name:<32}{per_call_ms:>10.3f}{baseline / per_call_ms:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
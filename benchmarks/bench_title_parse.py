@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Benchmark: full BeautifulSoup parse of a product page vs the streamed,
+early-terminating title extraction used by crawl.fetch_product_page.
+
+Run from the repository root:
+    python benchmarks/bench_title_parse.py [--page-kb 600] [--rounds 50]
+"""
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from crawl import extract_page_title, TITLE_STOP_MARKERS, TITLE_CHUNK_SIZE
+
+
+def make_product_page(page_kb):
+    """Build a page shaped like a Uniqlo product page: a head with meta,
+    preload and inline script tags, then a large body with embedded state"""
+    head = ['<!DOCTYPE html><html lang="ja"><head><meta charset="utf-8">']
+    head += [f'<link rel="preload" href="/jp/static/chunk-{i}.js" as="script">' for i in range(40)]
+    head += [f'<meta property="og:tag{i}" content="{"値" * 20}">' for i in range(20)]
+    head.append('<title>エアリズムコットンオーバーサイズTシャツ（5分袖） | ユニクロ</title>')
+    head.append('<script>window.__CONFIG__ = {"env": "production"};</script></head>')
+    body = ['<body><div id="root">']
+    row = '<div class="product-tile"><span>商品</span><a href="/jp/ja/products/E474479-000">詳細</a></div>'
+    while sum(len(part) for part in body) < page_kb * 1024:
+        body.append(row)
+    body.append('</div></body></html>')
+    return (''.join(head) + ''.join(body)).encode('utf-8')
+
+
+def read_head(page):
+    """Simulate get_prefix: consume chunks until a stop marker has arrived"""
+    body = bytearray()
+    longest_marker = max(len(marker) for marker in TITLE_STOP_MARKERS)
+    for start in range(0, len(page), TITLE_CHUNK_SIZE):
+        search_from = max(len(body) - longest_marker, 0)
+        body.extend(page[start:start + TITLE_CHUNK_SIZE])
+        window = bytes(body[search_from:]).lower()
+        if any(marker in window for marker in TITLE_STOP_MARKERS):
+            break
+    return bytes(body)
+
+
+def full_parse(page):
+    soup = BeautifulSoup(page.decode('utf-8'), 'html.parser')
+    return soup.find('title').get_text().strip(), len(page)
+
+
+def streamed_parse(page):
+    head_html = read_head(page)
+    return extract_page_title(head_html), len(head_html)
+
+
+def measure(func, page, rounds):
+    title, bytes_read = func(page)
+    started = time.perf_counter()
+    for _ in range(rounds):
+        func(page)
+    per_call_ms = (time.perf_counter() - started) / rounds * 1000
+
+    tracemalloc.start()
+    func(page)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return title, bytes_read, per_call_ms, peak
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('--page-kb', type=int, default=600)
+    arg_parser.add_argument('--rounds', type=int, default=50)
+    args = arg_parser.parse_args()
+
+    page = make_product_page(args.page_kb)
+    print(f"Product page: {len(page) / 1024:.0f} KB, {args.rounds} rounds\n")
+    print(f"{'method':<22}{'bytes read':>12}{'ms/call':>10}{'peak KB':>10}")
+
+    results = {}
+    for name, func in (('full html.parser', full_parse), ('streamed lxml title', streamed_parse)):
+        title, bytes_read, per_call_ms, peak = measure(func, page, args.rounds)
+        results[name] = title
+        print(f"{name:<22}{bytes_read:>12,}{per_call_ms:>10.2f}{peak / 1024:>10.0f}")
+
+    assert len(set(results.values())) == 1, f"Titles differ: {results}"
+    print(f"\nBoth methods extracted: {title}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,348 @@
+"""
+Pluggable backends for the price cache: in-process memory, the SQL
+price_cache table, and a Redis-protocol server shared by every replica
+"""
+import os
+import json
+import socket
+import logging
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime
+from urllib.parse import urlsplit, unquote
+from typing import Any, Callable, Dict, List, Optional
+
+from memory_cache import LRUCache
+from resilience import CircuitBreaker, CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+
+class CacheBackend(ABC):
+    """Stores price records {'data', 'cache_timestamp', 'expiry_timestamp'} by product id.
+
+    ``ttl_seconds`` given to ``set`` is how long the record may be served
+    at all (until its hard expiry); soft expiry is decided by the caller
+    from ``expiry_timestamp``. Backends treat their own failures as
+    misses and log them, never raising into the lookup path.
+    """
+
+    name = 'base'
+
+    def get(self, product_id: str) -> Optional[Dict[str, Any]]:
+        return self.get_many([product_id]).get(product_id)
+
+    @abstractmethod
+    def get_many(self, product_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Records of the given products that are cached; misses are left out"""
+
+    @abstractmethod
+    def set(self, product_id: str, record: Dict[str, Any], ttl_seconds: float):
+        """Store a record, served for at most ``ttl_seconds``"""
+
+    @abstractmethod
+    def delete(self, product_id: str):
+        """Drop a product's record"""
+
+    def stats(self) -> Dict[str, Any]:
+        return {'backend': self.name}
+
+
+class MemoryCacheBackend(CacheBackend):
+    """Process-local backend; not shared between replicas (single instance and tests)"""
+
+    name = 'memory'
+
+    def __init__(self, max_entries: Optional[int] = None):
+        self._cache = LRUCache(max_entries=max_entries or int(os.getenv('PRICE_CACHE_MEMORY_MAX_ENTRIES', '10000')),
+                               max_bytes=int(os.getenv('PRICE_CACHE_MEMORY_MAX_BYTES', str(256 * 1024 * 1024))))
+
+    def get_many(self, product_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        records = {}
+        for product_id in product_ids:
+            record = self._cache.get(product_id)
+            if record is not None:
+                records[product_id] = record
+        return records
+
+    def set(self, product_id: str, record: Dict[str, Any], ttl_seconds: float):
+        size = len(json.dumps(record['data'], ensure_ascii=False, default=str))
+        self._cache.set(product_id, record, size, ttl_seconds)
+
+    def delete(self, product_id: str):
+        self._cache.delete(product_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {'backend': self.name, **self._cache.stats()}
+
+
+class SQLCacheBackend(CacheBackend):
+    """The price_cache table; shared through the database and kept as the store of record"""
+
+    name = 'sql'
+
+    def __init__(self, session_factory: Callable[[], Any], model: Any):
+        self.session_factory = session_factory
+        self.model = model
+
+    def get_many(self, product_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        if not product_ids:
+            return {}
+        try:
+            with self.session_factory() as session:
+                rows = session.query(self.model).filter(self.model.product_id.in_(product_ids)).all()
+                return {row.product_id: {'data': row.cached_data,
+                                         'cache_timestamp': row.cache_timestamp,
+                                         'expiry_timestamp': row.expiry_timestamp}
+                        for row in rows}
+        except Exception as e:
+            logger.error(f"Failed to read price cache rows: {e}")
+            return {}
+
+    def write(self, session, product_id: str, record: Dict[str, Any]):
+        """Upsert a record within the caller's session (committed by the caller)"""
+        cache = session.query(self.model).filter(self.model.product_id == product_id).first()
+        if cache:
+            cache.cached_data = record['data']
+            cache.cache_timestamp = record['cache_timestamp']
+            cache.expiry_timestamp = record['expiry_timestamp']
+            cache.access_count += 1
+            cache.last_accessed = record['cache_timestamp']
+        else:
+            session.add(self.model(
+                product_id=product_id,
+                serial_number=record['data'].get('serial_number'),
+                cached_data=record['data'],
+                cache_timestamp=record['cache_timestamp'],
+                expiry_timestamp=record['expiry_timestamp']
+            ))
+
+    def set(self, product_id: str, record: Dict[str, Any], ttl_seconds: float):
+        with self.session_factory() as session:
+            self.write(session, product_id, record)
+            session.commit()
+
+    def delete(self, product_id: str):
+        with self.session_factory() as session:
+            session.query(self.model).filter(self.model.product_id == product_id).delete()
+            session.commit()
+
+
+class RespError(Exception):
+    """Error reply from a Redis-protocol server"""
+
+
+class RespConnection:
+    """One socket speaking RESP2; sends a whole pipeline of commands in one write"""
+
+    def __init__(self, host: str, port: int, timeout: float, password: Optional[str] = None, db: int = 0):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile('rb')
+        setup = []
+        if password:
+            setup.append(('AUTH', password))
+        if db:
+            setup.append(('SELECT', str(db)))
+        if setup:
+            try:
+                self.pipeline(setup)
+            except Exception:
+                self.close()
+                raise
+
+    @staticmethod
+    def encode(command) -> bytes:
+        parts = [b'*%d\r\n' % len(command)]
+        for arg in command:
+            if isinstance(arg, str):
+                arg = arg.encode()
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        return b''.join(parts)
+
+    def read_reply(self):
+        line = self.reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError("Connection closed by cache server")
+        kind, body = line[:1], line[1:-2]
+        if kind == b'+':
+            return body.decode()
+        if kind == b'-':
+            return RespError(body.decode())
+        if kind == b':':
+            return int(body)
+        if kind == b'$':
+            length = int(body)
+            if length < 0:
+                return None
+            data = self.reader.read(length + 2)
+            if len(data) != length + 2:
+                raise ConnectionError("Connection closed by cache server")
+            return data[:-2]
+        if kind == b'*':
+            length = int(body)
+            return None if length < 0 else [self.read_reply() for _ in range(length)]
+        raise ConnectionError(f"Unexpected reply type {kind!r} from cache server")
+
+    def pipeline(self, commands: List[tuple]) -> List[Any]:
+        """Send every command, then read every reply: one round trip for the lot"""
+        self.sock.sendall(b''.join(self.encode(command) for command in commands))
+        replies = [self.read_reply() for _ in commands]
+        for reply in replies:
+            if isinstance(reply, RespError):
+                raise reply
+        return replies
+
+    def close(self):
+        try:
+            self.reader.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class RedisCacheBackend(CacheBackend):
+    """Redis (or any RESP-compatible server) shared by every replica.
+
+    Records are stored as JSON under REDIS_KEY_PREFIX + product id with the
+    record's hard TTL as the key expiry. Multi-key lookups are sent as one
+    pipeline of MGETs of at most REDIS_MGET_CHUNK keys each. Connections
+    are pooled; one that errors is discarded. After REDIS_FAILURE_THRESHOLD
+    consecutive connection failures the server is skipped (every call is a
+    miss) for REDIS_RETRY_SECONDS, then one trial call probes it again.
+    """
+
+    name = 'redis'
+
+    def __init__(self, url: Optional[str] = None, timeout: Optional[float] = None):
+        parts = urlsplit(url or os.getenv('REDIS_URL', 'redis://localhost:6379/0'))
+        self.host = parts.hostname or 'localhost'
+        self.port = parts.port or 6379
+        self.password = unquote(parts.password) if parts.password else None
+        self.db = int(parts.path.lstrip('/') or 0)
+        self.timeout = timeout or float(os.getenv('REDIS_SOCKET_TIMEOUT', '0.5'))
+        self.key_prefix = os.getenv('REDIS_KEY_PREFIX', 'uniqlo:price:')
+        self.mget_chunk = int(os.getenv('REDIS_MGET_CHUNK', '100'))
+        self.max_idle = int(os.getenv('REDIS_POOL_SIZE', '8'))
+        self._idle = []
+        self._lock = threading.Lock()
+        self.breaker = CircuitBreaker(int(os.getenv('REDIS_FAILURE_THRESHOLD', '1')),
+                                      float(os.getenv('REDIS_RETRY_SECONDS', '5')))
+        self.stats_counters = {'hits': 0, 'misses': 0, 'sets': 0, 'round_trips': 0, 'errors': 0, 'skipped': 0}
+
+    def _key(self, product_id: str) -> str:
+        return self.key_prefix + product_id
+
+    def _execute(self, commands: List[tuple]) -> List[Any]:
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"Cache server {self.host}:{self.port} unreachable; retrying later")
+        with self._lock:
+            connection = self._idle.pop() if self._idle else None
+        try:
+            if connection is None:
+                connection = RespConnection(self.host, self.port, self.timeout, self.password, self.db)
+            replies = connection.pipeline(commands)
+        except RespError:
+            # The server answered; only the command was refused
+            self.breaker.record_success()
+            self._release(connection)
+            raise
+        except Exception:
+            self.breaker.record_failure()
+            if connection is not None:
+                connection.close()
+            raise
+        self.breaker.record_success()
+        self._release(connection)
+        with self._lock:
+            self.stats_counters['round_trips'] += 1
+        return replies
+
+    def _release(self, connection: RespConnection):
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def _count(self, **amounts):
+        with self._lock:
+            for counter, amount in amounts.items():
+                self.stats_counters[counter] += amount
+
+    @staticmethod
+    def _dump(record: Dict[str, Any]) -> bytes:
+        return json.dumps({
+            'data': record['data'],
+            'cache_timestamp': record['cache_timestamp'].isoformat(),
+            'expiry_timestamp': record['expiry_timestamp'].isoformat()
+        }, ensure_ascii=False, default=str).encode()
+
+    @staticmethod
+    def _load(raw: bytes) -> Dict[str, Any]:
+        record = json.loads(raw)
+        record['cache_timestamp'] = datetime.fromisoformat(record['cache_timestamp'])
+        record['expiry_timestamp'] = datetime.fromisoformat(record['expiry_timestamp'])
+        return record
+
+    def get_many(self, product_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        if not product_ids:
+            return {}
+        chunks = [product_ids[i:i + self.mget_chunk] for i in range(0, len(product_ids), self.mget_chunk)]
+        try:
+            replies = self._execute([('MGET', *(self._key(product_id) for product_id in chunk))
+                                     for chunk in chunks])
+        except CircuitOpenError:
+            self._count(skipped=1)
+            return {}
+        except Exception as e:
+            self._count(errors=1)
+            logger.error(f"Cache server lookup failed: {e}")
+            return {}
+
+        records = {}
+        for chunk, values in zip(chunks, replies):
+            for product_id, raw in zip(chunk, values):
+                if raw is not None:
+                    records[product_id] = self._load(raw)
+        self._count(hits=len(records), misses=len(product_ids) - len(records))
+        return records
+
+    def set(self, product_id: str, record: Dict[str, Any], ttl_seconds: float):
+        ttl_ms = int(ttl_seconds * 1000)
+        if ttl_ms <= 0:
+            return
+        try:
+            self._execute([('SET', self._key(product_id), self._dump(record), 'PX', str(ttl_ms))])
+            self._count(sets=1)
+        except CircuitOpenError:
+            self._count(skipped=1)
+        except Exception as e:
+            self._count(errors=1)
+            logger.error(f"Cache server write of {product_id} failed: {e}")
+
+    def delete(self, product_id: str):
+        try:
+            self._execute([('DEL', self._key(product_id))])
+        except CircuitOpenError:
+            self._count(skipped=1)
+        except Exception as e:
+            self._count(errors=1)
+            logger.error(f"Cache server delete of {product_id} failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'backend': self.name, 'server': f"{self.host}:{self.port}/{self.db}",
+                    'idle_connections': len(self._idle), 'breaker': self.breaker.stats(), **self.stats_counters}
+
+
+def create_shared_backend(name: str) -> Optional[CacheBackend]:
+    """Shared tier for PRICE_CACHE_BACKEND: 'memory', 'redis', or None for 'sql' (table only)"""
+    name = (name or 'sql').lower()
+    if name == 'memory':
+        return MemoryCacheBackend()
+    if name == 'redis':
+        return RedisCacheBackend()
+    if name != 'sql':
+        logger.warning(f"Unknown PRICE_CACHE_BACKEND {name!r}; using the price_cache table only")
+    return None
@@ -1,59 +1,106 @@
-import requests
-from bs4 import BeautifulSoup
+import os
+import queue
+import asyncio
 
+from bs4 import BeautifulSoup, SoupStrainer
 
-def fetch_exchange_rate():
-    """Fetch the current JPY to TWD exchange rate."""
-    try:
-        currency_url = "https://www.google.com/finance/quote/JPY-TWD"
-        currency_page = requests.get(currency_url)
-        soup = BeautifulSoup(currency_page.text, "html.parser")
-        return float(soup.find('div', class_='YMlKec fxKbKc').get_text())
-    except Exception:
-        return None
+from http_client import async_upstream_client, current_rate_limiter, HostRateLimiter
+from exchange_rate import exchange_rate_service
+from alias_index import alias_index, MAX_ALIAS_HOPS
+from resilience import Deadline, UpstreamUnavailableError
+from variant_decoder import decode_l2s, color_name, size_name
+
+# Upstream endpoint, overridable for local stand-in servers
+UNIQLO_BASE_URL = os.getenv('UNIQLO_BASE_URL', 'https://www.uniqlo.com')
+
+# Batch crawl defaults: lookups in flight, and requests per second per host (0 = unlimited)
+CRAWL_BATCH_CONCURRENCY = int(os.getenv('CRAWL_BATCH_CONCURRENCY', '8'))
+CRAWL_RATE_LIMIT = float(os.getenv('CRAWL_RATE_LIMIT', '0'))
+
+# The title sits in <head>, so stop downloading the product page once it has arrived
+TITLE_STOP_MARKERS = (b'</title>', b'</head>')
+TITLE_CHUNK_SIZE = 8192
+_title_strainer = SoupStrainer('title')
+
+# Total time budget of one crawl, and the share of it each stage may use
+CRAWL_DEADLINE_SECONDS = float(os.getenv('CRAWL_DEADLINE_SECONDS', '8'))
+STAGE_BUDGET = {'lookup': 0.6, 'search': 0.25}
 
 
 def get_color_name(color_code):
-    color_code = int(color_code)
-    if color_code <= 1:
-        return 'White 白'
-    elif color_code < 9:
-        return 'Gray 灰'
-    elif color_code == 9:
-        return 'Black 黑'
-    elif color_code <= 19:
-        return 'Red 紅'
-    elif color_code <= 29:
-        return 'Orange 橘'
-    elif color_code <= 39:
-        return 'Brown 棕'
-    elif color_code <= 49:
-        return 'Yellow 黃'
-    elif color_code <= 59:
-        return 'Green 綠'
-    elif color_code < 69:
-        return 'Blue 藍'
-    elif color_code == 69:
-        return 'Navy 海軍藍'
-    elif color_code <= 79:
-        return 'Purple 紫'
-    return 'Others 其他'
+    return color_name(int(color_code))
 
 
 def get_size_name(size_code):
-    size_dict = {
-        1: "XXS", 2: "XS", 3: "S", 4: "M", 5: "L", 6: "XL", 7: "XXL",
-        8: "3XL", 9: "4XL", 23: "23-25", 25: "25-27", 27: "27-29",
-        60: "60", 70: "70", 80: "80", 90: "90", 100: "100", 110: "110",
-        120: "120", 130: "130", 140: "140", 150: "150", 160: "160",
-        499: "AA 65/70", 500: "AB 65/70", 501: "CD 65/70", 502: "EF 65/70",
-        503: "AB 75/80", 504: "CD 75/80", 505: "EF 75/80",
-        506: "AB 85/90", 507: "CD 85/90", 508: "EF 85/90"
-    }
-    return size_dict.get(int(size_code), "")
+    return size_name(int(size_code))
 
 
-def product_crawl(serial_number):
+def extract_page_title(html):
+    """Extract the <title> text from (the head of) a product page"""
+    # Ensure proper UTF-8 encoding for Japanese characters
+    soup = BeautifulSoup(html, 'lxml', parse_only=_title_strainer, from_encoding='utf-8')
+    title_tag = soup.find('title')
+    return title_tag.get_text().strip() if title_tag else ""
+
+
+async def fetch_product_page(product_url, timeout=None):
+    """Fetch the JP product page, return (status_code, page_title)"""
+    status_code, head_html = await async_upstream_client.get_prefix(
+        product_url, TITLE_STOP_MARKERS, chunk_size=TITLE_CHUNK_SIZE, timeout=timeout
+    )
+
+    # Get the web page title
+    page_title = ""
+    if status_code == 200:
+        try:
+            page_title = extract_page_title(head_html)
+            if page_title:
+                print(f"Page title: {page_title}")
+        except Exception as e:
+            print(f"Error getting page title: {e}")
+
+    return status_code, page_title
+
+
+async def fetch_product_detail(serial_number, timeout=None):
+    """Fetch the l2s detail payload (variants, prices and stocks), hedged when slow"""
+    detail_url = f"{UNIQLO_BASE_URL}/jp/api/commerce/v5/ja/products/E{serial_number}-000/price-groups/00/l2s?withPrices=true&withStocks=true&includePreviousPrice=false&httpFailure=true"
+    return await async_upstream_client.get_json_hedged(detail_url, timeout=timeout)
+
+
+def _discard(task):
+    """Cancel a task whose result is no longer needed"""
+    task.cancel()
+    if task.done() and not task.cancelled():
+        task.exception()
+
+
+async def search_relaxed_serial(serial_number, timeout=None):
+    """Ask the relaxed product search which serial a code belongs to.
+
+    Returns the serial, or None when the search itself didn't succeed.
+    Raises when the search succeeded but found nothing.
+    """
+    alt_api_url = f"{UNIQLO_BASE_URL}/jp/api/commerce/v5/ja/products?q={serial_number}&queryRelaxationFlag=true&offset=0&limit=36&httpFailure=true"
+    api_resp = await async_upstream_client.get_json(alt_api_url, timeout=timeout)
+
+    if api_resp.get('status') == "ok":
+        item = api_resp['result']['items'][0]
+        return item['productId'][1:7]
+    return None
+
+
+async def async_product_crawl(serial_number, deadline=None):
+    """Crawl one product on the shared aiohttp session.
+
+    Returns the same dict as ``product_crawl``, or -1 when the product
+    can't be found. Codes already known to the alias index go straight to
+    their canonical serial; a 404 product page is resolved through the
+    relaxed search at most MAX_ALIAS_HOPS times. Every stage is bounded by
+    ``deadline`` (CRAWL_DEADLINE_SECONDS by default); raises
+    UpstreamUnavailableError when Uniqlo can't answer within it. Must run
+    on the crawl engine loop (``async_upstream_client.loop``).
+    """
     product_all_info = {
         "serial_number": "",
         "product_url": "",
@@ -64,73 +111,76 @@ def product_crawl(serial_number):
         "product_list": []
     }
 
-    base_url = 'https://www.uniqlo.com/jp/ja/products/'
-    product_url = base_url + serial_number
-    response = requests.get(product_url)
-    
-    # Ensure proper UTF-8 encoding for Japanese characters
-    if response.status_code == 200:
-        response.encoding = 'utf-8'
+    loop = asyncio.get_running_loop()
+    deadline = deadline or Deadline(CRAWL_DEADLINE_SECONDS)
+    serial_number = alias_index.resolve(serial_number)
+    visited = set()
+    page_failed = False
 
-    # Get the web page title
-    page_title = ""
-    if response.status_code == 200:
+    for _ in range(MAX_ALIAS_HOPS + 1):
+        visited.add(serial_number)
+        base_url = f'{UNIQLO_BASE_URL}/jp/ja/products/'
+        product_url = base_url + serial_number
+
+        # The page and detail API don't depend on each other, so fetch them
+        # concurrently and wait for the slower one
+        stage_timeout = deadline.stage_timeout(STAGE_BUDGET['lookup'])
+        detail_task = asyncio.ensure_future(fetch_product_detail(serial_number, stage_timeout))
         try:
-            soup = BeautifulSoup(response.text, 'html.parser')
-            title_tag = soup.find('title')
-            if title_tag:
-                page_title = title_tag.get_text().strip()
-                print(f"Page title: {page_title}")
-        except Exception as e:
-            print(f"Error getting page title: {e}")
+            status_code, page_title = await fetch_product_page(product_url, stage_timeout)
+        except UpstreamUnavailableError as e:
+            # The page only supplies the title; carry on with the detail API
+            print(f"Product page unavailable: {e}")
+            status_code, page_title, page_failed = None, "", True
+        except BaseException:
+            _discard(detail_task)
+            raise
 
-    # Case 1: Product not found on JP site, directly find product on API
-    if response.status_code == 404:
+        if status_code != 404:
+            break
+
+        # Case 1: Product not found on JP site, find its canonical serial
         print("Product not found on JP site, trying alternative API.")
-        try:
-            alt_api_url = f"https://www.uniqlo.com/jp/api/commerce/v5/ja/products?q={serial_number}&queryRelaxationFlag=true&offset=0&limit=36&httpFailure=true"
-            api_resp = requests.get(alt_api_url).json()
-
-            if api_resp.get('status') == "ok":
-                serial_alt = api_resp['result']['relaxedQueries'][0]
-                item = api_resp['result']['items'][0]
-                serial_number = item['productId'][1:7]
-                # Execute product_crawl again with the new serial number
-                print(f"Found alternative serial number: {serial_number}")
-                return product_crawl(serial_number)
-        except Exception:
+        canonical_serial = await loop.run_in_executor(None, alias_index.lookup_stored, serial_number)
+        if canonical_serial is None:
+            try:
+                canonical_serial = await search_relaxed_serial(
+                    serial_number, deadline.stage_timeout(STAGE_BUDGET['search'])
+                )
+            except UpstreamUnavailableError:
+                _discard(detail_task)
+                raise
+            except Exception:
+                _discard(detail_task)
+                return -1
+            if canonical_serial is None:
+                # Search unavailable: try the detail API with the code as given
+                break
+            loop.run_in_executor(None, alias_index.remember, {serial_number: canonical_serial}, 'relaxed_query')
+
+        _discard(detail_task)
+        if canonical_serial in visited:
             return -1
+        print(f"Found alternative serial number: {canonical_serial}")
+        serial_number = canonical_serial
+    else:
+        return -1
 
     # Case 2: Product found
     try:
-        detail_url = f"https://www.uniqlo.com/jp/api/commerce/v5/ja/products/E{serial_number}-000/price-groups/00/l2s?withPrices=true&withStocks=true&includePreviousPrice=false&httpFailure=true"
-        detail_resp = requests.get(detail_url).json()
-
-        price_jp = None
-        product_list = []
-
-        for item in detail_resp['result']['l2s']:
-            l2_id = item['l2Id']
-            color = get_color_name(item['color']['code'][-2:])
-            size = get_size_name(item['size']['code'][-3:])
-
-            stock = detail_resp['result']['stocks'].get(l2_id, {}).get('statusCode', 0)
-            price = detail_resp['result']['prices'].get(l2_id, {}).get('base', {}).get('value', 0)
-
-            if price_jp is None:
-                price_jp = price
-
-            product_list.append({
-                "serial": serial_number,
-                "serial_alt": item['communicationCode'][:6],
-                "id": l2_id,
-                "color": color,
-                "size": size,
-                "stock": stock,
-                "price": price
-            })
-
-        rate = fetch_exchange_rate()
+        detail_resp = await detail_task
+    except UpstreamUnavailableError:
+        raise
+    except Exception:
+        return -1
+
+    try:
+        variants = decode_l2s(detail_resp)
+        price_jp = variants.first_price
+        product_list = variants.to_product_list(serial_number)
+
+        # Served from memory; a stale rate is refreshed in the background
+        rate = exchange_rate_service.get_rate()
         jp_price_in_twd = round(price_jp * rate) if rate else 0
 
         product_all_info.update({
@@ -142,12 +192,83 @@ def product_crawl(serial_number):
             "product_list": product_list
         })
 
+        # Communication codes on the tags resolve to this serial from now on
+        communication_aliases = dict.fromkeys(variants.serial_alts, serial_number)
+        loop.run_in_executor(None, alias_index.remember, communication_aliases, 'communication_code')
+
         return product_all_info
 
     except Exception:
+        if page_failed:
+            # Without the page we can't tell "not found" from "not reachable"
+            raise UpstreamUnavailableError(f"Could not crawl {serial_number}")
         return -1
 
-            
+
+def product_crawl(serial_number):
+    """Synchronous wrapper around ``async_product_crawl`` on the crawl engine loop"""
+    return async_upstream_client.run(async_product_crawl(serial_number))
+
+
+async def async_product_crawl_many(serial_numbers, concurrency=None, rate_limit=None):
+    """Crawl many products, yielding (serial_number, result) as each one finishes.
+
+    Duplicate serials are crawled once. At most ``concurrency`` lookups are
+    in flight, and requests to each upstream host are spaced to
+    ``rate_limit`` per second. A lookup that raises yields -1, except when
+    Uniqlo was unavailable, which yields None.
+    """
+    concurrency = concurrency or CRAWL_BATCH_CONCURRENCY
+    rate_limit = CRAWL_RATE_LIMIT if rate_limit is None else rate_limit
+    limiter = HostRateLimiter(rate_limit) if rate_limit else None
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def crawl_one(serial_number):
+        async with semaphore:
+            current_rate_limiter.set(limiter)
+            try:
+                return serial_number, await async_product_crawl(serial_number)
+            except UpstreamUnavailableError as e:
+                print(f"Batch crawl unavailable for {serial_number}: {e}")
+                return serial_number, None
+            except Exception as e:
+                print(f"Batch crawl failed for {serial_number}: {e}")
+                return serial_number, -1
+
+    unique_serials = dict.fromkeys(serial for serial in serial_numbers if serial)
+    tasks = [asyncio.ensure_future(crawl_one(serial)) for serial in unique_serials]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def product_crawl_many(serial_numbers, concurrency=None, rate_limit=None):
+    """Synchronous generator over ``async_product_crawl_many`` on the crawl engine loop"""
+    results = queue.Queue()
+    done = object()
+
+    async def pump():
+        try:
+            async for pair in async_product_crawl_many(serial_numbers, concurrency, rate_limit):
+                results.put(pair)
+        finally:
+            results.put(done)
+
+    future = async_upstream_client.submit(pump())
+    try:
+        while True:
+            item = results.get()
+            if item is done:
+                break
+            yield item
+        future.result()
+    finally:
+        future.cancel()
+
+
 # test, product list = [464787, 467536, 467543, 459591, 450314]
 if __name__ == '__main__':
     serial_number = '474479'
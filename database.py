@@ -2,15 +2,28 @@
 Database models and connection for UNIQLO Price Finder
 """
 import os
+import json
+import time
+import hashlib
+import queue
+import atexit
 import logging
-from datetime import datetime
-from typing import Optional, List, Dict, Any
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Float, Text, Boolean
+import threading
+from datetime import datetime, timedelta
+from typing import Optional, List, Dict, Any, Set
+from sqlalchemy import (create_engine, inspect, insert, update, select, union_all, func, literal, literal_column,
+                        bindparam, null, or_, text, Column, Index, Integer, String, DateTime, Float, Text, Boolean)
+from sqlalchemy.schema import CreateIndex
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
-from sqlalchemy.dialects.postgresql import JSON
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import JSON, insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from dotenv import load_dotenv
 
+from memory_cache import LRUCache
+from cache_backends import SQLCacheBackend, create_shared_backend
+
 # Load environment variables
 load_dotenv()
 load_dotenv('.env.database')
@@ -32,12 +45,93 @@ class SearchHistory(Base):
     jp_price = Column(Integer, nullable=True)
     jp_price_in_twd = Column(Integer, nullable=True)
     tw_prices = Column(JSON, nullable=True)  # Store as JSON array
-    product_data = Column(JSON, nullable=True)  # Store full product response
+    product_data = Column(JSON, nullable=True)  # Full product response (rows from before snapshots)
+    snapshot_hash = Column(String(64), nullable=True, index=True)  # ProductSnapshot.content_hash
     product_url = Column(Text, nullable=True)
     search_source = Column(String(20), default='api', nullable=False)  # 'api', 'linebot', 'web'
     user_id = Column(String(100), nullable=True)  # Line user ID if from Line Bot
     is_successful = Column(Boolean, default=True, nullable=False)
     error_message = Column(Text, nullable=True)
+    # Summaries of product_data computed at write time, so listing history
+    # never has to load or walk the full product JSON
+    page_title = Column(Text, nullable=True)
+    colors = Column(JSON, nullable=True)  # Distinct colors, in variant order
+    in_stock_sizes = Column(JSON, nullable=True)  # Distinct sizes with stock
+    variant_count = Column(Integer, nullable=True)  # NULL until summarized
+    
+    __table_args__ = (
+        # A user's history, newest first (/api/history, history deletes)
+        Index('ix_search_history_user_success_time', 'user_id', 'is_successful', 'search_timestamp'),
+        # Successful searches grouped by product; covers the count
+        Index('ix_search_history_success_product', 'is_successful', 'product_id'),
+        # Time-window counts and the pre-warm ingest window
+        Index('ix_search_history_timestamp', 'search_timestamp'),
+    )
+
+class ProductSnapshot(Base):
+    """One copy of each distinct product response, shared by every history row that saw it"""
+    __tablename__ = 'product_snapshot'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    content_hash = Column(String(64), nullable=False, unique=True, index=True)
+    product_id = Column(String(50), nullable=False)
+    product_data = Column(JSON, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    orphaned_at = Column(DateTime, nullable=True)  # When GC found no history row referencing it
+
+class PriceObservation(Base):
+    """Per-variant price and stock change points, folded into hourly and daily buckets as they age"""
+    __tablename__ = 'price_observation'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    product_id = Column(String(50), nullable=False)
+    l2_id = Column(String(50), nullable=False)
+    observed_at = Column(DateTime, nullable=False)  # When the value changed, or the bucket start
+    resolution = Column(Integer, default=0, nullable=False)  # 0 change point, 3600 hourly, 86400 daily
+    price = Column(Integer, nullable=True)  # Price at the change, or at the bucket's close
+    min_price = Column(Integer, nullable=True)  # Bucket range; NULL for change points
+    max_price = Column(Integer, nullable=True)
+    stock = Column(String(20), nullable=True)  # Stock status at the change / bucket close
+    changes = Column(Integer, default=1, nullable=False)  # Change points folded into the row
+    
+    __table_args__ = (
+        # A product's history over a time range is one index range scan
+        Index('ix_price_observation_product_time', 'product_id', 'observed_at'),
+    )
+
+class VariantPriceState(Base):
+    """Latest observed price and stock of each variant, so only changes are written"""
+    __tablename__ = 'variant_price_state'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    product_id = Column(String(50), nullable=False)
+    l2_id = Column(String(50), nullable=False)
+    price = Column(Integer, nullable=True)
+    stock = Column(String(20), nullable=True)
+    observed_at = Column(DateTime, nullable=False)
+    
+    __table_args__ = (
+        Index('ix_variant_price_state_product_variant', 'product_id', 'l2_id', unique=True),
+    )
+
+class SearchStatsHourly(Base):
+    """Search counts per hour, maintained as history rows are written"""
+    __tablename__ = 'search_stats_hourly'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    hour_bucket = Column(DateTime, nullable=False, unique=True, index=True)
+    search_count = Column(Integer, default=0, nullable=False)
+    successful_count = Column(Integer, default=0, nullable=False)
+
+class ProductSearchStats(Base):
+    """Search counts per product, maintained as history rows are written"""
+    __tablename__ = 'product_search_stats'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    product_id = Column(String(50), nullable=False, unique=True, index=True)
+    search_count = Column(Integer, default=0, nullable=False)
+    successful_count = Column(Integer, default=0, nullable=False, index=True)
+    last_searched = Column(DateTime, nullable=True)
 
 class PriceCache(Base):
     """Cache recent price data to reduce API calls"""
@@ -52,6 +146,44 @@ class PriceCache(Base):
     access_count = Column(Integer, default=1, nullable=False)
     last_accessed = Column(DateTime, default=datetime.utcnow, nullable=False)
 
+class NegativeCache(Base):
+    """Remember products that could not be found, to avoid re-crawling them"""
+    __tablename__ = 'negative_cache'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    product_id = Column(String(50), nullable=False, unique=True, index=True)
+    reason = Column(String(50), default='not_found', nullable=False)
+    cache_timestamp = Column(DateTime, default=datetime.utcnow, nullable=False)
+    expiry_timestamp = Column(DateTime, nullable=False)  # When the entry expires
+
+class ProductAlias(Base):
+    """Map codes users type (alternative serials, communication codes) to canonical serials"""
+    __tablename__ = 'product_alias'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    alias_code = Column(String(50), nullable=False, unique=True, index=True)
+    serial_number = Column(String(50), nullable=False)
+    source = Column(String(30), nullable=False)  # 'relaxed_query', 'communication_code'
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+
+class CrawlLease(Base):
+    """Short-lived cross-worker lease so only one worker crawls a product at a time"""
+    __tablename__ = 'crawl_lease'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    lease_key = Column(String(100), nullable=False, unique=True, index=True)
+    holder = Column(String(100), nullable=False)
+    expiry_timestamp = Column(DateTime, nullable=False)
+
+class WebhookEvent(Base):
+    """LINE webhookEventIds already handled, so redeliveries are dropped across workers"""
+    __tablename__ = 'webhook_event'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    event_id = Column(String(100), nullable=False, unique=True, index=True)
+    expiry_timestamp = Column(DateTime, nullable=False, index=True)
+
 class SystemConfig(Base):
     """Store system configuration and settings"""
     __tablename__ = 'system_config'
@@ -64,12 +196,149 @@ class SystemConfig(Base):
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
 
+def migrate_schema(engine) -> List[str]:
+    """Add the nullable columns declared on the models that an existing
+    database lacks; returns the columns added.
+
+    ``create_all`` skips tables that already exist, so columns added to a
+    model later are created here, on every start. Missing indexes are only
+    reported: building them can take long on a large search_history, so
+    that is left to ``migrate_indexes`` (``db_maintenance.py migrate``).
+    """
+    created = []
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in columns or not column.nullable:
+                continue
+            column_type = column.type.compile(dialect=engine.dialect)
+            try:
+                with engine.begin() as connection:
+                    connection.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}")
+                created.append(f"{table.name}.{column.name}")
+                logger.info(f"Added column {column.name} to {table.name}")
+            except Exception as e:
+                # Another instance may have added it first
+                logger.error(f"Failed to add column {table.name}.{column.name}: {e}")
+        
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        missing = sorted(index.name for index in table.indexes if index.name not in existing)
+        if missing:
+            logger.warning(f"Indexes missing on {table.name}: {', '.join(missing)}; "
+                           f"run `python db_maintenance.py migrate`")
+    return created
+
+def migrate_indexes(engine) -> List[str]:
+    """Create the indexes declared on the models that an existing database
+    lacks; returns the names of the indexes created.
+
+    On PostgreSQL indexes are built CONCURRENTLY so writes to a large
+    search_history aren't blocked. A concurrent build that failed leaves an
+    INVALID index behind under the same name; those are dropped and built
+    again.
+    """
+    created = []
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        if engine.dialect.name == 'postgresql':
+            with engine.connect() as connection:
+                invalid = set(connection.execute(text(
+                    "SELECT c.relname FROM pg_index i "
+                    "JOIN pg_class c ON c.oid = i.indexrelid "
+                    "JOIN pg_class t ON t.oid = i.indrelid "
+                    "WHERE t.relname = :table AND NOT i.indisvalid"
+                ), {'table': table.name}).scalars())
+        else:
+            invalid = set()
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name in existing and index.name not in invalid:
+                continue
+            try:
+                if engine.dialect.name == 'postgresql':
+                    ddl = str(CreateIndex(index, if_not_exists=True).compile(dialect=engine.dialect))
+                    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+                        if index.name in invalid:
+                            logger.warning(f"Rebuilding invalid index {index.name}")
+                            connection.exec_driver_sql(f"DROP INDEX CONCURRENTLY IF EXISTS {index.name}")
+                        connection.exec_driver_sql(ddl.replace('CREATE INDEX', 'CREATE INDEX CONCURRENTLY', 1))
+                else:
+                    index.create(bind=engine, checkfirst=True)
+                created.append(index.name)
+                logger.info(f"Created index {index.name} on {table.name}")
+            except Exception as e:
+                # Another instance may be building the same index
+                logger.error(f"Failed to create index {index.name}: {e}")
+    return created
+
 class DatabaseManager:
     """Manages database connections and operations"""
     
+    ROLLUPS_CONFIG_KEY = 'search_rollups_built'
+    # Product fields that change without the product changing; they are kept
+    # in their own history columns and left out of snapshots
+    SNAPSHOT_VOLATILE_FIELDS = ('jp_price_in_twd',)
+    
     def __init__(self):
         self.engine = None
         self.SessionLocal = None
+        self.negative_cache_minutes = int(os.getenv('NEGATIVE_CACHE_TTL_MINUTES', '10'))
+        # Past its expiry (soft TTL) a price is still served, and refreshed in
+        # the background, until it is this many hours old (hard TTL)
+        self.price_cache_hard_ttl_hours = float(os.getenv('PRICE_CACHE_HARD_TTL_HOURS', '24'))
+        self._stats_lock = threading.Lock()
+        self.negative_cache_stats = {'hits': 0, 'misses': 0, 'stores': 0, 'invalidations': 0}
+        self._rollups_ready = False
+        # Snapshot hashes known to be stored already, so popular products
+        # don't re-send their snapshot with every history batch
+        self._known_snapshots = LRUCache(
+            max_entries=int(os.getenv('SNAPSHOT_KNOWN_MAX', '4096')),
+            max_bytes=int(os.getenv('SNAPSHOT_KNOWN_MAX', '4096')) * 64
+        )
+        # Known hashes are forgotten after SNAPSHOT_KNOWN_TTL_SECONDS, so a snapshot
+        # garbage-collected later is stored again rather than referenced dangling
+        self.snapshot_known_ttl = float(os.getenv('SNAPSHOT_KNOWN_TTL_SECONDS', '3600'))
+        self.snapshot_stats = {'stored': 0, 'skipped_known': 0}
+        
+        # In-process L1 in front of PriceCache; entries live at most
+        # PRICE_L1_TTL_SECONDS so other workers' updates are picked up
+        self.price_l1 = LRUCache(
+            max_entries=int(os.getenv('PRICE_L1_MAX_ENTRIES', '1024')),
+            max_bytes=int(os.getenv('PRICE_L1_MAX_BYTES', str(32 * 1024 * 1024)))
+        )
+        self.price_l1_ttl = float(os.getenv('PRICE_L1_TTL_SECONDS', '60'))
+        # Lookups go L1 -> shared backend (PRICE_CACHE_BACKEND) -> price_cache
+        # table; writes go to the table, which stays the store of record
+        self.price_store = SQLCacheBackend(self.get_session, PriceCache)
+        self.price_shared = create_shared_backend(os.getenv('PRICE_CACHE_BACKEND', 'sql'))
+        # Cache hits are counted in memory and written in one batched UPDATE
+        self.access_flush_interval = float(os.getenv('PRICE_ACCESS_FLUSH_INTERVAL', '30'))
+        self._access_buffer = {}  # product_id -> [hits, last_accessed]
+        self._access_lock = threading.Lock()
+        self._access_flusher = None
+        self._access_flush_stop = threading.Event()
+        self.access_flush_stats = {'flushes': 0, 'rows': 0, 'failures': 0}
+        
+        # Search history is written behind the request: rows are queued and a
+        # background thread inserts them every HISTORY_FLUSH_ROWS rows or
+        # HISTORY_FLUSH_INTERVAL_MS milliseconds
+        self.history_write_behind = os.getenv('HISTORY_WRITE_BEHIND', 'true').lower() == 'true'
+        self.history_flush_rows = int(os.getenv('HISTORY_FLUSH_ROWS', '200'))
+        self.history_flush_interval = int(os.getenv('HISTORY_FLUSH_INTERVAL_MS', '500')) / 1000
+        self.history_enqueue_timeout = int(os.getenv('HISTORY_ENQUEUE_TIMEOUT_MS', '50')) / 1000
+        self._history_queue = queue.Queue(maxsize=int(os.getenv('HISTORY_QUEUE_MAX', '10000')))
+        self._history_pending = 0
+        self._history_done = threading.Condition()
+        self._history_flush_now = threading.Event()
+        self._history_flusher = None
+        self.history_queue_stats = {'enqueued': 0, 'dropped': 0, 'written': 0, 'failed': 0,
+                                    'batches': 0, 'last_flush_ms': None, 'max_flush_ms': 0.0,
+                                    'total_flush_ms': 0.0}
         self._setup_database()
     
     def _setup_database(self):
@@ -110,8 +379,9 @@ class DatabaseManager:
             
             self.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
             
-            # Create tables
+            # Create tables, and indexes that existing tables lack
             Base.metadata.create_all(bind=self.engine)
+            migrate_schema(self.engine)
             logger.info("Database connection established successfully")
             
         except Exception as e:
@@ -122,101 +392,1146 @@ class DatabaseManager:
             self.engine = create_engine('sqlite:///data/uniqlo_price_finder.db', echo=False)
             self.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
             Base.metadata.create_all(bind=self.engine)
+            migrate_schema(self.engine)
     
     def get_session(self) -> Session:
         """Get a database session"""
         return self.SessionLocal()
     
+    @staticmethod
+    def summarize_product(search_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Title, distinct colors, distinct in-stock sizes and variant count of a product"""
+        variants = search_data.get('product_list') or []
+        return {
+            'page_title': search_data.get('page_title') or '',
+            'colors': list(dict.fromkeys(item['color'] for item in variants if item.get('color'))),
+            'in_stock_sizes': list(dict.fromkeys(item['size'] for item in variants
+                                                 if item.get('size') and item.get('stock') == 'IN_STOCK')),
+            'variant_count': len(variants)
+        }
+    
+    @classmethod
+    def product_snapshot(cls, search_data: Dict[str, Any]) -> tuple:
+        """(content_hash, snapshot) of a product response: volatile fields are
+        dropped and the hash is taken over canonical JSON (sorted keys)"""
+        snapshot = {key: value for key, value in search_data.items() if key not in cls.SNAPSHOT_VOLATILE_FIELDS}
+        canonical = json.dumps(snapshot, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+        return hashlib.sha256(canonical.encode()).hexdigest(), snapshot
+    
+    def _history_row(self, product_id: str, search_data: Dict[str, Any],
+                     source: str = 'api', user_id: Optional[str] = None,
+                     is_successful: bool = True, error_message: Optional[str] = None) -> Dict[str, Any]:
+        """Build the column values of one SearchHistory row; the product itself
+        goes to the snapshot store (under 'snapshot', removed before the insert)"""
+        snapshot_hash, snapshot = self.product_snapshot(search_data) if search_data else (None, None)
+        return {
+            **self.summarize_product(search_data),
+            'snapshot_hash': snapshot_hash,
+            'snapshot': snapshot,
+            'product_id': product_id,
+            'serial_number': search_data.get('serial_number'),
+            'search_timestamp': datetime.utcnow(),
+            'jp_price': search_data.get('price_jp'),
+            'jp_price_in_twd': search_data.get('jp_price_in_twd'),
+            'tw_prices': search_data.get('price_tw', []),
+            'product_url': search_data.get('product_url'),
+            'search_source': source,
+            'user_id': user_id,
+            'is_successful': is_successful,
+            'error_message': error_message
+        }
+
     def save_search_history(self, product_id: str, search_data: Dict[str, Any], 
                           source: str = 'api', user_id: Optional[str] = None,
                           is_successful: bool = True, error_message: Optional[str] = None):
-        """Save search history to database"""
-        try:
-            with self.get_session() as session:
-                history = SearchHistory(
-                    product_id=product_id,
-                    serial_number=search_data.get('serial_number'),
-                    jp_price=search_data.get('price_jp'),
-                    jp_price_in_twd=search_data.get('jp_price_in_twd'),
-                    tw_prices=search_data.get('price_tw', []),
-                    product_data=search_data,
-                    product_url=search_data.get('product_url'),
-                    search_source=source,
-                    user_id=user_id,
-                    is_successful=is_successful,
-                    error_message=error_message
-                )
-                session.add(history)
-                session.commit()
-                logger.info(f"Search history saved for product {product_id}")
+        """Save search history to database (queued, written in the background)"""
+        try:
+            self._enqueue_history([self._history_row(
+                product_id, search_data, source, user_id, is_successful, error_message
+            )])
         except Exception as e:
             logger.error(f"Failed to save search history: {e}")
+
+    def save_search_history_bulk(self, entries: List[Dict[str, Any]]):
+        """Save many searches; each entry takes the keyword arguments of ``save_search_history``"""
+        if not entries:
+            return
+        try:
+            self._enqueue_history([self._history_row(**entry) for entry in entries])
+        except Exception as e:
+            logger.error(f"Failed to save search history batch: {e}")
+
+    def _enqueue_history(self, rows: List[Dict[str, Any]]):
+        """Queue rows for the history flusher, or write them now without write-behind.
+
+        When the queue is full a call waits at most HISTORY_ENQUEUE_TIMEOUT_MS
+        in total, however many rows it brings; rows that still don't fit are
+        dropped and counted.
+        """
+        if not self.history_write_behind:
+            self._write_history_rows(rows)
+            return
+        
+        self._start_history_flusher()
+        deadline = time.monotonic() + self.history_enqueue_timeout
+        for row in rows:
+            # Counted before the put, so flush_history can't return while the row is in flight
+            with self._history_done:
+                self._history_pending += 1
+            try:
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    self._history_queue.put(row, timeout=remaining)
+                else:
+                    self._history_queue.put_nowait(row)
+            except queue.Full:
+                with self._history_done:
+                    self._history_pending -= 1
+                    self._history_done.notify_all()
+                self.history_queue_stats['dropped'] += 1
+                logger.warning(f"History queue full, dropped search of {row['product_id']}")
+                continue
+            self.history_queue_stats['enqueued'] += 1
+
+    def _store_snapshots(self, session, snapshots: Dict[str, tuple]) -> List[str]:
+        """Insert the snapshots {hash: (product_id, data)} not already stored;
+        returns the hashes sent, to be remembered once the caller commits"""
+        new = {content_hash: value for content_hash, value in snapshots.items()
+               if self._known_snapshots.get(content_hash) is None}
+        with self._stats_lock:
+            self.snapshot_stats['skipped_known'] += len(snapshots) - len(new)
+        if not new:
+            return []
+        
+        now = datetime.utcnow()
+        rows = [{'content_hash': content_hash, 'product_id': product_id, 'product_data': data, 'created_at': now}
+                for content_hash, (product_id, data) in new.items()]
+        dialect = session.get_bind().dialect.name
+        if dialect in ('sqlite', 'postgresql'):
+            dialect_insert = sqlite_insert if dialect == 'sqlite' else postgresql_insert
+            # A snapshot referenced again is no longer a garbage-collection candidate
+            session.execute(dialect_insert(ProductSnapshot).on_conflict_do_update(
+                index_elements=['content_hash'],
+                set_={'orphaned_at': None},
+                where=ProductSnapshot.orphaned_at.isnot(None)
+            ), rows)
+        else:
+            stored = {content_hash for (content_hash,) in session.query(ProductSnapshot.content_hash).filter(
+                ProductSnapshot.content_hash.in_(list(new)))}
+            if stored:
+                session.query(ProductSnapshot).filter(ProductSnapshot.content_hash.in_(stored)).update(
+                    {ProductSnapshot.orphaned_at: None}, synchronize_session=False)
+            session.add_all([ProductSnapshot(**row) for row in rows if row['content_hash'] not in stored])
+        with self._stats_lock:
+            self.snapshot_stats['stored'] += len(rows)
+        return list(new)
+    
+    def _remember_snapshots(self, content_hashes: List[str]):
+        for content_hash in content_hashes:
+            self._known_snapshots.set(content_hash, True, size=64, ttl=self.snapshot_known_ttl)
+    
+    def get_history_product(self, history_id: int) -> Optional[Dict[str, Any]]:
+        """Full product response of a history row, from its snapshot (or legacy copy)"""
+        with self.get_session() as session:
+            row = session.query(SearchHistory.product_data, SearchHistory.jp_price_in_twd,
+                                ProductSnapshot.product_data.label('snapshot')).outerjoin(
+                ProductSnapshot, ProductSnapshot.content_hash == SearchHistory.snapshot_hash
+            ).filter(SearchHistory.id == history_id).first()
+        if row is None:
+            return None
+        if row.snapshot is None:
+            return row.product_data
+        return {**row.snapshot, 'jp_price_in_twd': row.jp_price_in_twd}
     
-    def get_cached_price(self, product_id: str) -> Optional[Dict[str, Any]]:
-        """Get cached price data if still valid"""
+    def compact_history_snapshots(self, batch_size: int = 1000) -> Dict[str, int]:
+        """Move product_data of older history rows into the snapshot store.
+
+        Rows are processed in id order; each batch stores its distinct
+        snapshots, points the rows at them and clears their own copy
+        (filling in the summary columns on the way). Returns counts.
+        """
+        self.flush_history()
+        result = {'rows': 0, 'snapshots': 0}
+        last_id = 0
+        stmt = update(SearchHistory).where(SearchHistory.id == bindparam('b_id')).values(
+            snapshot_hash=bindparam('b_snapshot_hash'),
+            product_data=null(),
+            page_title=bindparam('b_page_title'),
+            colors=bindparam('b_colors'),
+            in_stock_sizes=bindparam('b_in_stock_sizes'),
+            variant_count=bindparam('b_variant_count')
+        )
+        while True:
+            with self.get_session() as session:
+                rows = session.query(SearchHistory.id, SearchHistory.product_id, SearchHistory.product_data).filter(
+                    SearchHistory.id > last_id,
+                    SearchHistory.snapshot_hash.is_(None),
+                    SearchHistory.product_data.isnot(None)
+                ).order_by(SearchHistory.id).limit(batch_size).all()
+                if not rows:
+                    break
+                snapshots, params = {}, []
+                for row_id, product_id, product_data in rows:
+                    content_hash, snapshot = self.product_snapshot(product_data) if product_data else (None, None)
+                    if content_hash:
+                        snapshots[content_hash] = (product_id, snapshot)
+                    summary = self.summarize_product(product_data or {})
+                    params.append({'b_id': row_id, 'b_snapshot_hash': content_hash,
+                                   **{f"b_{key}": value for key, value in summary.items()}})
+                stored = self._store_snapshots(session, snapshots)
+                session.connection().execute(stmt, params)
+                session.commit()
+            self._remember_snapshots(stored)
+            last_id = rows[-1][0]
+            result['rows'] += len(rows)
+            result['snapshots'] += len(snapshots)
+            logger.info(f"Compacted {result['rows']} history rows")
+        return result
+    
+    def collect_orphan_snapshots(self, grace_seconds: Optional[float] = None) -> Dict[str, int]:
+        """Delete snapshots no history row references any more (e.g. after user deletes).
+
+        Collection takes two runs: a run marks unreferenced snapshots, and a
+        later run deletes those still unreferenced once marked for
+        ``grace_seconds`` (default twice SNAPSHOT_KNOWN_TTL_SECONDS). By then no
+        worker still remembers the hash as stored, so none can write a row
+        pointing at a deleted snapshot; storing it again clears the mark.
+        Returns counts.
+        """
+        if grace_seconds is None:
+            grace_seconds = 2 * self.snapshot_known_ttl
+        now = datetime.utcnow()
+        referenced = select(SearchHistory.id).where(
+            SearchHistory.snapshot_hash == ProductSnapshot.content_hash).exists()
+        with self.get_session() as session:
+            unmarked = session.query(ProductSnapshot).filter(
+                ProductSnapshot.orphaned_at.isnot(None), referenced
+            ).update({ProductSnapshot.orphaned_at: None}, synchronize_session=False)
+            deleted = session.query(ProductSnapshot).filter(
+                ProductSnapshot.orphaned_at <= now - timedelta(seconds=grace_seconds), ~referenced
+            ).delete(synchronize_session=False)
+            marked = session.query(ProductSnapshot).filter(
+                ProductSnapshot.orphaned_at.is_(None), ~referenced
+            ).update({ProductSnapshot.orphaned_at: now}, synchronize_session=False)
+            session.commit()
+        logger.info(f"Snapshot GC: {deleted} deleted, {marked} marked, {unmarked} referenced again")
+        return {'deleted': deleted, 'marked': marked, 'unmarked': unmarked}
+    
+    def _write_history_rows(self, rows: List[Dict[str, Any]]) -> bool:
+        """Insert rows with one executemany INSERT and a single commit"""
+        started = time.perf_counter()
         try:
+            snapshots = {row['snapshot_hash']: (row['product_id'], row['snapshot'])
+                          for row in rows if row['snapshot_hash']}
+            history_rows = [{key: value for key, value in row.items() if key != 'snapshot'} for row in rows]
             with self.get_session() as session:
-                cache = session.query(PriceCache).filter(
-                    PriceCache.product_id == product_id,
-                    PriceCache.expiry_timestamp > datetime.utcnow()
-                ).first()
-                
-                if cache:
-                    # Update access statistics
-                    cache.access_count += 1
-                    cache.last_accessed = datetime.utcnow()
-                    session.commit()
-                    logger.info(f"Cache hit for product {product_id}")
-                    return cache.cached_data
-                
-                return None
+                stored = self._store_snapshots(session, snapshots)
+                session.execute(insert(SearchHistory), history_rows)
+                self._apply_search_rollups(session, rows)
+                session.commit()
+            self._remember_snapshots(stored)
+            logger.info(f"Search history saved for {len(rows)} searches")
+            written = True
+        except Exception as e:
+            logger.error(f"Failed to write {len(rows)} search history rows: {e}")
+            written = False
+        
+        flush_ms = (time.perf_counter() - started) * 1000
+        with self._history_done:
+            stats = self.history_queue_stats
+            stats['written' if written else 'failed'] += len(rows)
+            stats['batches'] += 1
+            stats['last_flush_ms'] = round(flush_ms, 2)
+            stats['max_flush_ms'] = round(max(stats['max_flush_ms'], flush_ms), 2)
+            stats['total_flush_ms'] += flush_ms
+        return written
+
+    def _start_history_flusher(self):
+        with self._history_done:
+            if self._history_flusher is not None:
+                return
+            self._history_flusher = threading.Thread(target=self._history_flush_loop,
+                                                     name='history-writer', daemon=True)
+            self._history_flusher.start()
+        # Drain whatever is still queued when the process exits
+        atexit.register(self.flush_history)
+
+    def _history_flush_loop(self):
+        while True:
+            try:
+                batch = [self._history_queue.get(timeout=self.history_flush_interval)]
+            except queue.Empty:
+                continue
+            
+            # Collect up to a full batch, for at most one flush interval
+            deadline = time.monotonic() + self.history_flush_interval
+            while len(batch) < self.history_flush_rows:
+                remaining = 0 if self._history_flush_now.is_set() else deadline - time.monotonic()
+                try:
+                    if remaining <= 0:
+                        batch.append(self._history_queue.get_nowait())
+                    else:
+                        batch.append(self._history_queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            self._write_history_rows(batch)
+            with self._history_done:
+                self._history_pending -= len(batch)
+                self._history_done.notify_all()
+
+    def flush_history(self, timeout: float = 10.0) -> bool:
+        """Write every queued history row now; returns False if that took over ``timeout``"""
+        deadline = time.monotonic() + timeout
+        self._history_flush_now.set()
+        try:
+            with self._history_done:
+                while self._history_pending > 0:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self._history_done.wait(remaining)
+            return True
+        finally:
+            self._history_flush_now.clear()
+
+    def get_history_queue_stats(self) -> Dict[str, Any]:
+        """Queue depth and flush latency of the history write-behind pipeline"""
+        with self._history_done:
+            stats = dict(self.history_queue_stats)
+            pending = self._history_pending
+        total_flush_ms = stats.pop('total_flush_ms')
+        return {
+            'depth': self._history_queue.qsize(),
+            'pending': pending,
+            'capacity': self._history_queue.maxsize,
+            'avg_flush_ms': round(total_flush_ms / stats['batches'], 2) if stats['batches'] else None,
+            'snapshots': dict(self.snapshot_stats),
+            **stats
+        }
+    
+    def _price_records(self, product_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Cached price records {'data', 'cache_timestamp', 'expiry_timestamp'} by
+        product id, looked up tier by tier with one request per tier for all misses"""
+        records = {}
+        missing = []
+        for product_id in product_ids:
+            record = self.price_l1.get(product_id)
+            if record is not None:
+                records[product_id] = record
+            else:
+                missing.append(product_id)
+        
+        if missing and self.price_shared is not None:
+            found = self.price_shared.get_many(missing)
+            for product_id, record in found.items():
+                records[product_id] = record
+                self._remember_price(product_id, record)
+            missing = [product_id for product_id in missing if product_id not in found]
+        
+        if missing:
+            for product_id, record in self.price_store.get_many(missing).items():
+                records[product_id] = record
+                self._remember_price(product_id, record, shared=True)
+        return records
+    
+    def _price_record(self, product_id: str) -> Optional[Dict[str, Any]]:
+        return self._price_records([product_id]).get(product_id)
+    
+    def _price_ttl(self, record: Dict[str, Any]) -> float:
+        """Seconds until a record reaches its hard expiry and may no longer be served"""
+        hard_expiry = max(record['expiry_timestamp'],
+                          record['cache_timestamp'] + timedelta(hours=self.price_cache_hard_ttl_hours))
+        return (hard_expiry - datetime.utcnow()).total_seconds()
+    
+    def _remember_price(self, product_id: str, record: Dict[str, Any], shared: bool = False):
+        """Keep a price record in L1 until the L1 TTL or its hard expiry, whichever is
+        first; with ``shared`` also write it to the shared backend"""
+        ttl = self._price_ttl(record)
+        size = len(json.dumps(record['data'], ensure_ascii=False, default=str))
+        self.price_l1.set(product_id, record, size, min(self.price_l1_ttl, ttl))
+        if shared and self.price_shared is not None:
+            self.price_shared.set(product_id, record, ttl)
+    
+    def evict_price_l1(self, product_id: Optional[str] = None):
+        """Drop one product (or everything) from L1, e.g. after editing price_cache directly"""
+        if product_id is None:
+            self.price_l1.clear()
+        else:
+            self.price_l1.delete(product_id)
+    
+    def get_cached_price(self, product_id: str, allow_stale: bool = False) -> Optional[Dict[str, Any]]:
+        """Get cached price data if still valid (or at all, with ``allow_stale``)"""
+        try:
+            record = self._price_record(product_id)
+            if record and (allow_stale or record['expiry_timestamp'] > datetime.utcnow()):
+                self._record_access(product_id)
+                logger.info(f"Cache hit for product {product_id}")
+                return record['data']
+            return None
         except Exception as e:
             logger.error(f"Failed to get cached price: {e}")
             return None
     
+    def get_cached_price_entry(self, product_id: str) -> Optional[Dict[str, Any]]:
+        """Get cached price data with its age, for stale-while-revalidate.
+
+        Returns {'data', 'age_seconds', 'is_stale'} for an entry that is
+        either unexpired or younger than the hard TTL; None otherwise.
+        """
+        return self.get_cached_price_entries([product_id]).get(product_id)
+    
+    def get_cached_price_entries(self, product_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """``get_cached_price_entry`` for many products at once (batch lookups)"""
+        try:
+            records = self._price_records(product_ids)
+        except Exception as e:
+            logger.error(f"Failed to get cached price entries: {e}")
+            return {}
+        
+        now = datetime.utcnow()
+        hard_cutoff = now - timedelta(hours=self.price_cache_hard_ttl_hours)
+        entries = {}
+        for product_id, record in records.items():
+            is_stale = record['expiry_timestamp'] <= now
+            if is_stale and record['cache_timestamp'] <= hard_cutoff:
+                continue
+            
+            self._record_access(product_id)
+            logger.info(f"Cache {'stale ' if is_stale else ''}hit for product {product_id}")
+            entries[product_id] = {
+                'data': record['data'],
+                'age_seconds': max((now - record['cache_timestamp']).total_seconds(), 0.0),
+                'is_stale': is_stale
+            }
+        return entries
+    
+    def _record_access(self, product_id: str):
+        """Buffer a cache hit; flushed to price_cache by ``flush_access_stats``"""
+        with self._access_lock:
+            entry = self._access_buffer.setdefault(product_id, [0, None])
+            entry[0] += 1
+            entry[1] = datetime.utcnow()
+            if self._access_flusher is None:
+                self._access_flusher = threading.Thread(target=self._flush_access_loop,
+                                                        name='price-access-flush', daemon=True)
+                self._access_flusher.start()
+                atexit.register(self.flush_access_stats)
+    
+    def _flush_access_loop(self):
+        while not self._access_flush_stop.wait(self.access_flush_interval):
+            self.flush_access_stats()
+    
+    def flush_access_stats(self) -> int:
+        """Write buffered hit counts to price_cache in one batched UPDATE; returns rows"""
+        with self._access_lock:
+            pending, self._access_buffer = self._access_buffer, {}
+        if not pending:
+            return 0
+        
+        stmt = update(PriceCache).where(
+            PriceCache.product_id == bindparam('b_product_id')
+        ).values(
+            access_count=PriceCache.access_count + bindparam('b_hits'),
+            last_accessed=bindparam('b_last_accessed')
+        )
+        params = [{'b_product_id': product_id, 'b_hits': hits, 'b_last_accessed': last_accessed}
+                  for product_id, (hits, last_accessed) in pending.items()]
+        try:
+            with self.get_session() as session:
+                # Core executemany: one statement, one round trip per batch
+                session.connection().execute(stmt, params)
+                session.commit()
+            self.access_flush_stats['flushes'] += 1
+            self.access_flush_stats['rows'] += len(params)
+            return len(params)
+        except Exception as e:
+            # Access counts are statistics only; drop them rather than retry forever
+            self.access_flush_stats['failures'] += 1
+            logger.error(f"Failed to flush price cache access stats: {e}")
+            return 0
+    
+    def price_cache_stats(self) -> Dict[str, Any]:
+        with self._access_lock:
+            buffered = len(self._access_buffer)
+        return {'l1': self.price_l1.stats(),
+                'shared': self.price_shared.stats() if self.price_shared is not None else None,
+                'buffered_accesses': buffered, **self.access_flush_stats}
+    
     def cache_price_data(self, product_id: str, data: Dict[str, Any], cache_hours: int = 1):
         """Cache price data for specified hours"""
         try:
-            from datetime import timedelta
-            
             with self.get_session() as session:
-                expiry = datetime.utcnow() + timedelta(hours=cache_hours)
+                now = datetime.utcnow()
+                record = {
+                    'data': data,
+                    'cache_timestamp': now,
+                    'expiry_timestamp': now + timedelta(hours=cache_hours)
+                }
+                self.price_store.write(session, product_id, record)
+                
+                # A product that was found is no longer unknown
+                session.query(NegativeCache).filter(NegativeCache.product_id == product_id).delete()
+                
+                session.commit()
+                self._remember_price(product_id, record, shared=True)
+                logger.info(f"Price data cached for product {product_id} (expires in {cache_hours}h)")
+        except Exception as e:
+            logger.error(f"Failed to cache price data: {e}")
+    
+    def get_price_cache_expiries(self, product_ids: List[str]) -> Dict[str, datetime]:
+        """Soft expiry of the cached price of each product that has one"""
+        if not product_ids:
+            return {}
+        try:
+            with self.get_session() as session:
+                rows = session.query(PriceCache.product_id, PriceCache.expiry_timestamp).filter(
+                    PriceCache.product_id.in_(product_ids)
+                ).all()
+                return {product_id: expiry for product_id, expiry in rows}
+        except Exception as e:
+            logger.error(f"Failed to get price cache expiries: {e}")
+            return {}
+    
+    def _count_negative(self, counter: str, amount: int = 1):
+        with self._stats_lock:
+            self.negative_cache_stats[counter] += amount
+    
+    def is_negative_cached(self, product_id: str) -> bool:
+        """Check whether a product is remembered as not found"""
+        try:
+            with self.get_session() as session:
+                entry = session.query(NegativeCache).filter(
+                    NegativeCache.product_id == product_id,
+                    NegativeCache.expiry_timestamp > datetime.utcnow()
+                ).first()
                 
-                # Update existing cache or create new
-                cache = session.query(PriceCache).filter(PriceCache.product_id == product_id).first()
+                if entry:
+                    self._count_negative('hits')
+                    logger.info(f"Negative cache hit for product {product_id}")
+                    return True
                 
-                if cache:
-                    cache.cached_data = data
-                    cache.cache_timestamp = datetime.utcnow()
-                    cache.expiry_timestamp = expiry
-                    cache.access_count += 1
-                    cache.last_accessed = datetime.utcnow()
+                self._count_negative('misses')
+                return False
+        except Exception as e:
+            logger.error(f"Failed to check negative cache: {e}")
+            return False
+    
+    def get_negative_cached_ids(self, product_ids: List[str]) -> Set[str]:
+        """The products among ``product_ids`` remembered as not found, in one query"""
+        if not product_ids:
+            return set()
+        try:
+            with self.get_session() as session:
+                rows = session.query(NegativeCache.product_id).filter(
+                    NegativeCache.product_id.in_(product_ids),
+                    NegativeCache.expiry_timestamp > datetime.utcnow()
+                ).all()
+                return {product_id for product_id, in rows}
+        except Exception as e:
+            logger.error(f"Failed to check negative cache: {e}")
+            return set()
+    
+    def cache_negative_result(self, product_id: str, reason: str = 'not_found',
+                              cache_minutes: Optional[int] = None):
+        """Remember that a product could not be found, for a short TTL"""
+        try:
+            minutes = cache_minutes if cache_minutes is not None else self.negative_cache_minutes
+            with self.get_session() as session:
+                expiry = datetime.utcnow() + timedelta(minutes=minutes)
+                entry = session.query(NegativeCache).filter(NegativeCache.product_id == product_id).first()
+                
+                if entry:
+                    entry.reason = reason
+                    entry.cache_timestamp = datetime.utcnow()
+                    entry.expiry_timestamp = expiry
                 else:
-                    cache = PriceCache(
+                    session.add(NegativeCache(
                         product_id=product_id,
-                        serial_number=data.get('serial_number'),
-                        cached_data=data,
+                        reason=reason,
                         expiry_timestamp=expiry
-                    )
-                    session.add(cache)
+                    ))
+                
+                # The cached price is expired rather than deleted: it is no longer
+                # served or refreshed, but stays the fallback while Uniqlo is down
+                now = datetime.utcnow()
+                session.query(PriceCache).filter(
+                    PriceCache.product_id == product_id,
+                    PriceCache.expiry_timestamp > now
+                ).update({PriceCache.expiry_timestamp: now}, synchronize_session=False)
                 
                 session.commit()
-                logger.info(f"Price data cached for product {product_id} (expires in {cache_hours}h)")
+                self.price_l1.delete(product_id)
+                if self.price_shared is not None:
+                    self.price_shared.delete(product_id)
+                self._count_negative('stores')
+                logger.info(f"Negative result cached for product {product_id} (expires in {minutes}m)")
         except Exception as e:
-            logger.error(f"Failed to cache price data: {e}")
+            logger.error(f"Failed to cache negative result: {e}")
+    
+    def invalidate_negative_cache(self, product_id: Optional[str] = None) -> int:
+        """Drop the negative entry for one product, or all entries when product_id is None"""
+        try:
+            with self.get_session() as session:
+                query = session.query(NegativeCache)
+                if product_id is not None:
+                    query = query.filter(NegativeCache.product_id == product_id)
+                removed = query.delete()
+                session.commit()
+                self._count_negative('invalidations', removed)
+                return removed
+        except Exception as e:
+            logger.error(f"Failed to invalidate negative cache: {e}")
+            return 0
+    
+    def get_product_alias(self, alias_code: str) -> Optional[str]:
+        """Get the canonical serial number stored for an alias code"""
+        try:
+            with self.get_session() as session:
+                alias = session.query(ProductAlias).filter(ProductAlias.alias_code == alias_code).first()
+                return alias.serial_number if alias else None
+        except Exception as e:
+            logger.error(f"Failed to get product alias: {e}")
+            return None
+    
+    def get_all_product_aliases(self) -> Dict[str, str]:
+        """Get every alias code -> serial number mapping"""
+        try:
+            with self.get_session() as session:
+                return dict(session.query(ProductAlias.alias_code, ProductAlias.serial_number).all())
+        except Exception as e:
+            logger.error(f"Failed to load product aliases: {e}")
+            return {}
+    
+    def save_product_aliases(self, aliases: Dict[str, str], source: str):
+        """Create or update alias code -> serial number mappings"""
+        if not aliases:
+            return
+        try:
+            with self.get_session() as session:
+                existing = {
+                    alias.alias_code: alias for alias in
+                    session.query(ProductAlias).filter(ProductAlias.alias_code.in_(list(aliases)))
+                }
+                for alias_code, serial_number in aliases.items():
+                    alias = existing.get(alias_code)
+                    if alias:
+                        alias.serial_number = serial_number
+                        alias.source = source
+                    else:
+                        session.add(ProductAlias(
+                            alias_code=alias_code,
+                            serial_number=serial_number,
+                            source=source
+                        ))
+                session.commit()
+                logger.info(f"Saved {len(aliases)} product aliases ({source})")
+        except Exception as e:
+            logger.error(f"Failed to save product aliases: {e}")
+    
+    def acquire_lease(self, lease_key: str, holder: str, lease_seconds: int) -> bool:
+        """Try to take a lease; succeeds if it is free, expired or already ours"""
+        now = datetime.utcnow()
+        expiry = now + timedelta(seconds=lease_seconds)
+        try:
+            with self.get_session() as session:
+                # Take over an expired (or our own) lease atomically
+                taken = session.query(CrawlLease).filter(
+                    CrawlLease.lease_key == lease_key,
+                    or_(CrawlLease.expiry_timestamp <= now, CrawlLease.holder == holder)
+                ).update({'holder': holder, 'expiry_timestamp': expiry}, synchronize_session=False)
+                if taken:
+                    session.commit()
+                    return True
+                
+                session.add(CrawlLease(lease_key=lease_key, holder=holder, expiry_timestamp=expiry))
+                session.commit()
+                return True
+        except IntegrityError:
+            # Someone else holds an unexpired lease
+            return False
+        except Exception as e:
+            logger.error(f"Failed to acquire lease {lease_key}: {e}")
+            return False
+    
+    def release_lease(self, lease_key: str, holder: str):
+        """Release a lease if we still hold it"""
+        try:
+            with self.get_session() as session:
+                session.query(CrawlLease).filter(
+                    CrawlLease.lease_key == lease_key,
+                    CrawlLease.holder == holder
+                ).delete(synchronize_session=False)
+                session.commit()
+        except Exception as e:
+            logger.error(f"Failed to release lease {lease_key}: {e}")
+    
+    def claim_webhook_event(self, event_id: str, window_seconds: int) -> bool:
+        """Record a webhook event as handled; False if it was already seen within the window"""
+        now = datetime.utcnow()
+        expiry = now + timedelta(seconds=window_seconds)
+        try:
+            with self.get_session() as session:
+                # An id whose window has passed counts as new again
+                taken = session.query(WebhookEvent).filter(
+                    WebhookEvent.event_id == event_id,
+                    WebhookEvent.expiry_timestamp <= now
+                ).update({'expiry_timestamp': expiry}, synchronize_session=False)
+                if not taken:
+                    session.add(WebhookEvent(event_id=event_id, expiry_timestamp=expiry))
+                session.commit()
+                return True
+        except IntegrityError:
+            return False
+        except Exception as e:
+            # Better to answer twice than not at all
+            logger.error(f"Failed to claim webhook event {event_id}: {e}")
+            return True
+    
+    def purge_webhook_events(self) -> int:
+        """Delete webhook event ids whose de-duplication window has passed"""
+        try:
+            with self.get_session() as session:
+                purged = session.query(WebhookEvent).filter(
+                    WebhookEvent.expiry_timestamp <= datetime.utcnow()
+                ).delete(synchronize_session=False)
+                session.commit()
+                return purged
+        except Exception as e:
+            logger.error(f"Failed to purge webhook events: {e}")
+            return 0
+    
+    def record_price_changes(self, product_id: str, variants: List[Dict[str, Any]],
+                             observed_at: datetime) -> List[Dict[str, Any]]:
+        """Make ``variants`` [{'l2_id', 'price', 'stock'}] the latest state of a
+        product's variants and insert a change point for each one whose price
+        or stock differs from the stored state; returns the change points.
+
+        The comparison happens in the database (one conditional upsert), so
+        changes written by other workers are seen and a change recorded by
+        two workers at once is stored once.
+        """
+        rows = [{'product_id': product_id, 'observed_at': observed_at, **variant} for variant in variants]
+        if not rows:
+            return []
+        with self.get_session() as session:
+            dialect = session.get_bind().dialect.name
+            if dialect in ('sqlite', 'postgresql'):
+                dialect_insert = sqlite_insert if dialect == 'sqlite' else postgresql_insert
+                stmt = dialect_insert(VariantPriceState).values(rows)
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=['product_id', 'l2_id'],
+                    set_={'price': stmt.excluded.price, 'stock': stmt.excluded.stock,
+                          'observed_at': stmt.excluded.observed_at},
+                    where=or_(VariantPriceState.price.is_distinct_from(stmt.excluded.price),
+                              VariantPriceState.stock.is_distinct_from(stmt.excluded.stock))
+                ).returning(VariantPriceState.l2_id)
+                changed = set(session.execute(stmt).scalars())
+            else:
+                stored = {state.l2_id: state for state in session.query(VariantPriceState).filter(
+                    VariantPriceState.product_id == product_id).with_for_update()}
+                changed = set()
+                for row in rows:
+                    state = stored.get(row['l2_id'])
+                    if state is None:
+                        session.add(VariantPriceState(**row))
+                    elif (state.price, state.stock) != (row['price'], row['stock']):
+                        state.price, state.stock, state.observed_at = row['price'], row['stock'], observed_at
+                    else:
+                        continue
+                    changed.add(row['l2_id'])
+            
+            observations = [row for row in rows if row['l2_id'] in changed]
+            if observations:
+                session.execute(insert(PriceObservation), [
+                    {**observation, 'resolution': 0, 'changes': 1} for observation in observations
+                ])
+            session.commit()
+        return observations
+    
+    def get_price_observations(self, product_id: str, start: datetime, end: datetime,
+                               l2_id: Optional[str] = None) -> List[Any]:
+        """Observations of a product in [start, end), oldest first (one index range scan)"""
+        with self.get_session() as session:
+            query = session.query(
+                PriceObservation.l2_id, PriceObservation.observed_at, PriceObservation.resolution,
+                PriceObservation.price, PriceObservation.min_price, PriceObservation.max_price,
+                PriceObservation.stock, PriceObservation.changes
+            ).filter(
+                PriceObservation.product_id == product_id,
+                PriceObservation.observed_at >= start,
+                PriceObservation.observed_at < end
+            )
+            if l2_id is not None:
+                query = query.filter(PriceObservation.l2_id == l2_id)
+            return query.order_by(PriceObservation.observed_at, PriceObservation.id).all()
+    
+    def downsample_price_observations(self, resolution: int, before: datetime,
+                                      products_per_batch: int = 100) -> Dict[str, int]:
+        """Fold observations finer than ``resolution`` seconds and older than
+        ``before`` into one row per variant and bucket of that size.
+
+        A bucket keeps the closing price and stock, the price range and the
+        number of change points; it merges into a bucket row left by an
+        earlier run. Products are processed ``products_per_batch`` at a time.
+        """
+        epoch = datetime(1970, 1, 1)
+        
+        def bucket_start(observed_at):
+            seconds = int((observed_at - epoch).total_seconds())
+            return epoch + timedelta(seconds=seconds - seconds % resolution)
+        
+        result = {'rows': 0, 'buckets': 0}
+        while True:
+            with self.get_session() as session:
+                product_ids = [product_id for (product_id,) in session.query(PriceObservation.product_id).filter(
+                    PriceObservation.resolution < resolution,
+                    PriceObservation.observed_at < before
+                ).distinct().limit(products_per_batch)]
+                if not product_ids:
+                    break
+                
+                rows = session.query(PriceObservation).filter(
+                    PriceObservation.product_id.in_(product_ids),
+                    PriceObservation.resolution < resolution,
+                    PriceObservation.observed_at < before
+                ).order_by(PriceObservation.observed_at, PriceObservation.id).all()
+                buckets = {}
+                for row in rows:
+                    key = (row.product_id, row.l2_id, bucket_start(row.observed_at))
+                    prices = [price for price in (row.min_price, row.max_price, row.price) if price is not None]
+                    bucket = buckets.setdefault(key, {'prices': [], 'changes': 0})
+                    # Rows are read oldest first, so the last one closes the bucket
+                    bucket.update(price=row.price, stock=row.stock)
+                    bucket['prices'] += prices
+                    bucket['changes'] += row.changes
+                
+                existing = {
+                    (row.product_id, row.l2_id, row.observed_at): row
+                    for row in session.query(PriceObservation).filter(
+                        PriceObservation.product_id.in_(product_ids),
+                        PriceObservation.resolution == resolution,
+                        PriceObservation.observed_at.in_({key[2] for key in buckets})
+                    )
+                }
+                for row in rows:
+                    session.delete(row)
+                for (product_id, l2_id, started_at), bucket in buckets.items():
+                    target = existing.get((product_id, l2_id, started_at))
+                    if target is None:
+                        target = PriceObservation(product_id=product_id, l2_id=l2_id, observed_at=started_at,
+                                                  resolution=resolution, changes=0)
+                        session.add(target)
+                    prices = bucket['prices'] + [price for price in (target.min_price, target.max_price)
+                                                 if price is not None]
+                    target.price, target.stock = bucket['price'], bucket['stock']
+                    target.min_price = min(prices) if prices else None
+                    target.max_price = max(prices) if prices else None
+                    target.changes += bucket['changes']
+                session.commit()
+                result['rows'] += len(rows)
+                result['buckets'] += len(buckets)
+        if result['rows']:
+            logger.info(f"Downsampled {result['rows']} price observations into {result['buckets']} "
+                        f"{resolution}s buckets")
+        return result
+    
+    def get_config(self, config_key: str, default: Any = None) -> Any:
+        """Get a system config value, converted according to its config_type"""
+        try:
+            with self.get_session() as session:
+                config = session.query(SystemConfig).filter(SystemConfig.config_key == config_key).first()
+                if config is None or config.config_value is None:
+                    return default
+
+                value = config.config_value
+                if config.config_type == 'int':
+                    return int(value)
+                if config.config_type == 'float':
+                    return float(value)
+                if config.config_type == 'bool':
+                    return value.lower() in ('1', 'true', 'yes')
+                if config.config_type == 'json':
+                    return json.loads(value)
+                return value
+        except Exception as e:
+            logger.error(f"Failed to get config {config_key}: {e}")
+            return default
+
+    def set_config(self, config_key: str, config_value: Any, config_type: str = 'string',
+                   description: Optional[str] = None):
+        """Create or update a system config value"""
+        try:
+            if config_type == 'json':
+                stored_value = json.dumps(config_value)
+            elif config_type == 'bool':
+                stored_value = 'true' if config_value else 'false'
+            else:
+                stored_value = str(config_value)
+
+            with self.get_session() as session:
+                config = session.query(SystemConfig).filter(SystemConfig.config_key == config_key).first()
+                if config:
+                    config.config_value = stored_value
+                    config.config_type = config_type
+                    if description is not None:
+                        config.description = description
+                else:
+                    session.add(SystemConfig(
+                        config_key=config_key,
+                        config_value=stored_value,
+                        config_type=config_type,
+                        description=description
+                    ))
+                session.commit()
+        except Exception as e:
+            logger.error(f"Failed to set config {config_key}: {e}")
+
+    def get_successful_searches(self, after_id: int = 0, since: Optional[datetime] = None,
+                                limit: int = 10000) -> List[tuple]:
+        """(id, product_id, search_timestamp) of successful searches newer than ``after_id``"""
+        try:
+            with self.get_session() as session:
+                query = session.query(
+                    SearchHistory.id, SearchHistory.product_id, SearchHistory.search_timestamp
+                ).filter(SearchHistory.id > after_id, SearchHistory.is_successful == True)
+                if since is not None:
+                    query = query.filter(SearchHistory.search_timestamp > since)
+                return [tuple(row) for row in query.order_by(SearchHistory.id).limit(limit).all()]
+        except Exception as e:
+            logger.error(f"Failed to get successful searches: {e}")
+            return []
+    
+    @staticmethod
+    def _rollup_deltas(rows, sign: int = 1):
+        """Per-hour and per-product counter deltas for history rows
+        (dicts or (product_id, search_timestamp, is_successful) tuples)"""
+        hourly, products = {}, {}
+        for row in rows:
+            if isinstance(row, dict):
+                product_id, searched_at, successful = row['product_id'], row['search_timestamp'], row['is_successful']
+            else:
+                product_id, searched_at, successful = row
+            hour = searched_at.replace(minute=0, second=0, microsecond=0)
+            counts = hourly.setdefault(hour, [0, 0])
+            counts[0] += sign
+            counts[1] += sign if successful else 0
+            product = products.setdefault(product_id, [0, 0, None])
+            product[0] += sign
+            product[1] += sign if successful else 0
+            product[2] = max(product[2] or searched_at, searched_at)
+        hourly_rows = [{'hour_bucket': hour, 'search_count': total, 'successful_count': successful}
+                       for hour, (total, successful) in hourly.items()]
+        product_rows = [{'product_id': product_id, 'search_count': total, 'successful_count': successful,
+                         'last_searched': last_searched}
+                        for product_id, (total, successful, last_searched) in products.items()]
+        return hourly_rows, product_rows
+    
+    def _upsert_counters(self, session, model, key: str, rows: List[Dict[str, Any]]):
+        """Add each row's counts to the counter row with the same key, creating it if needed"""
+        if not rows:
+            return
+        dialect = session.get_bind().dialect.name
+        if dialect in ('sqlite', 'postgresql'):
+            dialect_insert = sqlite_insert if dialect == 'sqlite' else postgresql_insert
+            stmt = dialect_insert(model)
+            changes = {
+                'search_count': model.search_count + stmt.excluded.search_count,
+                'successful_count': model.successful_count + stmt.excluded.successful_count
+            }
+            if 'last_searched' in rows[0]:
+                changes['last_searched'] = func.coalesce(
+                    func.max(model.last_searched, stmt.excluded.last_searched) if dialect == 'sqlite'
+                    else func.greatest(model.last_searched, stmt.excluded.last_searched),
+                    stmt.excluded.last_searched
+                )
+            session.execute(stmt.on_conflict_do_update(index_elements=[key], set_=changes), rows)
+            return
+        
+        # Other databases: update, then insert the keys that had no row yet
+        column = getattr(model, key)
+        for row in rows:
+            updated = session.query(model).filter(column == row[key]).update({
+                'search_count': model.search_count + row['search_count'],
+                'successful_count': model.successful_count + row['successful_count']
+            }, synchronize_session=False)
+            if not updated:
+                session.add(model(**row))
+    
+    def _apply_search_rollups(self, session, rows, sign: int = 1):
+        """Fold written (or, with ``sign=-1``, deleted) history rows into the rollup tables"""
+        hourly_rows, product_rows = self._rollup_deltas(rows, sign)
+        self._upsert_counters(session, SearchStatsHourly, 'hour_bucket', hourly_rows)
+        self._upsert_counters(session, ProductSearchStats, 'product_id', product_rows)
+    
+    def delete_user_history(self, user_id: str) -> int:
+        """Delete a user's search history and take it out of the rollups; returns rows deleted"""
+        self.flush_history()
+        with self.get_session() as session:
+            query = session.query(SearchHistory).filter(SearchHistory.user_id == user_id)
+            rows = query.with_entities(SearchHistory.product_id, SearchHistory.search_timestamp,
+                                       SearchHistory.is_successful).all()
+            if not rows:
+                return 0
+            self._apply_search_rollups(session, rows, sign=-1)
+            query.delete(synchronize_session=False)
+            session.commit()
+            return len(rows)
+    
+    def summarize_history_rows(self, row_ids: List[int]) -> Dict[int, Dict[str, Any]]:
+        """Summaries of history rows written before the summary columns existed,
+        computed from their product data (inline or snapshot) and stored, so each
+        row is summarized once; returns {row id: summary}"""
+        if not row_ids:
+            return {}
+        with self.get_session() as session:
+            rows = session.query(SearchHistory.id, SearchHistory.product_data, ProductSnapshot.product_data).outerjoin(
+                ProductSnapshot, ProductSnapshot.content_hash == SearchHistory.snapshot_hash
+            ).filter(SearchHistory.id.in_(row_ids)).all()
+            summaries = {row_id: self.summarize_product(product_data or snapshot_data or {})
+                         for row_id, product_data, snapshot_data in rows}
+            if not summaries:
+                return summaries
+            stmt = update(SearchHistory).where(SearchHistory.id == bindparam('b_id')).values(
+                page_title=bindparam('b_page_title'),
+                colors=bindparam('b_colors'),
+                in_stock_sizes=bindparam('b_in_stock_sizes'),
+                variant_count=bindparam('b_variant_count')
+            )
+            params = [{'b_id': row_id, **{f"b_{key}": value for key, value in summary.items()}}
+                      for row_id, summary in summaries.items()]
+            try:
+                session.connection().execute(stmt, params)
+                session.commit()
+            except Exception as e:
+                # The summaries are still good to answer with; the next read retries the write
+                session.rollback()
+                logger.error(f"Failed to store history summaries: {e}")
+            return summaries
+    
+    def backfill_history_summaries(self, batch_size: int = 1000) -> int:
+        """Compute the summary columns of history rows written before they existed;
+        returns the number of rows updated"""
+        self.flush_history()
+        updated = 0
+        last_id = 0
+        while True:
+            with self.get_session() as session:
+                row_ids = [row_id for row_id, in session.query(SearchHistory.id).filter(
+                    SearchHistory.id > last_id,
+                    SearchHistory.variant_count.is_(None)
+                ).order_by(SearchHistory.id).limit(batch_size).all()]
+            if not row_ids:
+                break
+            self.summarize_history_rows(row_ids)
+            last_id = row_ids[-1]
+            updated += len(row_ids)
+            logger.info(f"Summarized {updated} history rows")
+        return updated
+    
+    def rebuild_search_rollups(self, batch_size: int = 5000) -> Dict[str, int]:
+        """Recompute the rollup tables from all of search_history (backfill).
+
+        Streams the history once, in batches of ``batch_size`` rows, and
+        replaces the rollups in one transaction. The rollup tables are locked
+        for writing before the history is read, so searches written (or
+        deleted) meanwhile wait and apply their increments to the rebuilt
+        tables instead of being lost.
+        """
+        self.flush_history()
+        with self.get_session() as session:
+            if session.get_bind().dialect.name == 'postgresql':
+                session.execute(text('LOCK TABLE search_stats_hourly, product_search_stats IN EXCLUSIVE MODE'))
+            # On SQLite the first DELETE takes the database write lock
+            session.query(SearchStatsHourly).delete()
+            session.query(ProductSearchStats).delete()
+            
+            result = session.query(SearchHistory.product_id, SearchHistory.search_timestamp,
+                                   SearchHistory.is_successful).yield_per(batch_size)
+            hourly_rows, product_rows = self._rollup_deltas(result)
+            if hourly_rows:
+                session.execute(insert(SearchStatsHourly), hourly_rows)
+            if product_rows:
+                session.execute(insert(ProductSearchStats), product_rows)
+            session.commit()
+        history_rows = sum(row['search_count'] for row in hourly_rows)
+        self.set_config(self.ROLLUPS_CONFIG_KEY, True, config_type='bool',
+                        description='search_stats_hourly / product_search_stats built from search_history')
+        self._rollups_ready = True
+        logger.info(f"Rebuilt search rollups from {history_rows} history rows")
+        return {'history_rows': history_rows, 'hours': len(hourly_rows), 'products': len(product_rows)}
+    
+    def _search_rollups_ready(self) -> bool:
+        """Rollups are complete once backfilled, or from the start on an empty history"""
+        if not self._rollups_ready:
+            if self.get_config(self.ROLLUPS_CONFIG_KEY, False):
+                self._rollups_ready = True
+            else:
+                with self.get_session() as session:
+                    if session.query(SearchHistory.id).first() is None:
+                        self.set_config(self.ROLLUPS_CONFIG_KEY, True, config_type='bool',
+                                        description='search rollups maintained since the history was empty')
+                        self._rollups_ready = True
+        return self._rollups_ready
+    
+    @staticmethod
+    def _recent_cutoff() -> datetime:
+        """Start of the hour-granular "last 24h" window: the current hour and the 23 before it"""
+        return datetime.utcnow().replace(minute=0, second=0, microsecond=0) - timedelta(hours=23)
     
     def get_search_stats(self) -> Dict[str, Any]:
-        """Get search statistics"""
+        """Get search statistics from the rollup tables, in a single query.
+
+        ``recent_searches_24h`` is hour-granular: it sums the hourly buckets
+        of the current hour and the 23 before it.
+        """
+        try:
+            if not self._search_rollups_ready():
+                logger.warning("Search rollups not built yet; run `python db_maintenance.py backfill-rollups`")
+                return self._get_search_stats_from_history()
+            
+            recent_cutoff = self._recent_cutoff()
+            popular = select(ProductSearchStats.product_id, ProductSearchStats.successful_count).where(
+                ProductSearchStats.successful_count > 0
+            ).order_by(ProductSearchStats.successful_count.desc()).limit(10).subquery()
+            stmt = union_all(
+                select(literal('total').label('kind'), literal_column('NULL').label('product_id'),
+                       func.coalesce(func.sum(SearchStatsHourly.search_count), 0).label('value'),
+                       func.coalesce(func.sum(SearchStatsHourly.successful_count), 0).label('successful')),
+                select(literal('recent'), literal_column('NULL'),
+                       func.coalesce(func.sum(SearchStatsHourly.search_count), 0), literal(0)).where(
+                    SearchStatsHourly.hour_bucket >= recent_cutoff
+                ),
+                select(literal('popular'), popular.c.product_id, popular.c.successful_count, literal(0))
+            )
+            with self.get_session() as session:
+                rows = session.execute(stmt).all()
+            
+            stats = {'popular_products': []}
+            for kind, product_id, value, successful in rows:
+                if kind == 'total':
+                    stats['total_searches'] = int(value)
+                    stats['successful_searches'] = int(successful)
+                elif kind == 'recent':
+                    stats['recent_searches_24h'] = int(value)
+                else:
+                    stats['popular_products'].append({'product_id': product_id, 'search_count': int(value)})
+            stats['success_rate'] = round(stats['successful_searches'] / max(stats['total_searches'], 1) * 100, 2)
+            return stats
+        except Exception as e:
+            logger.error(f"Failed to get search stats: {e}")
+            return {}
+    
+    def _get_search_stats_from_history(self) -> Dict[str, Any]:
+        """Search statistics computed from search_history itself (before the rollups exist)"""
         try:
             with self.get_session() as session:
                 total_searches = session.query(SearchHistory).count()
                 successful_searches = session.query(SearchHistory).filter(SearchHistory.is_successful == True).count()
                 
-                # Recent searches (last 24 hours)
-                from datetime import timedelta
-                recent_cutoff = datetime.utcnow() - timedelta(hours=24)
+                # Recent searches (same hour-granular window as the rollups)
                 recent_searches = session.query(SearchHistory).filter(
-                    SearchHistory.search_timestamp > recent_cutoff
+                    SearchHistory.search_timestamp >= self._recent_cutoff()
                 ).count()
                 
                 # Popular products (top 10 most searched)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Database maintenance commands
+
+    python db_maintenance.py migrate            # add columns and indexes missing from an existing database
+    python db_maintenance.py backfill-summaries # fill the history summary columns of older rows
+    python db_maintenance.py backfill-rollups   # build the stats rollups from search_history
+    python db_maintenance.py compact-snapshots  # move old history product_data into snapshots, drop unreferenced ones
+    python db_maintenance.py downsample-prices  # fold aged price observations into hourly/daily buckets
+    python db_maintenance.py stats              # print /api/stats as served from the rollups
+"""
+import sys
+import json
+import argparse
+
+from sqlalchemy import text
+
+from database import db_manager, migrate_schema, migrate_indexes
+from price_history import price_history
+
+
+def migrate(args):
+    # DatabaseManager already added missing columns on start; indexes are built here
+    created = migrate_schema(db_manager.engine) + migrate_indexes(db_manager.engine)
+    print(f"✅ Created {len(created)} columns/indexes: {', '.join(created)}" if created else "✅ Schema is up to date")
+    return 0
+
+
+def backfill_summaries(args):
+    print("🔄 Summarizing history rows written before the summary columns existed...")
+    updated = db_manager.backfill_history_summaries(batch_size=args.batch_size)
+    print(f"✅ {updated} history rows summarized")
+    return 0
+
+
+def backfill_rollups(args):
+    print("🔄 Rebuilding search rollups from search_history...")
+    result = db_manager.rebuild_search_rollups(batch_size=args.batch_size)
+    print(f"✅ {result['history_rows']} searches -> {result['hours']} hourly rows, "
+          f"{result['products']} product rows")
+    return 0
+
+
+def compact_snapshots(args):
+    print("🔄 Moving history product_data into the snapshot store...")
+    result = db_manager.compact_history_snapshots(batch_size=args.batch_size)
+    print(f"✅ {result['rows']} history rows now reference {result['snapshots']} distinct snapshots")
+    collected = db_manager.collect_orphan_snapshots()
+    print(f"✅ {collected['deleted']} unreferenced snapshots deleted, {collected['marked']} marked for the next run")
+    if args.vacuum:
+        statement = 'VACUUM ANALYZE search_history' if db_manager.engine.dialect.name == 'postgresql' else 'VACUUM'
+        with db_manager.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            connection.execute(text(statement))
+        print("✅ Freed space returned to the database")
+    return 0
+
+
+def downsample_prices(args):
+    print("🔄 Downsampling price observations...")
+    price_history.bind_database(db_manager)
+    result = price_history.downsample()
+    if result.get('skipped'):
+        print("⚠️  Another worker is downsampling right now; try again later")
+        return 1
+    for resolution in ('hourly', 'daily'):
+        print(f"✅ {result[resolution]['rows']} rows -> {result[resolution]['buckets']} {resolution} buckets")
+    return 0
+
+
+def show_stats(args):
+    print(json.dumps(db_manager.get_search_stats(), ensure_ascii=False, indent=2))
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('migrate', help='Add columns and indexes missing from existing tables').set_defaults(run=migrate)
+
+    summaries = commands.add_parser('backfill-summaries', help='Fill the history summary columns')
+    summaries.add_argument('--batch-size', type=int, default=1000, help='History rows updated per batch')
+    summaries.set_defaults(run=backfill_summaries)
+
+    backfill = commands.add_parser('backfill-rollups', help='Rebuild the search stats rollup tables')
+    backfill.add_argument('--batch-size', type=int, default=5000, help='History rows read per batch')
+    backfill.set_defaults(run=backfill_rollups)
+
+    compact = commands.add_parser('compact-snapshots',
+                                  help='De-duplicate history product_data into snapshots, drop unreferenced ones')
+    compact.add_argument('--batch-size', type=int, default=1000, help='History rows rewritten per batch')
+    compact.add_argument('--vacuum', action='store_true', help='Reclaim the freed space afterwards')
+    compact.set_defaults(run=compact_snapshots)
+
+    commands.add_parser('downsample-prices', help='Fold aged price observations into hourly/daily buckets'
+                        ).set_defaults(run=downsample_prices)
+
+    stats = commands.add_parser('stats', help='Print search statistics')
+    stats.set_defaults(run=show_stats)
+
+    args = parser.parse_args(argv)
+    return args.run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
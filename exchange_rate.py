@@ -0,0 +1,161 @@
+"""
+JPY to TWD exchange rate service for UNIQLO Price Finder
+"""
+import os
+import re
+import time
+import logging
+import threading
+from datetime import datetime
+from typing import Optional, Dict, Any
+
+from http_client import upstream_client
+
+logger = logging.getLogger(__name__)
+
+EXCHANGE_RATE_URL = os.getenv('EXCHANGE_RATE_URL', 'https://www.google.com/finance/quote/JPY-TWD')
+EXCHANGE_RATE_CONFIG_KEY = 'exchange_rate_jpy_twd'
+
+# The quote is the text of the first <div class="YMlKec fxKbKc">, so a regex
+# over the raw page is enough; no need to build a full parse tree
+_RATE_PATTERN = re.compile(r'class="YMlKec fxKbKc"[^>]*>\s*([0-9][0-9,]*\.?[0-9]*)\s*<')
+
+
+def fetch_exchange_rate():
+    """Fetch the current JPY to TWD exchange rate."""
+    try:
+        currency_page = upstream_client.get(EXCHANGE_RATE_URL)
+        match = _RATE_PATTERN.search(currency_page.text)
+        return float(match.group(1).replace(',', ''))
+    except Exception:
+        return None
+
+
+class ExchangeRateService:
+    """Keeps the last good JPY to TWD rate in memory and refreshes it in the background.
+
+    ``get_rate`` never blocks on the network: it returns the last known rate
+    (or None before the first successful fetch) and, when the rate is older
+    than the TTL, schedules a refresh. The rate is persisted through
+    SystemConfig so a cold start has a value right away.
+    """
+
+    def __init__(self, ttl: Optional[int] = None, retry_interval: Optional[int] = None):
+        self.ttl = ttl or int(os.getenv('EXCHANGE_RATE_TTL', '3600'))
+        self.retry_interval = retry_interval or int(os.getenv('EXCHANGE_RATE_RETRY_INTERVAL', '60'))
+        self.db_manager = None
+
+        self._rate = None
+        self._fetched_at = None  # epoch seconds of the last good fetch
+        self._last_attempt = 0.0
+        self._last_error = None
+        self._refresh_count = 0
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._thread = None
+        self._stop = threading.Event()
+
+    def bind_database(self, db_manager):
+        """Persist the rate through SystemConfig and load the last stored value"""
+        self.db_manager = db_manager
+        stored = db_manager.get_config(EXCHANGE_RATE_CONFIG_KEY)
+        if stored and stored.get('rate'):
+            with self._lock:
+                if self._rate is None:
+                    self._rate = float(stored['rate'])
+                    self._fetched_at = datetime.fromisoformat(stored['fetched_at']).timestamp()
+                    logger.info(f"Loaded stored exchange rate {self._rate} (age {self.age_seconds():.0f}s)")
+
+    def get_rate(self) -> Optional[float]:
+        """Return the last known rate, scheduling a refresh if it is stale"""
+        if self.is_stale():
+            self._schedule_refresh()
+        return self._rate
+
+    def age_seconds(self) -> Optional[float]:
+        """Seconds since the current rate was fetched"""
+        if self._fetched_at is None:
+            return None
+        return max(time.time() - self._fetched_at, 0.0)
+
+    def is_stale(self) -> bool:
+        age = self.age_seconds()
+        return age is None or age >= self.ttl
+
+    def refresh(self) -> Optional[float]:
+        """Fetch the rate now; keep the previous value if the fetch fails"""
+        self._last_attempt = time.time()
+        rate = fetch_exchange_rate()
+        if rate is None:
+            self._last_error = 'fetch failed'
+            logger.warning("Exchange rate refresh failed, keeping last known rate")
+            return self._rate
+
+        with self._lock:
+            self._rate = rate
+            self._fetched_at = time.time()
+            self._last_error = None
+            self._refresh_count += 1
+
+        if self.db_manager is not None:
+            self.db_manager.set_config(
+                EXCHANGE_RATE_CONFIG_KEY,
+                {'rate': rate, 'fetched_at': datetime.fromtimestamp(self._fetched_at).isoformat()},
+                config_type='json',
+                description='Last fetched JPY to TWD exchange rate'
+            )
+        return rate
+
+    def _schedule_refresh(self):
+        """Start a one-off refresh unless one is running or just failed"""
+        with self._lock:
+            if self._refreshing or time.time() - self._last_attempt < self.retry_interval:
+                return
+            self._refreshing = True
+            self._last_attempt = time.time()
+        threading.Thread(target=self._refresh_once, name='exchange-rate-refresh', daemon=True).start()
+
+    def _refresh_once(self):
+        try:
+            self.refresh()
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def start(self):
+        """Start the background thread that refreshes the rate before it expires"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='exchange-rate', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            age = self.age_seconds()
+            # Refresh a little ahead of expiry so readers never see a stale rate
+            if age is None or age >= self.ttl * 0.8:
+                self.refresh()
+            if self._last_error:
+                wait = self.retry_interval
+            else:
+                wait = max(self.ttl * 0.8 - (self.age_seconds() or 0), 1)
+            self._stop.wait(wait)
+
+    def stats(self) -> Dict[str, Any]:
+        age = self.age_seconds()
+        return {
+            'rate': self._rate,
+            'age_seconds': round(age, 1) if age is not None else None,
+            'ttl': self.ttl,
+            'is_stale': self.is_stale(),
+            'refresh_count': self._refresh_count,
+            'last_error': self._last_error,
+        }
+
+
+# Global exchange rate service instance
+exchange_rate_service = ExchangeRateService()
@@ -0,0 +1,345 @@
+"""
+Shared HTTP client for upstream calls (Uniqlo, Google Finance)
+"""
+import os
+import json
+import asyncio
+import contextvars
+import threading
+import logging
+from collections import defaultdict
+from typing import Dict, Any, Optional
+
+import aiohttp
+import requests
+from yarl import URL
+
+from resilience import (CircuitBreakerRegistry, CircuitOpenError, LatencyTracker,
+                        UpstreamUnavailableError)
+from requests.adapters import HTTPAdapter
+
+try:
+    import orjson
+except ImportError:  # optional, the stdlib parser is used without it
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# Parses JSON from bytes; orjson decodes large l2s payloads several times faster
+json_loads = orjson.loads if orjson is not None else json.loads
+
+
+class UpstreamClient:
+    """Thread-safe HTTP client with per-host keep-alive connection pools.
+
+    One HTTPAdapter (and therefore one urllib3 PoolManager) is shared by
+    every thread, so TCP/TLS connections to each host are reused across
+    requests. Each thread gets its own lightweight ``requests.Session`` on
+    top of it because sessions carry mutable cookie state.
+    """
+
+    def __init__(self, pool_connections: Optional[int] = None, pool_maxsize: Optional[int] = None,
+                 connect_timeout: Optional[float] = None, read_timeout: Optional[float] = None):
+        # Number of per-host pools kept alive and connections kept per host
+        self.pool_connections = pool_connections or int(os.getenv('UPSTREAM_POOL_CONNECTIONS', '4'))
+        self.pool_maxsize = pool_maxsize or int(os.getenv('UPSTREAM_POOL_MAXSIZE', '10'))
+        self.timeout = (
+            connect_timeout or float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', '3.05')),
+            read_timeout or float(os.getenv('UPSTREAM_READ_TIMEOUT', '10')),
+        )
+
+        self._adapter = HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+        )
+        self._local = threading.local()
+
+    def _session(self) -> requests.Session:
+        """Get the calling thread's session, mounted on the shared adapter"""
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('https://', self._adapter)
+            session.mount('http://', self._adapter)
+            self._local.session = session
+        return session
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """GET a URL through the shared pool, applying the default timeout"""
+        kwargs.setdefault('timeout', self.timeout)
+        return self._session().get(url, **kwargs)
+
+    def stats(self) -> Dict[str, Any]:
+        """Report per-host pool usage.
+
+        A request that reuses a kept-alive connection counts as a hit, one
+        that had to open a new connection counts as a miss.
+        """
+        pools = self._adapter.poolmanager.pools
+        hosts = {}
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            requests_made = pool.num_requests
+            misses = pool.num_connections
+            hosts[f"{key.key_scheme}://{key.key_host}:{key.key_port}"] = {
+                'requests': requests_made,
+                'pool_hits': max(requests_made - misses, 0),
+                'pool_misses': misses,
+                'idle_connections': sum(1 for conn in list(pool.pool.queue) if conn) if pool.pool else 0,
+            }
+
+        return {
+            'pool_connections': self.pool_connections,
+            'pool_maxsize': self.pool_maxsize,
+            'timeout': list(self.timeout),
+            'hosts': hosts,
+        }
+
+    def close(self):
+        """Close all pooled connections"""
+        self._adapter.close()
+
+
+class HostRateLimiter:
+    """Per-host request spacing for coroutines on one event loop.
+
+    Allows ``rate`` requests per second to each host, with up to ``burst``
+    requests let through back to back.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._next_slot = {}
+
+    async def acquire(self, host: str):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        interval = 1.0 / self.rate
+        slot = max(self._next_slot.get(host, now), now - (self.burst - 1) * interval)
+        self._next_slot[host] = slot + interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+# Rate limiter applied to requests made from the current task, if any
+current_rate_limiter = contextvars.ContextVar('current_rate_limiter', default=None)
+
+
+class AsyncUpstreamClient:
+    """aiohttp counterpart of UpstreamClient for the asyncio crawl engine.
+
+    Owns a private event loop running in a daemon thread and one shared
+    ``ClientSession`` on it, so hundreds of lookups can be in flight on a
+    single keep-alive pool. Synchronous code submits coroutines with
+    ``run``; coroutines that use ``session`` must run on this loop.
+    """
+
+    def __init__(self, pool_limit: Optional[int] = None, pool_maxsize: Optional[int] = None,
+                 connect_timeout: Optional[float] = None, read_timeout: Optional[float] = None):
+        # Total connections across hosts and connections kept per host
+        self.pool_limit = pool_limit or int(os.getenv('UPSTREAM_ASYNC_POOL_LIMIT', '100'))
+        self.pool_maxsize = pool_maxsize or int(os.getenv('UPSTREAM_POOL_MAXSIZE', '10'))
+        self.timeout = aiohttp.ClientTimeout(
+            sock_connect=connect_timeout or float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', '3.05')),
+            sock_read=read_timeout or float(os.getenv('UPSTREAM_READ_TIMEOUT', '10')),
+        )
+
+        self._loop = None
+        self._session = None
+        self._lock = threading.Lock()
+        self._host_stats = defaultdict(lambda: {'requests': 0, 'pool_hits': 0, 'pool_misses': 0})
+
+        # Per-host circuit breakers, and the latency window hedged calls are measured against
+        self.breakers = CircuitBreakerRegistry()
+        self.hedge_tracker = LatencyTracker(min_samples=int(os.getenv('HEDGE_MIN_SAMPLES', '20')))
+        self.hedge_percentile = float(os.getenv('HEDGE_PERCENTILE', '95'))
+        self.hedge_min_delay = float(os.getenv('HEDGE_MIN_DELAY', '0.05'))
+        self.hedge_counters = {'hedged': 0, 'hedge_wins': 0}
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """The engine loop, started on first use"""
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name='crawl-engine', daemon=True).start()
+        return self._loop
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """The shared session; only valid inside coroutines running on ``loop``"""
+        if self._session is None or self._session.closed:
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_request_start.append(self._on_request_start)
+            trace_config.on_connection_create_end.append(self._on_connection_create)
+            trace_config.on_connection_reuseconn.append(self._on_connection_reuse)
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_limit, limit_per_host=self.pool_maxsize),
+                timeout=self.timeout,
+                trace_configs=[trace_config],
+            )
+        return self._session
+
+    def run(self, coro, timeout: Optional[float] = None):
+        """Run a coroutine on the engine loop and wait for its result"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def submit(self, coro):
+        """Schedule a coroutine on the engine loop, return a concurrent Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def _throttle(self, url: str):
+        limiter = current_rate_limiter.get()
+        if limiter is not None:
+            await limiter.acquire(URL(url).host)
+
+    async def _request(self, url: str, read, timeout: Optional[float] = None):
+        """GET ``url`` through the host's circuit breaker and hand the response to ``read``.
+
+        Timeouts, connection errors and 5xx responses count as failures and
+        are raised as UpstreamUnavailableError; an open circuit raises
+        CircuitOpenError without making the request. Waiting for the host's
+        rate-limit slot comes first and counts neither towards ``timeout``
+        nor as a failure.
+        """
+        await self._throttle(url)
+        host = f"{URL(url).host}:{URL(url).port}"
+        breaker = self.breakers.get(host)
+        if not breaker.allow():
+            raise CircuitOpenError(f"Circuit open for {host}")
+
+        async def fetch():
+            async with self.session.get(url) as response:
+                if response.status >= 500:
+                    raise UpstreamUnavailableError(f"{host} answered HTTP {response.status}")
+                return await read(response)
+
+        try:
+            result = await asyncio.wait_for(fetch(), timeout)
+        except asyncio.CancelledError:
+            breaker.record_cancelled()
+            raise
+        except UpstreamUnavailableError:
+            breaker.record_failure()
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            breaker.record_failure()
+            raise UpstreamUnavailableError(f"{host} request failed: {e!r}") from e
+        except Exception:
+            # The host answered; the body just wasn't what the caller expected
+            breaker.record_success()
+            raise
+        breaker.record_success()
+        return result
+
+    async def get_text(self, url: str, encoding: Optional[str] = None, timeout: Optional[float] = None):
+        """GET a URL, return (status, text)"""
+        async def read(response):
+            return response.status, await response.text(encoding=encoding)
+        return await self._request(url, read, timeout)
+
+    async def get_prefix(self, url: str, stop_markers, chunk_size: int = 8192,
+                         timeout: Optional[float] = None):
+        """Stream a GET response until one of ``stop_markers`` has arrived.
+
+        Returns (status, bytes read so far). Markers are matched
+        case-insensitively. Only a 200 body is read; when reading stops
+        early the connection is closed rather than drained.
+        """
+        async def read(response):
+            if response.status != 200:
+                return response.status, b''
+
+            longest_marker = max(len(marker) for marker in stop_markers)
+            body = bytearray()
+            async for chunk in response.content.iter_chunked(chunk_size):
+                search_from = max(len(body) - longest_marker, 0)
+                body.extend(chunk)
+                window = bytes(body[search_from:]).lower()
+                if any(marker in window for marker in stop_markers):
+                    response.close()
+                    break
+            return response.status, bytes(body)
+        return await self._request(url, read, timeout)
+
+    async def get_json(self, url: str, timeout: Optional[float] = None):
+        """GET a URL and decode its JSON body regardless of content type"""
+        async def read(response):
+            return json_loads(await response.read())
+        return await self._request(url, read, timeout)
+
+    async def get_json_hedged(self, url: str, timeout: Optional[float] = None,
+                              tracker: Optional[LatencyTracker] = None):
+        """``get_json`` with a hedge: if the call outlives the tracked latency
+        percentile (HEDGE_PERCENTILE), an identical second request is sent
+        and whichever succeeds first wins."""
+        tracker = tracker or self.hedge_tracker
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        hedge_after = tracker.percentile(self.hedge_percentile)
+        if hedge_after is not None:
+            hedge_after = max(hedge_after, self.hedge_min_delay)
+
+        tasks = [asyncio.ensure_future(self.get_json(url, timeout))]
+        try:
+            if hedge_after is not None and (timeout is None or hedge_after < timeout):
+                done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+                if not done:
+                    self.hedge_counters['hedged'] += 1
+                    remaining = None if timeout is None else max(timeout - (loop.time() - started), 0.001)
+                    tasks.append(asyncio.ensure_future(self.get_json(url, remaining)))
+
+            pending, last_error = set(tasks), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not tasks[0]:
+                            self.hedge_counters['hedge_wins'] += 1
+                        tracker.record(loop.time() - started)
+                        return task.result()
+                    last_error = task.exception()
+            raise last_error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def _on_request_start(self, session, ctx, params):
+        ctx.host = f"{params.url.scheme}://{params.url.host}:{params.url.port}"
+        self._host_stats[ctx.host]['requests'] += 1
+
+    async def _on_connection_create(self, session, ctx, params):
+        self._host_stats[getattr(ctx, 'host', 'unknown')]['pool_misses'] += 1
+
+    async def _on_connection_reuse(self, session, ctx, params):
+        self._host_stats[getattr(ctx, 'host', 'unknown')]['pool_hits'] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Report per-host pool usage, same shape as UpstreamClient.stats"""
+        return {
+            'pool_limit': self.pool_limit,
+            'pool_maxsize': self.pool_maxsize,
+            'hosts': {host: dict(counts) for host, counts in list(self._host_stats.items())},
+        }
+
+    def resilience_stats(self) -> Dict[str, Any]:
+        """Report circuit breaker states and hedging counts"""
+        return {
+            'circuit_breakers': self.breakers.stats(),
+            'hedging': {**self.hedge_counters, 'percentile': self.hedge_percentile,
+                        'latency': self.hedge_tracker.stats()},
+        }
+
+    def close(self):
+        """Close the shared session"""
+        if self._session is not None and self._loop is not None:
+            self.run(self._session.close())
+
+
+# Global upstream client instances
+upstream_client = UpstreamClient()
+async_upstream_client = AsyncUpstreamClient()
@@ -0,0 +1,149 @@
+"""
+Background processing of LINE webhook events
+"""
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from memory_cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+class EventDeduplicator:
+    """Remembers recently handled webhookEventIds so LINE redeliveries are dropped.
+
+    LINE redelivers an event when the webhook was slow to answer, with the
+    same webhookEventId. Ids are kept in a bounded in-memory window of
+    LINE_DEDUP_WINDOW_SECONDS; with LINE_DEDUP_STORE=db they are also
+    claimed in the database, so a redelivery that lands on another worker
+    is dropped too.
+    """
+
+    def __init__(self, window_seconds: Optional[int] = None, max_events: Optional[int] = None):
+        self.window_seconds = window_seconds or int(os.getenv('LINE_DEDUP_WINDOW_SECONDS', '600'))
+        self.max_events = max_events or int(os.getenv('LINE_DEDUP_MAX_EVENTS', '10000'))
+        self._seen = LRUCache(max_entries=self.max_events, max_bytes=self.max_events * 64)
+        self._lock = threading.Lock()
+        self.db_manager = None
+        self._purged_at = 0.0
+
+    def bind_database(self, db_manager):
+        """Also claim event ids in the database if LINE_DEDUP_STORE is 'db'"""
+        if os.getenv('LINE_DEDUP_STORE', 'memory').lower() == 'db':
+            self.db_manager = db_manager
+            logger.info("LINE webhook de-duplication shared through the database")
+
+    def claim(self, event_id: Optional[str]) -> bool:
+        """True the first time an event id is seen within the window"""
+        if not event_id:
+            return True
+        with self._lock:
+            if self._seen.get(event_id) is not None:
+                return False
+            self._seen.set(event_id, True, size=len(event_id), ttl=self.window_seconds)
+
+        if self.db_manager is None:
+            return True
+        now = time.monotonic()
+        if now - self._purged_at >= self.window_seconds:
+            self._purged_at = now
+            self.db_manager.purge_webhook_events()
+        return self.db_manager.claim_webhook_event(event_id, self.window_seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        return {'window_seconds': self.window_seconds, 'store': 'db' if self.db_manager else 'memory',
+                'tracked_events': self._seen.stats()['entries']}
+
+
+class WebhookDispatcher:
+    """Runs LINE webhook events on a worker pool so the webhook can return at once.
+
+    LINE waits for the webhook's response before it considers an event
+    delivered, and redelivers on timeouts; a crawl inside the request
+    would hold that response for seconds. Events are acknowledged as soon
+    as their signature is verified and handled here instead.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None, per_request: Optional[int] = None,
+                 deduplicator: Optional[EventDeduplicator] = None):
+        self.max_workers = max_workers or int(os.getenv('LINE_WEBHOOK_WORKERS', '8'))
+        # Workers one webhook body may occupy, so a burst can't starve other chats
+        self.per_request = per_request or int(os.getenv('LINE_WEBHOOK_EVENTS_PER_REQUEST', '4'))
+        self.deduplicator = deduplicator or EventDeduplicator()
+        self._executor = None
+        self._in_flight = 0
+        self._idle = threading.Condition()
+        self.stats_counters = {'batches': 0, 'received': 0, 'duplicates': 0, 'processed': 0, 'failed': 0}
+
+    def bind_database(self, db_manager):
+        self.deduplicator.bind_database(db_manager)
+
+    def submit_batch(self, events: List[Any], handle: Callable[[Any], Any]):
+        """Handle the events of one webhook body concurrently, at most
+        ``per_request`` at a time: each of that many lanes takes the next
+        unhandled event until the batch is done. Redelivered events are
+        dropped here, before any crawl or reply"""
+        received = len(events)
+        events = [event for event in events
+                  if self.deduplicator.claim(getattr(event, 'webhook_event_id', None))]
+        with self._idle:
+            self.stats_counters['received'] += received
+            self.stats_counters['duplicates'] += received - len(events)
+            if not events:
+                return
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix='line-webhook')
+            self._in_flight += len(events)
+            self.stats_counters['batches'] += 1
+
+        pending = iter(events)
+        lock = threading.Lock()
+
+        def lane():
+            while True:
+                with lock:
+                    event = next(pending, None)
+                if event is None:
+                    return
+                self._run(event, handle)
+
+        for _ in range(min(self.per_request, len(events))):
+            self._executor.submit(lane)
+
+    def _run(self, event: Any, handle: Callable[[Any], Any]):
+        try:
+            handle(event)
+            outcome = 'processed'
+        except Exception as e:
+            logger.exception(f"LINE event {getattr(event, 'webhook_event_id', '')} failed: {e}")
+            outcome = 'failed'
+        with self._idle:
+            self._in_flight -= 1
+            self.stats_counters[outcome] += 1
+            self._idle.notify_all()
+
+    def wait_idle(self, timeout: float = 10.0) -> bool:
+        """Block until every submitted event has been handled (for tests and shutdown)"""
+        deadline = time.monotonic() + timeout
+        with self._idle:
+            while self._in_flight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        with self._idle:
+            stats = {'workers': self.max_workers, 'per_request': self.per_request,
+                     'in_flight': self._in_flight, **self.stats_counters}
+        return {**stats, 'dedup': self.deduplicator.stats()}
+
+
+# Global dispatcher for /find_product
+line_dispatcher = WebhookDispatcher()
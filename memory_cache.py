@@ -0,0 +1,81 @@
+"""
+Bounded in-process LRU cache with per-entry TTL
+"""
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+
+class LRUCache:
+    """Thread-safe LRU cache limited by entry count and total size in bytes.
+
+    Every entry carries its own time to live; expired entries are dropped
+    when they are next read. The least recently used entries are evicted
+    once either limit is exceeded. Sizes are supplied by the caller.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, size, expires_at)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats_counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                self.stats_counters['misses'] += 1
+                return None
+            value, size, expires_at = item
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self._bytes -= size
+                self.stats_counters['expirations'] += 1
+                self.stats_counters['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats_counters['hits'] += 1
+            return value
+
+    def set(self, key: str, value: Any, size: int, ttl: float) -> bool:
+        """Store ``value`` for ``ttl`` seconds; values larger than the whole cache are not kept"""
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            if size > self.max_bytes or ttl <= 0:
+                return False
+
+            self._entries[key] = (value, size, time.monotonic() + ttl)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.stats_counters['evictions'] += 1
+            return True
+
+    def delete(self, key: str):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.stats_counters['hits'] + self.stats_counters['misses']
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hit_ratio': round(self.stats_counters['hits'] / lookups, 3) if lookups else None,
+                **self.stats_counters
+            }
@@ -0,0 +1,162 @@
+"""
+Popularity-driven pre-warming of the price cache
+"""
+import os
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional
+
+from revalidate import price_refresher
+
+logger = logging.getLogger(__name__)
+
+
+class PrewarmScheduler:
+    """Re-crawls the most in-demand products before their cache entries expire.
+
+    Demand is the number of successful searches per product, each one
+    decaying exponentially with a half-life of PREWARM_HALF_LIFE_HOURS, so
+    trending products outrank ones that were popular last week. Every
+    PREWARM_INTERVAL seconds the top PREWARM_TOP_N products whose price
+    expires within PREWARM_LEAD_MINUTES are refreshed through the same
+    background refresher as stale-while-revalidate, spending at most
+    PREWARM_BUDGET_PER_MINUTE crawls per minute.
+    """
+
+    def __init__(self, top_n: Optional[int] = None, budget_per_minute: Optional[int] = None,
+                 half_life_hours: Optional[float] = None, interval: Optional[float] = None):
+        self.enabled = os.getenv('PREWARM_ENABLED', 'false').lower() == 'true'
+        self.top_n = top_n or int(os.getenv('PREWARM_TOP_N', '20'))
+        self.budget_per_minute = budget_per_minute or int(os.getenv('PREWARM_BUDGET_PER_MINUTE', '30'))
+        self.half_life_hours = half_life_hours or float(os.getenv('PREWARM_HALF_LIFE_HOURS', '6'))
+        self.interval = interval or float(os.getenv('PREWARM_INTERVAL', '60'))
+        self.lead_minutes = float(os.getenv('PREWARM_LEAD_MINUTES', '10'))
+        self.window_hours = float(os.getenv('PREWARM_WINDOW_HOURS', '72'))
+        self.db_manager = None
+        self.refresh_fn = None
+
+        self._scores = {}
+        self._scored_at = None  # datetime the scores are decayed to
+        self._last_search_id = 0
+        self._tokens = float(self.budget_per_minute)
+        self._tokens_at = time.monotonic()
+        self._top = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self.stats_counters = {'runs': 0, 'prewarmed': 0, 'budget_exhausted': 0,
+                               'warm_hits': 0, 'warm_misses': 0}
+
+    def bind_database(self, db_manager):
+        """Read demand from SearchHistory and cache expiries from PriceCache"""
+        self.db_manager = db_manager
+
+    def _decay(self, seconds: float) -> float:
+        return 0.5 ** (seconds / (self.half_life_hours * 3600))
+
+    def ingest(self, now: Optional[datetime] = None):
+        """Fold searches made since the last call into the decayed demand scores"""
+        now = now or datetime.utcnow()
+        since = now - timedelta(hours=self.window_hours) if self._scored_at is None else None
+        rows = self.db_manager.get_successful_searches(self._last_search_id, since=since)
+
+        with self._lock:
+            if self._scored_at is not None:
+                factor = self._decay((now - self._scored_at).total_seconds())
+                self._scores = {product_id: score * factor for product_id, score in self._scores.items()
+                                if score * factor >= 0.01}
+            self._scored_at = now
+            for search_id, product_id, searched_at in rows:
+                age = max((now - searched_at).total_seconds(), 0.0)
+                self._scores[product_id] = self._scores.get(product_id, 0.0) + self._decay(age)
+                self._last_search_id = max(self._last_search_id, search_id)
+
+    def top_products(self, limit: Optional[int] = None) -> List[tuple]:
+        """Products with the highest decayed demand, as (product_id, score)"""
+        with self._lock:
+            ranked = sorted(self._scores.items(), key=lambda item: item[1], reverse=True)
+        return ranked[:limit or self.top_n]
+
+    def _take_token(self) -> bool:
+        """Spend one crawl from the per-minute budget (a token bucket)"""
+        now = time.monotonic()
+        self._tokens = min(self._tokens + (now - self._tokens_at) * self.budget_per_minute / 60,
+                           float(self.budget_per_minute))
+        self._tokens_at = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def run_once(self, now: Optional[datetime] = None) -> List[str]:
+        """Refresh the top products that are about to expire; returns the ones scheduled"""
+        now = now or datetime.utcnow()
+        self.ingest(now)
+        top = [product_id for product_id, _ in self.top_products()]
+        with self._lock:
+            self._top = set(top)
+        self.stats_counters['runs'] += 1
+
+        expiries = self.db_manager.get_price_cache_expiries(top)
+        refresh_before = now + timedelta(minutes=self.lead_minutes)
+        scheduled = []
+        for product_id in top:
+            expiry = expiries.get(product_id)
+            if expiry is not None and expiry > refresh_before:
+                continue
+            if not self._take_token():
+                self.stats_counters['budget_exhausted'] += 1
+                break
+            if price_refresher.schedule(product_id, lambda product_id=product_id: self.refresh_fn(product_id)):
+                scheduled.append(product_id)
+            else:
+                # Already being refreshed; give the crawl back to the budget
+                self._tokens = min(self._tokens + 1, float(self.budget_per_minute))
+        self.stats_counters['prewarmed'] += len(scheduled)
+        if scheduled:
+            logger.info(f"Pre-warming {len(scheduled)} products: {scheduled}")
+        return scheduled
+
+    def record_lookup(self, product_id: str, fresh_hit: bool):
+        """Count a cache lookup of a top product towards the warm-hit ratio"""
+        with self._lock:
+            if product_id not in self._top:
+                return
+            self.stats_counters['warm_hits' if fresh_hit else 'warm_misses'] += 1
+
+    def start(self, refresh_fn: Callable[[str], Any]):
+        """Start the background thread; ``refresh_fn(product_id)`` crawls and caches a product"""
+        self.refresh_fn = refresh_fn
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='prewarm', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"Pre-warm run failed: {e}")
+            self._stop.wait(self.interval)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.stats_counters['warm_hits'] + self.stats_counters['warm_misses']
+        return {
+            'enabled': self.enabled,
+            'tracked_products': len(self._scores),
+            'top': [{'product_id': product_id, 'score': round(score, 2)}
+                    for product_id, score in self.top_products(5)],
+            'warm_hit_ratio': round(self.stats_counters['warm_hits'] / lookups, 3) if lookups else None,
+            **self.stats_counters
+        }
+
+
+# Global pre-warm scheduler instance
+prewarm_scheduler = PrewarmScheduler()
@@ -0,0 +1,141 @@
+"""
+Per-variant price and stock history, written only when a value changes and
+downsampled into hourly and daily buckets as it ages
+"""
+import os
+import uuid
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class PriceHistoryRecorder:
+    """Turns every crawl into change points of each variant (l2Id).
+
+    The latest (price, stock) of every variant lives in the
+    variant_price_state table, shared by every worker. Each crawl is
+    compared with it in one conditional upsert, so a crawl that changes
+    nothing writes no observation. Change points older than
+    PRICE_HISTORY_RAW_DAYS are folded into hourly buckets and hourly buckets
+    older than PRICE_HISTORY_HOURLY_DAYS into daily ones, every
+    PRICE_HISTORY_DOWNSAMPLE_INTERVAL seconds by whichever worker holds the
+    downsampling lease.
+    """
+
+    HOUR = 3600
+    DAY = 86400
+    LEASE_KEY = 'price_history:downsample'
+
+    def __init__(self, raw_days: Optional[float] = None, hourly_days: Optional[float] = None,
+                 interval: Optional[float] = None):
+        self.enabled = os.getenv('PRICE_HISTORY_ENABLED', 'true').lower() == 'true'
+        self.downsample_enabled = os.getenv('PRICE_HISTORY_DOWNSAMPLE', 'true').lower() == 'true'
+        self.raw_days = raw_days or float(os.getenv('PRICE_HISTORY_RAW_DAYS', '7'))
+        self.hourly_days = hourly_days or float(os.getenv('PRICE_HISTORY_HOURLY_DAYS', '90'))
+        self.interval = interval or float(os.getenv('PRICE_HISTORY_DOWNSAMPLE_INTERVAL', '3600'))
+        self.db_manager = None
+        self.holder = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self.stats_counters = {'crawls': 0, 'unchanged': 0, 'observations': 0, 'errors': 0,
+                               'downsample_runs': 0, 'downsampled_rows': 0}
+
+    def bind_database(self, db_manager):
+        """Read and write observations through the database manager"""
+        self.db_manager = db_manager
+
+    def _count(self, **amounts):
+        with self._lock:
+            for counter, amount in amounts.items():
+                self.stats_counters[counter] += amount
+
+    def record(self, result: Dict[str, Any], observed_at: Optional[datetime] = None) -> int:
+        """Write the variants of a crawl result whose price or stock changed;
+        returns how many observations were written. Never raises."""
+        if not self.enabled or self.db_manager is None or not isinstance(result, dict):
+            return 0
+        product_id = result.get('serial_number')
+        variants = [{'l2_id': item['id'], 'price': item.get('price'), 'stock': item.get('stock')}
+                    for item in result.get('product_list') or [] if item.get('id')]
+        if not product_id or not variants:
+            return 0
+        try:
+            observations = self.db_manager.record_price_changes(product_id, variants,
+                                                                observed_at or datetime.utcnow())
+        except Exception as e:
+            self._count(crawls=1, errors=1)
+            logger.error(f"Failed to record price history of {product_id}: {e}")
+            return 0
+        self._count(crawls=1, unchanged=0 if observations else 1, observations=len(observations))
+        return len(observations)
+
+    def history(self, product_id: str, start: datetime, end: datetime,
+                l2_id: Optional[str] = None) -> Dict[str, List[Dict[str, Any]]]:
+        """Observations in [start, end) grouped by variant, oldest first.
+
+        Each point is a change (resolution 0) or an hourly/daily bucket with
+        the closing price and stock, the price range and the number of
+        changes it folds together.
+        """
+        variants = {}
+        for row in self.db_manager.get_price_observations(product_id, start, end, l2_id=l2_id):
+            point = {'observed_at': row.observed_at.isoformat(), 'resolution': row.resolution,
+                     'price': row.price, 'stock': row.stock}
+            if row.resolution:
+                point.update(min_price=row.min_price, max_price=row.max_price, changes=row.changes)
+            variants.setdefault(row.l2_id, []).append(point)
+        return variants
+
+    def downsample(self, now: Optional[datetime] = None) -> Dict[str, Any]:
+        """Fold aged change points into hourly buckets and aged hourly buckets
+        into daily ones; skipped while another worker holds the lease"""
+        now = now or datetime.utcnow()
+        if not self.db_manager.acquire_lease(self.LEASE_KEY, self.holder, int(max(self.interval, 60))):
+            return {'skipped': True}
+        try:
+            # Only whole buckets are folded, so a later run never splits one
+            hourly = self.db_manager.downsample_price_observations(
+                self.HOUR, self._bucket_floor(now - timedelta(days=self.raw_days), self.HOUR))
+            daily = self.db_manager.downsample_price_observations(
+                self.DAY, self._bucket_floor(now - timedelta(days=self.hourly_days), self.DAY))
+        finally:
+            self.db_manager.release_lease(self.LEASE_KEY, self.holder)
+        self._count(downsample_runs=1, downsampled_rows=hourly['rows'] + daily['rows'])
+        return {'hourly': hourly, 'daily': daily}
+
+    @staticmethod
+    def _bucket_floor(moment: datetime, seconds: int) -> datetime:
+        epoch = datetime(1970, 1, 1)
+        elapsed = int((moment - epoch).total_seconds())
+        return epoch + timedelta(seconds=elapsed - elapsed % seconds)
+
+    def start(self):
+        """Start the background downsampling thread"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='price-history', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.downsample()
+            except Exception as e:
+                logger.error(f"Price history downsampling failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'enabled': self.enabled, **self.stats_counters}
+
+
+# Global price history recorder instance
+price_history = PriceHistoryRecorder()
@@ -1,18 +1,72 @@
+import os
+import time
+import logging
+
 from linebot.v3.messaging import (
+    ApiException,
+    PushMessageRequest,
     ReplyMessageRequest,
     TextMessage,
     ImageMessage
 )
 
-def reply_message(result, event, line_bot_api):
+logger = logging.getLogger(__name__)
+
+# A reply token is only valid for a short time after the event; closer than
+# the margin to that, the answer is pushed to the chat instead
+REPLY_TOKEN_TTL_SECONDS = float(os.getenv('LINE_REPLY_TOKEN_TTL', '60'))
+REPLY_TOKEN_MARGIN_SECONDS = float(os.getenv('LINE_REPLY_TOKEN_MARGIN', '10'))
+
+delivery_stats = {'replies': 0, 'pushes': 0, 'reply_failures': 0}
+
+
+def reply_token_expiring(event, now=None):
+    """True when the event's reply token is (about to be) too old to use"""
+    age = (now or time.time()) - event.timestamp / 1000
+    return age > REPLY_TOKEN_TTL_SECONDS - REPLY_TOKEN_MARGIN_SECONDS
+
+
+def push_target(source):
+    """Chat to push to: the group or room the event came from, else the user"""
+    return getattr(source, 'group_id', None) or getattr(source, 'room_id', None) or source.user_id
+
+
+def send_messages(event, line_bot_api, messages):
+    """Answer an event with its reply token, falling back to the push API.
+
+    Events are handled after the webhook has returned, so a slow crawl can
+    use up the reply token's lifetime; the push API has no such deadline.
+    """
+    if not reply_token_expiring(event):
+        try:
+            line_bot_api.reply_message_with_http_info(
+                ReplyMessageRequest(
+                replyToken=event.reply_token,
+                messages=messages))
+            delivery_stats['replies'] += 1
+            return 'reply'
+        except ApiException as e:
+            # 400: the token expired or was used already
+            if e.status != 400:
+                raise
+            delivery_stats['reply_failures'] += 1
+            logger.warning(f"Reply token rejected, pushing instead: {e.reason}")
+
+    line_bot_api.push_message_with_http_info(
+        PushMessageRequest(
+        to=push_target(event.source),
+        messages=messages))
+    delivery_stats['pushes'] += 1
+    return 'push'
+
+
+def reply_message(result, event, line_bot_api, age_seconds=None):
     if result == -1:
         reply1 = "商品不存在日本Uniqlo哦! (期間限定價格商品可能找不到)"
         reply2 = "請重新輸入或按 1 看範例~"
-        line_bot_api.reply_message_with_http_info(
-            ReplyMessageRequest(
-            replyToken=event.reply_token, 
-            messages=[TextMessage(text=reply1),
-                        TextMessage(text=reply2)]))
+        send_messages(event, line_bot_api,
+                      [TextMessage(text=reply1),
+                       TextMessage(text=reply2)])
     else:
         '''result = {
             "serial_number": "",
@@ -24,6 +78,9 @@ def reply_message(result, event, line_bot_api):
         }
         '''
         reply1 = "商品連結:\n %s\n商品價格: %s日圓\n折合台幣: %s元" % (result["product_url"], result["price_jp"], result["jp_price_in_twd"])
+        if age_seconds is not None:
+            # Served from a stale cache entry while it is being refreshed
+            reply1 += "\n(%d分鐘前的資料，更新中)" % (age_seconds // 60)
         # reply1 = "商品連結:\n %s\n商品價格: %s日圓\n折合台幣: %s元\n臺灣官網售價: %s元" % (result[1], result[2], result[3], result[4][2])
         if len(result["price_tw"]) != 0:
             try:
@@ -47,8 +104,17 @@ def reply_message(result, event, line_bot_api):
         else:
             reply2 = "日本官網庫存查不到Q_Q"
 
-        line_bot_api.reply_message_with_http_info(
-            ReplyMessageRequest(
-            replyToken=event.reply_token, 
-            messages=[TextMessage(text=reply1),
-                        TextMessage(text=reply2)]))
\ No newline at end of file
+        send_messages(event, line_bot_api,
+                      [TextMessage(text=reply1),
+                       TextMessage(text=reply2)])
+
+
+def reply_unavailable(event, line_bot_api):
+    reply1 = "日本官網暫時無法連線，請稍後再試"
+    send_messages(event, line_bot_api, [TextMessage(text=reply1)])
+
+
+def reply_example(event, line_bot_api):
+    img_url = "https://i.imgur.com/HLw9BhO.jpg"
+    reply = ImageMessage(original_content_url=img_url, preview_image_url=img_url)
+    send_messages(event, line_bot_api, [reply])
@@ -0,0 +1,73 @@
+"""
+Background refreshes for stale-while-revalidate cache entries
+"""
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundRefresher:
+    """Runs cache refreshes off the request path on a small thread pool.
+
+    At most one refresh per key is queued or running at a time; asking to
+    refresh a key that is already pending is a no-op, so a popular stale
+    product triggers one crawl no matter how many requests hit it.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None):
+        self.max_workers = max_workers or int(os.getenv('SWR_REFRESH_WORKERS', '2'))
+        self._executor = None
+        self._pending = set()
+        self._idle = threading.Condition()
+        self.stats_counters = {'scheduled': 0, 'deduplicated': 0, 'completed': 0, 'failed': 0}
+
+    def schedule(self, key: str, fn: Callable[[], Any]) -> bool:
+        """Queue ``fn`` to refresh ``key``; returns False if one is already pending"""
+        with self._idle:
+            if key in self._pending:
+                self.stats_counters['deduplicated'] += 1
+                return False
+            self._pending.add(key)
+            self.stats_counters['scheduled'] += 1
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix='swr-refresh')
+        self._executor.submit(self._run, key, fn)
+        return True
+
+    def _run(self, key: str, fn: Callable[[], Any]):
+        try:
+            fn()
+            outcome = 'completed'
+        except Exception as e:
+            # The stale entry keeps being served; the next request retries
+            logger.warning(f"Background refresh of {key} failed: {e}")
+            outcome = 'failed'
+        with self._idle:
+            self._pending.discard(key)
+            self.stats_counters[outcome] += 1
+            self._idle.notify_all()
+
+    def wait_idle(self, timeout: float = 10.0) -> bool:
+        """Block until no refresh is pending (for tests and shutdown)"""
+        deadline = time.monotonic() + timeout
+        with self._idle:
+            while self._pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        with self._idle:
+            return {'pending': len(self._pending), **self.stats_counters}
+
+
+# Global refresher for stale price cache entries
+price_refresher = BackgroundRefresher()
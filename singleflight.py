@@ -0,0 +1,174 @@
+"""
+Request coalescing (single-flight) for concurrent product lookups
+"""
+import os
+import time
+import uuid
+import fcntl
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class FileLease:
+    """Cross-worker lease on one host, using flock on a file per key"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def acquire(self, key: str, timeout: float) -> Optional[Any]:
+        path = os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + '.lock')
+        handle = open(path, 'a')
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return handle
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    handle.close()
+                    return None
+                time.sleep(0.05)
+
+    def release(self, key: str, token: Any):
+        fcntl.flock(token, fcntl.LOCK_UN)
+        token.close()
+
+
+class DatabaseLease:
+    """Cross-worker lease shared by every instance, stored in the crawl_lease table"""
+
+    def __init__(self, db_manager, lease_seconds: int):
+        self.db_manager = db_manager
+        self.lease_seconds = lease_seconds
+
+    def acquire(self, key: str, timeout: float) -> Optional[Any]:
+        holder = uuid.uuid4().hex
+        deadline = time.monotonic() + timeout
+        while True:
+            if self.db_manager.acquire_lease(key, holder, self.lease_seconds):
+                return holder
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(0.1)
+
+    def release(self, key: str, token: Any):
+        self.db_manager.release_lease(key, token)
+
+
+class Flight:
+    """One in-flight call that followers wait on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Collapse concurrent calls for the same key into one execution.
+
+    Within a worker, the first caller for a key (the leader) runs the
+    function and every concurrent caller waits for its result. With a
+    lease configured the leader also takes a cross-worker lease first, so
+    leaders in other workers queue behind it; the function should re-check
+    the cache once it runs.
+    """
+
+    def __init__(self, lease=None, lease_timeout: Optional[float] = None,
+                 wait_timeout: Optional[float] = None):
+        self.lease = lease
+        self.lease_timeout = lease_timeout or float(os.getenv('SINGLEFLIGHT_LEASE_TIMEOUT', '15'))
+        self.wait_timeout = wait_timeout or float(os.getenv('SINGLEFLIGHT_WAIT_TIMEOUT', '30'))
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.stats_counters = {'leaders': 0, 'followers': 0, 'lease_waits': 0, 'lease_timeouts': 0}
+
+    def bind_database(self, db_manager):
+        """Configure the cross-worker lease from SINGLEFLIGHT_LEASE ('none', 'file' or 'db')"""
+        mode = os.getenv('SINGLEFLIGHT_LEASE', 'none').lower()
+        if mode == 'db':
+            self.lease = DatabaseLease(db_manager, int(os.getenv('SINGLEFLIGHT_LEASE_SECONDS', '30')))
+        elif mode == 'file':
+            self.lease = FileLease(os.getenv('SINGLEFLIGHT_LEASE_DIR', 'data/locks'))
+        if self.lease is not None:
+            logger.info(f"Single-flight lease enabled: {mode}")
+
+    def claim(self, key: str) -> Tuple[bool, Flight]:
+        """Join the flight for ``key``; returns (is_leader, flight)"""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.stats_counters['followers'] += 1
+                return False, flight
+            flight = Flight()
+            self._flights[key] = flight
+            self.stats_counters['leaders'] += 1
+            return True, flight
+
+    def complete(self, key: str, flight: Flight, result: Any = None, error: Optional[BaseException] = None):
+        """Publish the leader's outcome and let the next caller start a new flight"""
+        flight.result = result
+        flight.error = error
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.done.set()
+
+    def wait(self, flight: Flight) -> Any:
+        """Wait for a flight led by another caller and return its result"""
+        if not flight.done.wait(self.wait_timeout):
+            raise TimeoutError("Timed out waiting for an in-flight lookup")
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    @contextmanager
+    def hold_lease(self, key: str):
+        """Hold the cross-worker lease for ``key``; proceeds without it on timeout"""
+        if self.lease is None:
+            yield
+            return
+
+        started = time.monotonic()
+        token = self.lease.acquire(key, self.lease_timeout)
+        if time.monotonic() - started > 0.01:
+            self.stats_counters['lease_waits'] += 1
+        if token is None:
+            self.stats_counters['lease_timeouts'] += 1
+            logger.warning(f"Lease for {key} not acquired in {self.lease_timeout}s, proceeding without it")
+        try:
+            yield
+        finally:
+            if token is not None:
+                self.lease.release(key, token)
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        """Run ``fn`` once for all concurrent callers with the same key"""
+        is_leader, flight = self.claim(key)
+        if not is_leader:
+            return self.wait(flight)
+
+        try:
+            with self.hold_lease(key):
+                result = fn()
+        except BaseException as e:
+            self.complete(key, flight, error=e)
+            raise
+        self.complete(key, flight, result=result)
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            in_flight = len(self._flights)
+        return {'in_flight': in_flight, 'lease': type(self.lease).__name__ if self.lease else None,
+                **self.stats_counters}
+
+
+# Global single-flight group for product crawls
+crawl_flight = SingleFlight()
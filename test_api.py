@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""
+Test script for the REST API endpoints (runs offline against a local
+stand-in Uniqlo server)
+"""
+import os
+import sys
+import json
+import time
+import threading
+from datetime import datetime, timedelta
+
+os.environ.setdefault('LINE_CHANNEL_SECRET', 'test_secret')
+os.environ.setdefault('LINE_CHANNEL_ACCESS_TOKEN', 'test_token')
+
+import crawl
+from app import app
+from revalidate import price_refresher
+from singleflight import crawl_flight
+from database import db_manager, PriceCache, SearchHistory
+from test_crawl import stub_upstream, UniqloStubHandler
+
+
+def clear_test_products(product_ids, user_id=None):
+    """Remove cache rows (and the test user's history) left by earlier runs"""
+    db_manager.flush_history()
+    for product_id in product_ids:
+        db_manager.invalidate_negative_cache(product_id)
+    with db_manager.get_session() as session:
+        session.query(PriceCache).filter(PriceCache.product_id.in_(product_ids)).delete()
+        session.commit()
+    if user_id:
+        db_manager.delete_user_history(user_id)
+    for product_id in product_ids:
+        db_manager.evict_price_l1(product_id)
+
+
+def age_cache_entry(product_id, hours):
+    """Pretend a cached price was stored ``hours`` ago with a 1 hour soft TTL"""
+    cached_at = datetime.utcnow() - timedelta(hours=hours)
+    with db_manager.get_session() as session:
+        session.query(PriceCache).filter(PriceCache.product_id == product_id).update({
+            'cache_timestamp': cached_at,
+            'expiry_timestamp': cached_at + timedelta(hours=1)
+        })
+        session.commit()
+    db_manager.evict_price_l1(product_id)
+
+
+def test_batch_search():
+    """Batch search streams one NDJSON line per product and writes history once"""
+    print("🧪 Testing batch search API")
+    print("=" * 40)
+
+    product_ids = ['470001', '470002', '470003', '999999']
+    clear_test_products(product_ids)
+    db_manager.cache_price_data('470001', {'serial_number': '470001', 'price_jp': 1990}, cache_hours=1)
+
+    started_at = datetime.utcnow()
+    with stub_upstream(delay=0.1), app.test_client() as client:
+        response = client.post('/api/search/batch', json={'product_ids': product_ids + ['470002']})
+        assert response.status_code == 200
+        assert response.mimetype == 'application/x-ndjson'
+
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        by_id = {line['product_id']: line for line in lines}
+        assert len(lines) == 4 and sorted(by_id) == sorted(product_ids)
+        assert lines[0]['product_id'] == '470001' and by_id['470001']['cached'] is True
+        assert by_id['470002']['status'] == 'ok' and by_id['470002']['cached'] is False
+        assert by_id['470003']['result']['serial_number'] == '470003'
+        assert by_id['999999']['status'] == 'not_found'
+        print(f"✅ Streamed {len(lines)} results, cached one first")
+
+        with client.session_transaction() as flask_session:
+            user_id = flask_session['user_id']
+        assert db_manager.flush_history()
+        with db_manager.get_session() as session:
+            history = session.query(SearchHistory).filter(
+                SearchHistory.user_id == user_id,
+                SearchHistory.search_timestamp >= started_at
+            ).all()
+            assert len(history) == 4
+            assert sum(1 for row in history if not row.is_successful) == 1
+        print("✅ History saved for every product in the batch")
+
+        assert db_manager.get_cached_price('470003')['serial_number'] == '470003'
+        print("✅ Crawled products were cached")
+
+        response = client.post('/api/search/batch', json={'product_ids': []})
+        assert response.status_code == 400
+        response = client.post('/api/search/batch', json=['470001', '470002'])
+        assert response.status_code == 400
+        print("✅ Empty batch and non-object body rejected")
+
+    clear_test_products(product_ids, user_id)
+    return True
+
+
+def test_batch_follower_survives_leader_failure():
+    """A failed crawl led by another request is reported for that product only"""
+    print("\n🧪 Testing batch search following a failed crawl")
+    print("=" * 40)
+
+    product_ids = ['470019', '470011']
+    clear_test_products(product_ids)
+    # Another batch leads 470019's crawl and aborts while this one waits on it
+    _, flight = crawl_flight.claim('470019')
+    abort = threading.Timer(0.2, lambda: crawl_flight.complete(
+        '470019', flight, error=RuntimeError("Batch crawl aborted")))
+    abort.start()
+    try:
+        with stub_upstream(), app.test_client() as client:
+            response = client.post('/api/search/batch', json={'product_ids': product_ids})
+            lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        by_id = {line['product_id']: line for line in lines}
+        assert by_id['470019']['status'] == 'error'
+        assert by_id['470011']['status'] == 'ok'
+        print("✅ Leader failure -> error line for its product, rest of the stream intact")
+    finally:
+        abort.join()
+
+    clear_test_products(product_ids)
+    return True
+
+
+def test_negative_cache():
+    """Unknown products are remembered and not crawled again until invalidated"""
+    print("\n🧪 Testing negative cache")
+    print("=" * 40)
+
+    clear_test_products(['999998'])
+    with stub_upstream(), app.test_client() as client:
+        response = client.post('/api/search', json={'product_id': '999998'})
+        assert response.status_code == 404
+        requests_after_first = UniqloStubHandler.REQUEST_COUNT
+        assert requests_after_first > 0
+
+        hits_before = db_manager.negative_cache_stats['hits']
+        response = client.post('/api/search', json={'product_id': '999998'})
+        assert response.status_code == 404
+        assert UniqloStubHandler.REQUEST_COUNT == requests_after_first
+        assert db_manager.negative_cache_stats['hits'] == hits_before + 1
+        print("✅ Repeated unknown product answered without upstream requests")
+
+        assert db_manager.invalidate_negative_cache('999998') == 1
+        client.post('/api/search', json={'product_id': '999998'})
+        assert UniqloStubHandler.REQUEST_COUNT > requests_after_first
+        print("✅ Invalidated entry is crawled again")
+
+        metrics = client.get('/api/metrics').get_json()
+        assert metrics['negative_cache']['stores'] >= 2
+        print(f"✅ Negative cache metrics: {metrics['negative_cache']}")
+
+    # A crawl that finds nothing expires a price already cached: it is kept
+    # for the unavailable fallback but neither served nor refreshed
+    clear_test_products(['999997'])
+    db_manager.cache_price_data('999997', {'serial_number': '999997', 'price_jp': 1990}, cache_hours=1)
+    db_manager.cache_negative_result('999997')
+    assert db_manager.get_cached_price('999997') is None
+    assert db_manager.get_cached_price('999997', allow_stale=True)['price_jp'] == 1990
+    with stub_upstream(), app.test_client() as client:
+        requests_before = UniqloStubHandler.REQUEST_COUNT
+        for _ in range(5):
+            response = client.post('/api/search', json={'product_id': '999997'})
+            assert response.status_code == 404
+        batch = client.post('/api/search/batch', json={'product_ids': ['999997']})
+        assert '"not_found"' in batch.get_data(as_text=True)
+        time.sleep(0.3)
+        assert UniqloStubHandler.REQUEST_COUNT == requests_before
+    print("✅ Negative result hides the stale price and schedules no refresh")
+
+    clear_test_products(['999997', '999998'])
+    return True
+
+
+def test_concurrent_searches_coalesce():
+    """Concurrent misses for one product share one upstream crawl"""
+    print("\n🧪 Testing coalesced concurrent searches")
+    print("=" * 40)
+
+    clear_test_products(['470010'])
+    statuses = []
+
+    def search():
+        with app.test_client() as client:
+            statuses.append(client.post('/api/search', json={'product_id': '470010'}).status_code)
+
+    with stub_upstream(delay=0.3):
+        UniqloStubHandler.REQUEST_PATHS = []
+        threads = [threading.Thread(target=search) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        page_fetches = [path for path in UniqloStubHandler.REQUEST_PATHS if path.endswith('/products/470010')]
+        assert statuses == [200] * 8
+        assert len(page_fetches) == 1
+        print(f"✅ 8 concurrent searches, {len(page_fetches)} crawl")
+
+    clear_test_products(['470010'])
+    return True
+
+
+def test_stale_fallback_when_upstream_unavailable():
+    """Expired prices are served (marked stale) while Uniqlo can't answer in time"""
+    print("\n🧪 Testing stale fallback")
+    print("=" * 40)
+
+    clear_test_products(['470012', '470013'])
+    db_manager.cache_price_data('470012', {'serial_number': '470012', 'price_jp': 1990})
+    age_cache_entry('470012', hours=db_manager.price_cache_hard_ttl_hours + 1)
+    original_deadline = crawl.CRAWL_DEADLINE_SECONDS
+    crawl.CRAWL_DEADLINE_SECONDS = 0.2
+    try:
+        with stub_upstream(delay=0.5), app.test_client() as client:
+            response = client.post('/api/search', json={'product_id': '470012'})
+            assert response.status_code == 200
+            assert response.headers['X-Cache'] == 'STALE'
+            assert response.get_json()['price_jp'] == 1990
+            print("✅ Expired entry served with X-Cache: STALE")
+
+            response = client.post('/api/search', json={'product_id': '470013'})
+            assert response.status_code == 503
+            assert not db_manager.is_negative_cached('470013')
+            print("✅ No entry at all -> 503, and nothing negative-cached")
+
+            # A search that follows a batch's unavailable crawl gets the same 503
+            def batch_search():
+                with app.test_client() as batch_client:
+                    batch_client.post('/api/search/batch', json={'product_ids': ['470013']}).get_data()
+            batch = threading.Thread(target=batch_search)
+            batch.start()
+            time.sleep(0.1)
+            response = client.post('/api/search', json={'product_id': '470013'})
+            batch.join()
+            assert response.status_code == 503
+            print("✅ Follower of an unavailable batch crawl -> 503, not an empty result")
+
+            metrics = client.get('/api/metrics').get_json()
+            assert 'circuit_breakers' in metrics['resilience']
+            print(f"✅ Resilience metrics: {metrics['resilience']['hedging']}")
+    finally:
+        crawl.CRAWL_DEADLINE_SECONDS = original_deadline
+
+    clear_test_products(['470012', '470013'])
+    return True
+
+
+def test_stale_while_revalidate():
+    """Between soft and hard TTL the stale price is served at once and refreshed behind"""
+    print("\n🧪 Testing stale-while-revalidate")
+    print("=" * 40)
+
+    clear_test_products(['470014'])
+    db_manager.cache_price_data('470014', {'serial_number': '470014', 'price_jp': 990})
+    age_cache_entry('470014', hours=2)
+
+    with stub_upstream(delay=0.3), app.test_client() as client:
+        response = client.post('/api/search', json={'product_id': '470014'})
+        assert response.status_code == 200
+        assert response.headers['X-Cache'] == 'STALE'
+        assert int(response.headers['Age']) >= 2 * 3600
+        assert response.get_json()['price_jp'] == 990
+        print(f"✅ Stale entry served immediately (Age: {response.headers['Age']}s)")
+
+        # More requests while the refresh runs don't queue more refreshes
+        client.post('/api/search', json={'product_id': '470014'})
+        assert price_refresher.wait_idle()
+        assert price_refresher.stats()['deduplicated'] >= 1
+
+        response = client.post('/api/search', json={'product_id': '470014'})
+        assert response.headers['X-Cache'] == 'HIT'
+        assert response.get_json()['price_jp'] == 2990
+        print("✅ Background refresh replaced the entry")
+
+        # Past the hard TTL the request waits on the crawl
+        age_cache_entry('470014', hours=db_manager.price_cache_hard_ttl_hours + 1)
+        response = client.post('/api/search', json={'product_id': '470014'})
+        assert response.headers['X-Cache'] == 'MISS'
+        print("✅ Entry past the hard TTL is crawled synchronously")
+
+        lines = [json.loads(line) for line in client.post(
+            '/api/search/batch', json={'product_ids': ['470014']}).get_data(as_text=True).splitlines()]
+        assert lines[0]['cached'] is True and lines[0]['stale'] is False
+        print(f"✅ Revalidation metrics: {client.get('/api/metrics').get_json()['revalidation']}")
+
+    clear_test_products(['470014'])
+    return True
+
+
+if __name__ == "__main__":
+    success = (test_batch_search() and test_batch_follower_survives_leader_failure() and test_negative_cache() and test_concurrent_searches_coalesce()
+               and test_stale_fallback_when_upstream_unavailable() and test_stale_while_revalidate())
+    sys.exit(0 if success else 1)
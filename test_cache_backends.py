@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Test script for the pluggable price cache backends, with the Redis backend
+running against a stand-in RESP server
+"""
+import sys
+import time
+import socketserver
+import threading
+from datetime import datetime, timedelta
+
+from cache_backends import CacheBackend, MemoryCacheBackend, RedisCacheBackend
+from database import DatabaseManager, db_manager, PriceCache
+from resilience import CircuitBreaker
+
+
+class RespStubHandler(socketserver.StreamRequestHandler):
+    """Minimal RESP2 server: AUTH, SELECT, PING, GET, MGET, SET [PX|EX], DEL"""
+    STORE = {}  # key -> (value, expires_at or None)
+    COMMANDS = []
+    PASSWORD = None
+
+    def read_command(self):
+        header = self.rfile.readline()
+        if not header:
+            return None
+        count = int(header[1:-2])
+        args = []
+        for _ in range(count):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def lookup(self, key):
+        value, expires_at = self.STORE.get(key, (None, None))
+        if expires_at is not None and expires_at <= time.monotonic():
+            self.STORE.pop(key, None)
+            return None
+        return value
+
+    @staticmethod
+    def bulk(value):
+        return b'$-1\r\n' if value is None else b'$%d\r\n%s\r\n' % (len(value), value)
+
+    def handle(self):
+        authed = self.PASSWORD is None
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            name = args[0].decode().upper()
+            self.COMMANDS.append(name)
+            if name == 'AUTH':
+                authed = args[1].decode() == self.PASSWORD
+                reply = b'+OK\r\n' if authed else b'-WRONGPASS invalid password\r\n'
+            elif not authed:
+                reply = b'-NOAUTH Authentication required.\r\n'
+            elif name in ('SELECT', 'PING'):
+                reply = b'+OK\r\n'
+            elif name == 'GET':
+                reply = self.bulk(self.lookup(args[1]))
+            elif name == 'MGET':
+                reply = b'*%d\r\n' % (len(args) - 1) + b''.join(self.bulk(self.lookup(key)) for key in args[1:])
+            elif name == 'SET':
+                expires_at = None
+                if len(args) == 5:
+                    unit = 1000 if args[3].upper() == b'PX' else 1
+                    expires_at = time.monotonic() + int(args[4]) / unit
+                self.STORE[args[1]] = (args[2], expires_at)
+                reply = b'+OK\r\n'
+            elif name == 'DEL':
+                reply = b':%d\r\n' % sum(self.STORE.pop(key, None) is not None for key in args[1:])
+            else:
+                reply = b'-ERR unknown command\r\n'
+            self.wfile.write(reply)
+
+
+class RespStubServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def start_resp_server(password=None):
+    """Start a stand-in Redis on a free port, return (server, url)"""
+    RespStubHandler.STORE = {}
+    RespStubHandler.COMMANDS = []
+    RespStubHandler.PASSWORD = password
+    server = RespStubServer(('127.0.0.1', 0), RespStubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    auth = f":{password}@" if password else ''
+    return server, f"redis://{auth}127.0.0.1:{server.server_address[1]}/2"
+
+
+def price_record(price, age_hours=0.0, cache_hours=1.0):
+    cached_at = datetime.utcnow() - timedelta(hours=age_hours)
+    return {'data': {'serial_number': 'TEST', 'price_jp': price},
+            'cache_timestamp': cached_at, 'expiry_timestamp': cached_at + timedelta(hours=cache_hours)}
+
+
+def test_redis_backend():
+    """Records round-trip through the RESP server; batch gets are one pipelined round trip"""
+    print("🧪 Testing Redis cache backend")
+    print("=" * 40)
+
+    server, url = start_resp_server(password='s3cret')
+    try:
+        backend = RedisCacheBackend(url)
+        backend.mget_chunk = 100
+        backend.set('rb0001', price_record(1990), ttl_seconds=60)
+        backend.set('rb0002', price_record(2990), ttl_seconds=0.2)
+        record = backend.get('rb0001')
+        assert record['data']['price_jp'] == 1990
+        assert isinstance(record['expiry_timestamp'], datetime)
+        assert RespStubHandler.COMMANDS[:2] == ['AUTH', 'SELECT']
+        print("✅ Record stored and read back with AUTH and SELECT from the URL")
+
+        time.sleep(0.3)
+        assert backend.get('rb0002') is None
+        print("✅ Keys expire with the record's TTL")
+
+        product_ids = [f"rb{i:04d}" for i in range(250)]
+        round_trips = backend.stats()['round_trips']
+        RespStubHandler.COMMANDS.clear()
+        records = backend.get_many(product_ids)
+        assert list(records) == ['rb0001']
+        assert RespStubHandler.COMMANDS == ['MGET'] * 3
+        assert backend.stats()['round_trips'] == round_trips + 1
+        print("✅ 250 keys looked up with 3 MGETs in a single round trip")
+
+        backend.delete('rb0001')
+        assert backend.get('rb0001') is None
+        print("✅ Delete removes the key")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # An unreachable server is a miss, not an error for the caller, and is
+    # skipped without connecting until the retry interval has passed
+    backend = RedisCacheBackend(url)
+    backend.breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.3)
+    assert backend.get_many(['rb0001']) == {}
+    started = time.perf_counter()
+    backend.set('rb0001', price_record(1990), ttl_seconds=60)
+    assert backend.get_many(['rb0001']) == {}
+    assert time.perf_counter() - started < 0.05
+    assert backend.stats()['errors'] == 1 and backend.stats()['skipped'] == 2
+    print("✅ Unreachable server treated as a cache miss, then skipped while cooling down")
+
+    server, url = start_resp_server(password='s3cret')
+    try:
+        backend.port = server.server_address[1]
+        time.sleep(0.35)
+        backend.set('rb0001', price_record(1990), ttl_seconds=60)
+        assert backend.get('rb0001')['data']['price_jp'] == 1990
+        assert backend.stats()['breaker']['state'] == 'closed'
+        print("✅ Server probed again after the retry interval")
+    finally:
+        server.shutdown()
+        server.server_close()
+    return True
+
+
+def test_shared_tier_across_replicas():
+    """A price cached by one replica is served to another from the shared backend"""
+    print("\n🧪 Testing shared cache tier across replicas")
+    print("=" * 40)
+
+    product_ids = ['sh0001', 'sh0002', 'sh0003']
+
+    def clear_rows():
+        with db_manager.get_session() as session:
+            session.query(PriceCache).filter(PriceCache.product_id.in_(product_ids)).delete()
+            session.commit()
+
+    server, url = start_resp_server()
+    replica_a, replica_b = DatabaseManager(), DatabaseManager()
+    replica_a.price_shared, replica_b.price_shared = RedisCacheBackend(url), RedisCacheBackend(url)
+    clear_rows()
+    try:
+        replica_a.cache_price_data('sh0001', {'serial_number': 'sh0001', 'price_jp': 990}, cache_hours=1)
+        replica_a.cache_price_data('sh0002', {'serial_number': 'sh0002', 'price_jp': 1990}, cache_hours=1)
+
+        # Without the table rows, replica B can only be answered by the shared tier
+        clear_rows()
+        entries = replica_b.get_cached_price_entries(product_ids)
+        assert sorted(entries) == ['sh0001', 'sh0002']
+        assert entries['sh0002']['data']['price_jp'] == 1990 and not entries['sh0002']['is_stale']
+        assert replica_b.price_shared.stats()['round_trips'] == 1
+        print("✅ Replica B served replica A's prices from the shared backend in one round trip")
+
+        # Table hits are copied up to the shared tier for the other replicas
+        replica_b.price_store.set('sh0003', price_record(2990), ttl_seconds=3600)
+        assert replica_b.get_cached_price('sh0003')['price_jp'] == 2990
+        assert replica_a.price_shared.get('sh0003')['data']['price_jp'] == 2990
+        print("✅ Table hit written through to the shared backend")
+
+        replica_a.cache_negative_result('sh0002')
+        assert replica_b.price_shared.get('sh0002') is None
+        print("✅ Negative result drops the shared price")
+    finally:
+        clear_rows()
+        replica_a.invalidate_negative_cache('sh0002')
+        server.shutdown()
+        server.server_close()
+    return True
+
+
+def test_memory_backend():
+    """The process-local backend honours the record TTL"""
+    print("\n🧪 Testing memory cache backend")
+    print("=" * 40)
+
+    backend = MemoryCacheBackend(max_entries=2)
+    backend.set('mb0001', price_record(990), ttl_seconds=60)
+    backend.set('mb0002', price_record(1990), ttl_seconds=0)
+    assert backend.get_many(['mb0001', 'mb0002']).keys() == {'mb0001'}
+    assert backend.stats()['entries'] == 1
+    print("✅ Memory backend keeps unexpired records only")
+
+    try:
+        CacheBackend()
+        assert False, "CacheBackend should be abstract"
+    except TypeError:
+        print("✅ CacheBackend can't be instantiated without get_many/set/delete")
+    return True
+
+
+if __name__ == "__main__":
+    success = test_redis_backend() and test_shared_tier_across_replicas() and test_memory_backend()
+    sys.exit(0 if success else 1)
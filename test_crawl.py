@@ -0,0 +1,525 @@
+#!/usr/bin/env python3
+"""
+Test script for the crawler and its upstream HTTP client (runs offline
+against a local stand-in server)
+"""
+import sys
+import json
+import asyncio
+import time
+import threading
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+import crawl
+import exchange_rate
+from exchange_rate import ExchangeRateService
+from http_client import UpstreamClient, AsyncUpstreamClient, async_upstream_client
+from alias_index import AliasIndex
+from variant_decoder import decode_l2s
+from resilience import (CircuitBreakerRegistry, CircuitOpenError, Deadline, LatencyTracker,
+                        UpstreamUnavailableError)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Minimal keep-alive server answering every GET with a small JSON body"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = json.dumps({'path': self.path}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_l2s_payload(serial, colors=('09', '69'), sizes=('003', '004', '005'), price=2990,
+                     communication_code=None):
+    """Build a detail API payload shaped like the real l2s response"""
+    l2s, stocks, prices = [], {}, {}
+    for color in colors:
+        for size in sizes:
+            l2_id = f"{serial}{color}{size}"
+            l2s.append({
+                'l2Id': l2_id,
+                'communicationCode': f"{communication_code or serial}-{color}-{size}",
+                'color': {'code': f"COL{color}"},
+                'size': {'code': f"SMA{size}"},
+            })
+            stocks[l2_id] = {'statusCode': 'IN_STOCK' if size != '005' else 'STOCK_OUT'}
+            prices[l2_id] = {'base': {'value': price}}
+    return {'status': 'ok', 'result': {'l2s': l2s, 'stocks': stocks, 'prices': prices}}
+
+
+class UniqloStubHandler(BaseHTTPRequestHandler):
+    """Stand-in for the Uniqlo JP site, its commerce API and the rate page.
+
+    ``PRODUCTS`` maps serial numbers to page titles, ``ALIASES`` maps codes
+    that 404 on the product page to the serial the relaxed search finds and
+    ``COMMUNICATION_CODES`` gives a product tag codes other than its serial.
+    Every response is delayed by ``DELAY`` seconds; paths in ``FAILING_PATHS``
+    answer 500 and the first request to a path in ``SLOW_ONCE`` is delayed
+    by the given seconds.
+    """
+    protocol_version = 'HTTP/1.1'
+    PRODUCTS = {'474479': 'Test Product 474479',
+                **{f"4700{i:02d}": f"Test Product 4700{i:02d}" for i in range(20)}}
+    ALIASES = {'4744790': '474479', '111111': '222222', '222222': '111111'}
+    COMMUNICATION_CODES = {'474479': '460001'}
+    DELAY = 0.0
+    RATE = '0.2150'
+    PAGE_PADDING = 2048
+    REQUEST_COUNT = 0
+    REQUEST_PATHS = []
+    FAILING_PATHS = set()
+    SLOW_ONCE = {}
+
+    def _send(self, status, body, content_type):
+        body = body.encode() if isinstance(body, str) else body
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        UniqloStubHandler.REQUEST_COUNT += 1
+        UniqloStubHandler.REQUEST_PATHS.append(self.path)
+        time.sleep(self.DELAY)
+        url = urlsplit(self.path)
+        parts = url.path.strip('/').split('/')
+        time.sleep(UniqloStubHandler.SLOW_ONCE.pop(url.path, 0))
+
+        if url.path in self.FAILING_PATHS:
+            self._send(500, 'upstream error', 'text/plain')
+        elif url.path.startswith('/finance'):
+            self._send(200, f'<html><div class="YMlKec fxKbKc">{self.RATE}</div></html>', 'text/html')
+        elif url.path.startswith('/jp/ja/products/'):
+            serial = parts[-1]
+            if serial in self.PRODUCTS:
+                html = f"<html><head><title>{self.PRODUCTS[serial]}</title></head><body>{'x' * self.PAGE_PADDING}</body></html>"
+                self._send(200, html, 'text/html; charset=utf-8')
+            else:
+                self._send(404, '<html><head><title>Not Found</title></head></html>', 'text/html')
+        elif url.path.endswith('/l2s'):
+            serial = parts[6][1:7]
+            if serial in self.PRODUCTS:
+                payload = make_l2s_payload(serial, communication_code=self.COMMUNICATION_CODES.get(serial))
+                self._send(200, json.dumps(payload), 'application/json')
+            else:
+                self._send(200, json.dumps({'status': 'nok', 'error': {'code': 'NOT_FOUND'}}), 'application/json')
+        elif url.path.endswith('/products'):
+            query = parse_qs(url.query).get('q', [''])[0]
+            canonical = self.ALIASES.get(query)
+            if canonical:
+                payload = {'status': 'ok', 'result': {
+                    'relaxedQueries': [query],
+                    'items': [{'productId': f"E{canonical}-000"}],
+                }}
+            else:
+                payload = {'status': 'ok', 'result': {'relaxedQueries': [], 'items': []}}
+            self._send(200, json.dumps(payload), 'application/json')
+        else:
+            self._send(404, 'not found', 'text/plain')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients that stop reading early (streamed title fetch) reset the connection
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+
+def start_stub_server(handler_class=StubHandler):
+    """Start a stand-in server on a free port, return (server, base_url)"""
+    server = StubHTTPServer(('127.0.0.1', 0), handler_class)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def test_upstream_client_pooling():
+    """Sequential requests to one host should reuse a kept-alive connection"""
+    print("🧪 Testing upstream connection pooling")
+    print("=" * 40)
+
+    server, base_url = start_stub_server()
+    client = UpstreamClient(pool_connections=2, pool_maxsize=2)
+    try:
+        for i in range(5):
+            response = client.get(f"{base_url}/item/{i}")
+            assert response.status_code == 200
+            assert response.json()['path'] == f"/item/{i}"
+
+        stats = client.stats()
+        host_stats = list(stats['hosts'].values())
+        assert len(host_stats) == 1
+        print(f"✅ Pool stats: {host_stats[0]}")
+        assert host_stats[0]['requests'] == 5
+        assert host_stats[0]['pool_misses'] == 1
+        assert host_stats[0]['pool_hits'] == 4
+        return True
+    finally:
+        client.close()
+        server.shutdown()
+
+
+@contextmanager
+def stub_upstream(delay=0.0):
+    """Point crawl.py at a stand-in Uniqlo server for the duration of a test"""
+    original = (crawl.UNIQLO_BASE_URL, exchange_rate.EXCHANGE_RATE_URL)
+    UniqloStubHandler.DELAY = delay
+    server, base_url = start_stub_server(UniqloStubHandler)
+    crawl.UNIQLO_BASE_URL = base_url
+    exchange_rate.EXCHANGE_RATE_URL = f"{base_url}/finance/quote/JPY-TWD"
+    try:
+        yield base_url
+    finally:
+        crawl.UNIQLO_BASE_URL, exchange_rate.EXCHANGE_RATE_URL = original
+        UniqloStubHandler.DELAY = 0.0
+        server.shutdown()
+        server.server_close()
+
+
+def test_product_crawl_fan_out():
+    """The page, detail and rate fetches should overlap instead of adding up"""
+    print("\n🧪 Testing concurrent product crawl")
+    print("=" * 40)
+
+    with stub_upstream(delay=0.3):
+        exchange_rate.exchange_rate_service.refresh()
+        started = time.perf_counter()
+        result = crawl.product_crawl('474479')
+        elapsed = time.perf_counter() - started
+
+        assert result != -1
+        assert result['serial_number'] == '474479'
+        assert result['page_title'] == 'Test Product 474479'
+        assert result['price_jp'] == 2990
+        assert result['jp_price_in_twd'] == round(2990 * 0.2150)
+        assert len(result['product_list']) == 6
+        print(f"✅ Crawl finished in {elapsed:.2f}s (two calls of 0.3s each)")
+        assert elapsed < 0.55
+
+        # 404 on the product page falls back to the relaxed search
+        result = crawl.product_crawl('4744790')
+        assert result != -1 and result['serial_number'] == '474479'
+        print("✅ 404 fallback resolved 4744790 -> 474479")
+
+        assert crawl.product_crawl('999999') == -1
+        print("✅ Unknown serial returns -1")
+        return True
+
+
+def test_alias_resolution():
+    """Resolved codes skip the 404 and relaxed search; alias loops are bounded"""
+    print("\n🧪 Testing alias resolution")
+    print("=" * 40)
+
+    def searched_paths():
+        return [path for path in UniqloStubHandler.REQUEST_PATHS
+                if '/products?' in path or path.endswith('/4744790')]
+
+    original_index = crawl.alias_index
+    crawl.alias_index = AliasIndex()
+    try:
+        with stub_upstream():
+            UniqloStubHandler.REQUEST_PATHS = []
+            assert crawl.product_crawl('4744790')['serial_number'] == '474479'
+            assert len(searched_paths()) == 2
+            time.sleep(0.1)
+
+            UniqloStubHandler.REQUEST_PATHS = []
+            assert crawl.product_crawl('4744790')['serial_number'] == '474479'
+            assert searched_paths() == []
+            print("✅ Second lookup went straight to the canonical serial")
+
+            UniqloStubHandler.REQUEST_PATHS = []
+            result = crawl.product_crawl('460001')
+            assert result['serial_number'] == '474479'
+            assert all(item['serial_alt'] == '460001' for item in result['product_list'])
+            assert not any(path.endswith('/460001') for path in UniqloStubHandler.REQUEST_PATHS)
+            print("✅ Communication code resolved from the l2s payload")
+
+            UniqloStubHandler.REQUEST_PATHS = []
+            assert crawl.product_crawl('111111') == -1
+            assert len(UniqloStubHandler.REQUEST_PATHS) <= 8
+            print(f"✅ Alias loop stopped after {len(UniqloStubHandler.REQUEST_PATHS)} requests")
+            print(f"✅ Alias stats: {crawl.alias_index.stats()}")
+    finally:
+        crawl.alias_index = original_index
+    return True
+
+
+def test_streamed_page_title():
+    """Only the head of a large product page should be downloaded"""
+    print("\n🧪 Testing streamed page title fetch")
+    print("=" * 40)
+
+    UniqloStubHandler.PAGE_PADDING = 2_000_000
+    try:
+        with stub_upstream() as base_url:
+            url = f"{base_url}/jp/ja/products/474479"
+            status, head_html = async_upstream_client.run(
+                async_upstream_client.get_prefix(url, crawl.TITLE_STOP_MARKERS)
+            )
+            assert status == 200
+            assert len(head_html) < 256 * 1024
+            assert crawl.extract_page_title(head_html) == 'Test Product 474479'
+            print(f"✅ Read {len(head_html)} of ~2MB bytes before </title>")
+
+            # Markers split across chunk boundaries are still found
+            status, head_html = async_upstream_client.run(
+                async_upstream_client.get_prefix(url, crawl.TITLE_STOP_MARKERS, chunk_size=5)
+            )
+            assert b'</title>' in head_html
+            assert len(head_html) < 100
+            print("✅ Marker spanning chunks detected")
+
+            status, page_title = async_upstream_client.run(crawl.fetch_product_page(url))
+            assert (status, page_title) == (200, 'Test Product 474479')
+    finally:
+        UniqloStubHandler.PAGE_PADDING = 2048
+    return True
+
+
+def test_async_crawl_in_flight():
+    """Many lookups should share one session and be in flight at once"""
+    print("\n🧪 Testing asyncio crawl engine")
+    print("=" * 40)
+
+    async def crawl_all(serials):
+        return await asyncio.gather(*(crawl.async_product_crawl(serial) for serial in serials))
+
+    with stub_upstream(delay=0.3):
+        started = time.perf_counter()
+        results = async_upstream_client.run(crawl_all(['474479'] * 20))
+        elapsed = time.perf_counter() - started
+
+        assert all(result != -1 and result['serial_number'] == '474479' for result in results)
+        # 40 requests of 0.3s each, at most UPSTREAM_POOL_MAXSIZE (10) in flight
+        print(f"✅ 20 lookups finished in {elapsed:.2f}s on one session")
+        assert elapsed < 2.0
+
+        host_stats = [stats for host, stats in async_upstream_client.stats()['hosts'].items()
+                      if host.startswith('http://127.0.0.1')]
+        assert sum(stats['pool_hits'] for stats in host_stats) > 0
+        print(f"✅ Async pool stats: {host_stats}")
+    return True
+
+
+def test_product_crawl_many():
+    """Batch crawls de-duplicate, respect the caps and scale with concurrency"""
+    print("\n🧪 Testing batch crawl")
+    print("=" * 40)
+
+    serials = [f"4700{i:02d}" for i in range(8)]
+    with stub_upstream(delay=0.2):
+        timings = {}
+        for concurrency in (1, 4):
+            started = time.perf_counter()
+            results = dict(crawl.product_crawl_many(serials + serials[:3] + ['999999'], concurrency=concurrency))
+            timings[concurrency] = time.perf_counter() - started
+
+            assert sorted(results) == sorted(serials + ['999999'])
+            assert results['999999'] == -1
+            assert all(results[serial]['serial_number'] == serial for serial in serials)
+        print(f"✅ 9 unique lookups: {timings[1]:.2f}s at concurrency 1, {timings[4]:.2f}s at concurrency 4")
+        assert timings[4] < timings[1] / 2
+
+        # 4 lookups issue at least 8 requests; at 10 requests/s that takes >= 0.7s
+        started = time.perf_counter()
+        results = list(crawl.product_crawl_many(serials[:4], concurrency=4, rate_limit=10))
+        elapsed = time.perf_counter() - started
+        assert len(results) == 4
+        print(f"✅ Rate-limited batch took {elapsed:.2f}s")
+        assert elapsed >= 0.7
+    return True
+
+
+def test_rate_limited_batch_with_healthy_upstream():
+    """Queueing behind the rate limiter neither times requests out nor trips the breaker"""
+    print("\n🧪 Testing rate-limited batch against a healthy upstream")
+    print("=" * 40)
+
+    serials = [f"4700{i:02d}" for i in range(8)]
+    original_deadline = crawl.CRAWL_DEADLINE_SECONDS
+    crawl.CRAWL_DEADLINE_SECONDS = 1.0
+    try:
+        with stub_upstream() as base_url:
+            # 8 lookups x 2 requests at 5/s queue for ~3s, well past every stage timeout
+            results = dict(crawl.product_crawl_many(serials, concurrency=8, rate_limit=5))
+            host = urlsplit(base_url)
+            breaker = async_upstream_client.breakers.get(f"{host.hostname}:{host.port}").stats()
+    finally:
+        crawl.CRAWL_DEADLINE_SECONDS = original_deadline
+
+    assert all(results[serial] not in (None, -1) for serial in serials), results
+    assert breaker['state'] == 'closed' and breaker['failures'] == 0, breaker
+    print(f"✅ All {len(serials)} lookups answered; breaker {breaker}")
+    return True
+
+
+def test_exchange_rate_service():
+    """Readers get the last good rate immediately; refreshes happen in the background"""
+    print("\n🧪 Testing exchange rate service")
+    print("=" * 40)
+
+    with stub_upstream(delay=0.3):
+        service = ExchangeRateService(ttl=60, retry_interval=1)
+        assert service.get_rate() is None
+        print("✅ Cold start without a stored rate returns None without blocking")
+
+        time.sleep(0.6)
+        assert service.get_rate() == 0.215
+        assert service.age_seconds() < 1
+        print(f"✅ Background refresh fetched the rate: {service.stats()}")
+
+        # An expired rate is still served while the refresh is in flight
+        service._fetched_at -= 120
+        started = time.perf_counter()
+        assert service.get_rate() == 0.215
+        assert time.perf_counter() - started < 0.1
+        print("✅ Stale rate served immediately")
+
+    # With upstream unreachable, a failed refresh keeps the last good value
+    original_url = exchange_rate.EXCHANGE_RATE_URL
+    exchange_rate.EXCHANGE_RATE_URL = 'http://127.0.0.1:9/finance/quote/JPY-TWD'
+    try:
+        assert service.refresh() == 0.215
+    finally:
+        exchange_rate.EXCHANGE_RATE_URL = original_url
+    assert service.stats()['last_error'] == 'fetch failed'
+    print("✅ Failed refresh keeps the last good rate")
+    return True
+
+
+def test_circuit_breaker():
+    """Repeated failures open the host's circuit, which then fails fast"""
+    print("\n🧪 Testing circuit breaker")
+    print("=" * 40)
+
+    client = AsyncUpstreamClient()
+    client.breakers = CircuitBreakerRegistry(failure_threshold=3, reset_timeout=0.5)
+    with stub_upstream() as base_url:
+        UniqloStubHandler.FAILING_PATHS = {'/broken'}
+        try:
+            UniqloStubHandler.REQUEST_COUNT = 0
+            errors = []
+            for _ in range(5):
+                try:
+                    client.run(client.get_text(f"{base_url}/broken"))
+                except UpstreamUnavailableError as e:
+                    errors.append(type(e))
+            assert errors == [UpstreamUnavailableError] * 3 + [CircuitOpenError] * 2
+            assert UniqloStubHandler.REQUEST_COUNT == 3
+            print("✅ Circuit opened after 3 failures, later calls refused without a request")
+
+            # After the reset timeout one trial call goes through and closes the circuit
+            time.sleep(0.6)
+            status, _ = client.run(client.get_text(f"{base_url}/jp/ja/products/474479"))
+            assert status == 200
+            breaker_stats = list(client.resilience_stats()['circuit_breakers'].values())[0]
+            assert breaker_stats['state'] == 'closed' and breaker_stats['opened'] == 1
+            print(f"✅ Trial call closed the circuit: {breaker_stats}")
+        finally:
+            UniqloStubHandler.FAILING_PATHS = set()
+            client.close()
+    return True
+
+
+def test_hedged_request():
+    """A call slower than the tracked p95 is hedged and the faster copy wins"""
+    print("\n🧪 Testing hedged requests")
+    print("=" * 40)
+
+    client = AsyncUpstreamClient()
+    tracker = LatencyTracker(min_samples=5)
+    for _ in range(10):
+        tracker.record(0.02)
+    with stub_upstream() as base_url:
+        path = '/jp/api/commerce/v5/ja/products/E474479-000/price-groups/00/l2s'
+        UniqloStubHandler.SLOW_ONCE = {path: 1.0}
+        try:
+            started = time.perf_counter()
+            payload = client.run(client.get_json_hedged(f"{base_url}{path}", tracker=tracker))
+            elapsed = time.perf_counter() - started
+            assert payload['status'] == 'ok'
+            assert elapsed < 0.5
+            assert client.hedge_counters == {'hedged': 1, 'hedge_wins': 1}
+            print(f"✅ Hedged call answered in {elapsed:.2f}s instead of 1s")
+        finally:
+            UniqloStubHandler.SLOW_ONCE = {}
+            client.close()
+    return True
+
+
+def test_crawl_deadline():
+    """A crawl that can't finish within its deadline reports Uniqlo unavailable"""
+    print("\n🧪 Testing crawl deadline")
+    print("=" * 40)
+
+    with stub_upstream(delay=0.5):
+        started = time.perf_counter()
+        try:
+            async_upstream_client.run(crawl.async_product_crawl('474479', deadline=Deadline(0.3)))
+            assert False, "Crawl should have run out of time"
+        except UpstreamUnavailableError as e:
+            elapsed = time.perf_counter() - started
+            print(f"✅ Gave up after {elapsed:.2f}s: {e}")
+        assert elapsed < 0.45
+    return True
+
+
+def test_variant_decoder():
+    """The table-driven decoder gives the same product_list as the old loop"""
+    print("\n🧪 Testing l2s variant decoder")
+    print("=" * 40)
+
+    expected_colors = {0: 'White 白', 1: 'White 白', 2: 'Gray 灰', 9: 'Black 黑', 19: 'Red 紅',
+                       20: 'Orange 橘', 39: 'Brown 棕', 49: 'Yellow 黃', 59: 'Green 綠',
+                       68: 'Blue 藍', 69: 'Navy 海軍藍', 79: 'Purple 紫', 80: 'Others 其他',
+                       99: 'Others 其他'}
+    for code, name in expected_colors.items():
+        assert crawl.get_color_name(f"{code:02d}") == name
+    assert crawl.get_size_name('004') == 'M' and crawl.get_size_name('508') == 'EF 85/90'
+    assert crawl.get_size_name('011') == ''
+    print("✅ Lookup arrays match the color ranges and size codes")
+
+    payload = make_l2s_payload('474479', colors=('09', '69'), sizes=('003', '004'), price=2990,
+                               communication_code='460001')
+    variants = decode_l2s(payload)
+    assert len(variants) == 4 and variants.first_price == 2990
+    product_list = variants.to_product_list('474479')
+    assert product_list[0] == {'serial': '474479', 'serial_alt': '460001', 'id': '47447909003',
+                               'color': 'Black 黑', 'size': 'S', 'stock': 'IN_STOCK', 'price': 2990}
+    assert [item['color'] for item in product_list] == ['Black 黑'] * 2 + ['Navy 海軍藍'] * 2
+    print(f"✅ Decoded {len(variants)} variants into the product_list shape")
+
+    # Variants missing from stocks/prices default to 0, as before
+    del payload['result']['stocks']['47447969004']
+    del payload['result']['prices']['47447969004']
+    last = decode_l2s(payload).to_product_list('474479')[-1]
+    assert last['stock'] == 0 and last['price'] == 0
+    print("✅ Missing stock and price entries default to 0")
+    return True
+
+
+if __name__ == "__main__":
+    success = (test_upstream_client_pooling() and test_product_crawl_fan_out()
+               and test_alias_resolution() and test_streamed_page_title()
+               and test_async_crawl_in_flight()
+               and test_product_crawl_many() and test_rate_limited_batch_with_healthy_upstream()
+               and test_exchange_rate_service()
+               and test_circuit_breaker() and test_hedged_request()
+               and test_crawl_deadline() and test_variant_decoder())
+    sys.exit(0 if success else 1)
@@ -4,8 +4,15 @@ Test script for database functionality
 """
 import os
 import sys
-from datetime import datetime
-from database import db_manager
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import event
+
+os.environ.setdefault('LINE_CHANNEL_SECRET', 'test_secret')
+os.environ.setdefault('LINE_CHANNEL_ACCESS_TOKEN', 'test_token')
+
+from database import db_manager, PriceCache
+from memory_cache import LRUCache
 
 def test_database_operations():
     """Test basic database operations"""
@@ -32,6 +39,7 @@ def test_database_operations():
             source="test",
             user_id="test_user"
         )
+        assert db_manager.flush_history()
         print("✅ Search saved to history")
         
         # Get search statistics (since there's no direct get_search_history method)
@@ -62,8 +70,29 @@ def test_database_operations():
         stats = db_manager.get_search_stats()
         print(f"✅ Analytics: {stats}")
         
-        # Test 4: Config operations (skip - not implemented in current DatabaseManager)
-        print("\n4. Skipping config test (not implemented yet)")
+        # Test 4: Config operations
+        print("\n4. Testing config operations...")
+        db_manager.set_config('test_config_float', 0.215, config_type='float')
+        db_manager.set_config('test_config_json', {'rate': 0.215}, config_type='json')
+        if (db_manager.get_config('test_config_float') == 0.215
+                and db_manager.get_config('test_config_json') == {'rate': 0.215}
+                and db_manager.get_config('missing_config_key', 'default') == 'default'):
+            print("✅ Config saved and retrieved")
+        else:
+            print("❌ Config retrieval failed")
+            return False
+        
+        # Test 5: Product aliases
+        print("\n5. Testing product aliases...")
+        db_manager.save_product_aliases({'test_alias_1': 'TEST123'}, source='relaxed_query')
+        db_manager.save_product_aliases({'test_alias_1': 'TEST456'}, source='relaxed_query')
+        if (db_manager.get_product_alias('test_alias_1') == 'TEST456'
+                and db_manager.get_all_product_aliases().get('test_alias_1') == 'TEST456'
+                and db_manager.get_product_alias('missing_alias') is None):
+            print("✅ Aliases saved and retrieved")
+        else:
+            print("❌ Alias retrieval failed")
+            return False
         
         print("\n🎉 All database tests passed!")
         return True
@@ -74,6 +103,338 @@ def test_database_operations():
         traceback.print_exc()
         return False
 
+def test_price_l1_cache():
+    """Price cache hits are served from memory and their access counts batched"""
+    print("\n⚡ Testing in-process price cache")
+    print("=" * 40)
+    
+    statements = []
+    
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, executemany))
+    
+    product_ids = ['l1_test_a', 'l1_test_b']
+    for product_id in product_ids:
+        db_manager.cache_price_data(product_id, {'serial_number': product_id, 'price_jp': 990})
+    db_manager.flush_access_stats()
+    
+    event.listen(db_manager.engine, 'before_cursor_execute', count_statement)
+    try:
+        for _ in range(3):
+            assert db_manager.get_cached_price('l1_test_a')['price_jp'] == 990
+            assert db_manager.get_cached_price_entry('l1_test_b')['is_stale'] is False
+        assert statements == []
+        print("✅ 6 cache hits, 0 database statements")
+        
+        assert db_manager.flush_access_stats() == 2
+        assert len(statements) == 1 and statements[0][1] is True
+        print("✅ Access counts flushed in one batched UPDATE")
+        
+        # After L1 is dropped, the next read loads from the database once
+        db_manager.evict_price_l1('l1_test_a')
+        statements.clear()
+        db_manager.get_cached_price('l1_test_a')
+        db_manager.get_cached_price('l1_test_a')
+        assert len(statements) == 1
+        print("✅ L1 miss loads from the database and is cached again")
+    finally:
+        event.remove(db_manager.engine, 'before_cursor_execute', count_statement)
+    
+    db_manager.flush_access_stats()
+    with db_manager.get_session() as session:
+        access_count = session.query(PriceCache.access_count).filter(
+            PriceCache.product_id == 'l1_test_a').scalar()
+        assert access_count == 6  # 1 on insert + 3 + 2 hits
+        session.query(PriceCache).filter(PriceCache.product_id.in_(product_ids)).delete()
+        session.commit()
+    db_manager.evict_price_l1()
+    print(f"✅ PriceCache.access_count is {access_count}: {db_manager.price_cache_stats()}")
+    
+    # Limits: entry count, bytes and per-entry TTL
+    cache = LRUCache(max_entries=2, max_bytes=100)
+    cache.set('a', 1, size=10, ttl=60)
+    cache.set('b', 2, size=10, ttl=60)
+    cache.get('a')
+    cache.set('c', 3, size=10, ttl=60)
+    assert cache.get('b') is None and cache.get('a') == 1
+    cache.set('big', 4, size=95, ttl=60)
+    assert cache.stats()['bytes'] <= 100 and cache.get('big') == 4
+    assert not cache.set('huge', 5, size=101, ttl=60)
+    cache.set('short', 6, size=1, ttl=0.05)
+    time.sleep(0.1)
+    assert cache.get('short') is None
+    stats = cache.stats()
+    assert stats['evictions'] >= 2 and stats['expirations'] == 1
+    print(f"✅ LRU limits enforced: {stats}")
+    return True
+
+def test_history_write_behind():
+    """History rows are queued by requests and inserted in batches"""
+    print("\n📝 Testing search history write-behind")
+    print("=" * 40)
+    
+    from database import SearchHistory
+    user_id = 'write_behind_test'
+    before = db_manager.get_history_queue_stats()
+    
+    started = time.perf_counter()
+    for i in range(50):
+        db_manager.save_search_history(f"wb_{i}", {'serial_number': f"wb_{i}"},
+                                       source='test', user_id=user_id)
+    enqueue_ms = (time.perf_counter() - started) * 1000
+    print(f"✅ 50 searches queued in {enqueue_ms:.1f}ms")
+    
+    assert db_manager.flush_history()
+    stats = db_manager.get_history_queue_stats()
+    assert stats['pending'] == 0 and stats['depth'] == 0
+    assert stats['written'] - before['written'] == 50
+    assert stats['batches'] - before['batches'] < 50
+    with db_manager.get_session() as session:
+        assert session.query(SearchHistory).filter(SearchHistory.user_id == user_id).count() == 50
+    assert db_manager.delete_user_history(user_id) == 50
+    print(f"✅ Written in {stats['batches'] - before['batches']} batches: {stats}")
+    
+    # A full queue sheds rows instead of blocking the request
+    from database import DatabaseManager
+    os.environ['HISTORY_QUEUE_MAX'] = '1'
+    try:
+        stalled = DatabaseManager()
+    finally:
+        del os.environ['HISTORY_QUEUE_MAX']
+    stalled._history_flusher = 'stalled'  # no consumer: the queue stays full
+    started = time.perf_counter()
+    stalled.save_search_history_bulk([{'product_id': f"wb_full_{i}", 'search_data': {}} for i in range(50)])
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    assert stalled.history_queue_stats['enqueued'] == 1
+    assert stalled.history_queue_stats['dropped'] == 49
+    assert stalled.get_history_queue_stats()['pending'] == 1
+    # One enqueue deadline for the whole batch, not one per row
+    assert elapsed_ms < stalled.history_enqueue_timeout * 1000 * 4
+    print(f"✅ Full queue dropped 49 rows after {elapsed_ms:.0f}ms instead of blocking")
+    return True
+
+def test_search_rollups():
+    """/api/stats is answered from the rollup tables with one query"""
+    print("\n📊 Testing search stats rollups")
+    print("=" * 40)
+    
+    user_id = 'rollup_test'
+    db_manager.delete_user_history(user_id)
+    db_manager.rebuild_search_rollups()
+    assert db_manager.get_search_stats() == db_manager._get_search_stats_from_history()
+    print("✅ Backfilled rollups match the statistics computed from search_history")
+    
+    before = db_manager.get_search_stats()
+    db_manager.save_search_history_bulk(
+        [{'product_id': 'rollup_hot', 'search_data': {}, 'source': 'test', 'user_id': user_id}] * 40
+        + [{'product_id': 'rollup_miss', 'search_data': {}, 'source': 'test', 'user_id': user_id,
+            'is_successful': False, 'error_message': 'Product not found'}] * 2
+    )
+    assert db_manager.flush_history()
+    
+    statements = []
+    
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    
+    event.listen(db_manager.engine, 'before_cursor_execute', count_statement)
+    try:
+        stats = db_manager.get_search_stats()
+    finally:
+        event.remove(db_manager.engine, 'before_cursor_execute', count_statement)
+    assert len(statements) == 1 and 'UNION ALL' in statements[0]
+    assert stats['total_searches'] == before['total_searches'] + 42
+    assert stats['successful_searches'] == before['successful_searches'] + 40
+    assert stats['recent_searches_24h'] == before['recent_searches_24h'] + 42
+    assert {'product_id': 'rollup_hot', 'search_count': 40} in stats['popular_products']
+    print(f"✅ Rollups updated with the history insert, stats read in 1 query: {stats['total_searches']} searches")
+    
+    assert db_manager.delete_user_history(user_id) == 42
+    assert db_manager.get_search_stats() == before
+    print("✅ Deleting a user's history takes it out of the rollups")
+    
+    # "Last 24h" is the current hour plus the 23 before it, never 25 buckets
+    from database import SearchHistory
+    this_hour = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+    rows = [('rollup_old', this_hour - timedelta(hours=23, minutes=30), True),
+            ('rollup_new', this_hour - timedelta(hours=22, minutes=30), True)]
+    with db_manager.get_session() as session:
+        for product_id, searched_at, _ in rows:
+            session.add(SearchHistory(product_id=product_id, search_timestamp=searched_at,
+                                      user_id=user_id, is_successful=True))
+        db_manager._apply_search_rollups(session, rows)
+        session.commit()
+    stats = db_manager.get_search_stats()
+    assert stats['total_searches'] == before['total_searches'] + 2
+    assert stats['recent_searches_24h'] == before['recent_searches_24h'] + 1
+    legacy = db_manager._get_search_stats_from_history()
+    assert stats['recent_searches_24h'] == legacy['recent_searches_24h']
+    assert db_manager.delete_user_history(user_id) == 2
+    print("✅ recent_searches_24h covers whole hour buckets within the last 24h")
+    return True
+
+def test_history_summaries():
+    """History listings read precomputed summary columns instead of product_data"""
+    print("\n🗂️  Testing history summary columns")
+    print("=" * 40)
+    
+    from database import SearchHistory
+    from app import get_user_search_history
+    user_id = 'summary_test'
+    db_manager.delete_user_history(user_id)
+    product = {
+        'serial_number': 'SUM001', 'page_title': 'Summary Tee', 'price_jp': 1990,
+        'product_list': [
+            {'color': '00 WHITE', 'size': 'S', 'stock': 'IN_STOCK'},
+            {'color': '00 WHITE', 'size': 'M', 'stock': 'STOCK_OUT'},
+            {'color': '09 BLACK', 'size': 'S', 'stock': 'IN_STOCK'},
+            {'color': '09 BLACK', 'size': 'L', 'stock': 'LOW_STOCK'},
+        ]
+    }
+    db_manager.save_search_history('sum001', product, source='test', user_id=user_id)
+    assert db_manager.flush_history()
+    
+    # Rows from before the summary columns existed: one is summarized when first
+    # listed, the other by the backfill
+    with db_manager.get_session() as session:
+        session.add(SearchHistory(product_id='sum002', product_data={**product, 'page_title': 'Old Tee'},
+                                  search_timestamp=datetime(2024, 1, 1), user_id=user_id))
+        session.commit()
+    history = get_user_search_history(user_id)
+    assert history[1]['product_name'] == 'Old Tee' and history[1]['sizes'] == ['S']
+    print("✅ Unsummarized row listed with a summary derived from product_data")
+    
+    with db_manager.get_session() as session:
+        session.add(SearchHistory(product_id='sum003', product_data={**product, 'page_title': 'Older Tee'},
+                                  search_timestamp=datetime(2023, 1, 1), user_id=user_id))
+        session.commit()
+    assert db_manager.backfill_history_summaries() >= 1
+    
+    with db_manager.get_session() as session:
+        rows = session.query(SearchHistory.colors, SearchHistory.in_stock_sizes, SearchHistory.variant_count).filter(
+            SearchHistory.user_id == user_id).all()
+    assert all(row == (['00 WHITE', '09 BLACK'], ['S'], 4) for row in rows)
+    print("✅ Summaries written with the row and backfilled for older rows")
+    
+    statements = []
+    
+    def record_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    
+    event.listen(db_manager.engine, 'before_cursor_execute', record_statement)
+    try:
+        history = get_user_search_history(user_id)
+    finally:
+        event.remove(db_manager.engine, 'before_cursor_execute', record_statement)
+    assert [item['product_name'] for item in history] == ['Summary Tee', 'Old Tee', 'Older Tee']
+    assert history[0]['colors'] == ['00 WHITE', '09 BLACK'] and history[0]['sizes'] == ['S']
+    assert not any('product_data' in statement for statement in statements)
+    print("✅ History listed without loading product_data")
+    
+    # The old-style row never went through the rollups, so it's deleted directly
+    with db_manager.get_session() as session:
+        session.query(SearchHistory).filter(SearchHistory.product_id.in_(['sum002', 'sum003'])).delete(
+            synchronize_session=False)
+        session.commit()
+    db_manager.delete_user_history(user_id)
+    return True
+
+def test_snapshot_store():
+    """History rows reference one shared snapshot per distinct product response"""
+    print("\n🧬 Testing product snapshot store")
+    print("=" * 40)
+    
+    from database import SearchHistory, ProductSnapshot
+    user_id = 'snapshot_test'
+    product = {'serial_number': 'SNAP01', 'page_title': 'Snapshot Tee', 'price_jp': 1990,
+               'jp_price_in_twd': 420, 'price_tw': [], 'product_url': 'https://example.com/snap01',
+               'product_list': [{'color': '00 WHITE', 'size': 'M', 'stock': 'IN_STOCK'}]}
+    
+    def cleanup():
+        db_manager.delete_user_history(user_id)
+        with db_manager.get_session() as session:
+            session.query(SearchHistory).filter(SearchHistory.user_id == f"{user_id}_legacy").delete()
+            session.query(ProductSnapshot).filter(ProductSnapshot.product_id == 'snap01').delete()
+            session.commit()
+        db_manager._known_snapshots.clear()
+    
+    cleanup()
+    try:
+        # The TWD price moves with the exchange rate without the product changing
+        db_manager.save_search_history_bulk([
+            {'product_id': 'snap01', 'search_data': {**product, 'jp_price_in_twd': 420 + i % 3},
+             'source': 'test', 'user_id': user_id}
+            for i in range(30)
+        ])
+        assert db_manager.flush_history()
+        with db_manager.get_session() as session:
+            rows = session.query(SearchHistory.id, SearchHistory.snapshot_hash, SearchHistory.product_data).filter(
+                SearchHistory.user_id == user_id).order_by(SearchHistory.id).all()
+            snapshot_count = session.query(ProductSnapshot).filter(ProductSnapshot.product_id == 'snap01').count()
+        assert len(rows) == 30 and snapshot_count == 1
+        assert len({row.snapshot_hash for row in rows}) == 1 and all(row.product_data is None for row in rows)
+        assert db_manager.get_history_product(rows[1].id) == {**product, 'jp_price_in_twd': 421}
+        print("✅ 30 searches stored one snapshot; each row keeps its own TWD price")
+        
+        # Once a snapshot is known to be stored, later batches don't send it again
+        skipped = db_manager.snapshot_stats['skipped_known']
+        db_manager.save_search_history('snap01', product, source='test', user_id=user_id)
+        assert db_manager.flush_history()
+        assert db_manager.snapshot_stats['skipped_known'] == skipped + 1
+        print("✅ Known snapshot skipped on the next write")
+        
+        # Rows from before the snapshot store are compacted into the same snapshot
+        with db_manager.get_session() as session:
+            session.add_all([SearchHistory(product_id='snap01', product_data={**product, 'jp_price_in_twd': 399},
+                                           jp_price_in_twd=399, user_id=f"{user_id}_legacy")
+                             for _ in range(5)])
+            session.commit()
+        result = db_manager.compact_history_snapshots()
+        assert result['rows'] >= 5
+        with db_manager.get_session() as session:
+            legacy = session.query(SearchHistory).filter(SearchHistory.user_id == f"{user_id}_legacy").all()
+            assert all(row.product_data is None and row.snapshot_hash == rows[0].snapshot_hash
+                       and row.variant_count == 1 for row in legacy)
+            assert session.query(ProductSnapshot).filter(ProductSnapshot.product_id == 'snap01').count() == 1
+            legacy_id = legacy[0].id
+        assert db_manager.get_history_product(legacy_id)['jp_price_in_twd'] == 399
+        print(f"✅ Compaction moved {result['rows']} legacy rows onto the shared snapshot")
+        
+        # Once no row references it, a snapshot is marked by one GC run and deleted by a later one
+        def snapshot_rows():
+            with db_manager.get_session() as session:
+                return session.query(ProductSnapshot.orphaned_at).filter(ProductSnapshot.product_id == 'snap01').all()
+        
+        def delete_rows():
+            db_manager.delete_user_history(user_id)
+            with db_manager.get_session() as session:
+                session.query(SearchHistory).filter(SearchHistory.user_id == f"{user_id}_legacy").delete()
+                session.commit()
+        
+        delete_rows()
+        assert db_manager.collect_orphan_snapshots(grace_seconds=0)['marked'] >= 1
+        assert len(snapshot_rows()) == 1 and snapshot_rows()[0].orphaned_at is not None
+        
+        # Stored again before the next run, it is referenced and no longer marked
+        db_manager._known_snapshots.clear()
+        db_manager.save_search_history('snap01', product, source='test', user_id=user_id)
+        assert db_manager.flush_history()
+        assert snapshot_rows()[0].orphaned_at is None
+        db_manager.collect_orphan_snapshots(grace_seconds=0)
+        assert len(snapshot_rows()) == 1
+        
+        # Marked, it is kept for the grace period and deleted after it
+        delete_rows()
+        db_manager.collect_orphan_snapshots(grace_seconds=0)
+        db_manager.collect_orphan_snapshots()
+        assert len(snapshot_rows()) == 1
+        assert db_manager.collect_orphan_snapshots(grace_seconds=0)['deleted'] >= 1
+        assert snapshot_rows() == []
+        print("✅ Unreferenced snapshot garbage-collected over two runs")
+    finally:
+        cleanup()
+    return True
+
 def test_flask_integration():
     """Test Flask app integration"""
     print("\n🌐 Testing Flask Integration")
@@ -95,12 +456,6 @@ def test_flask_integration():
             else:
                 print(f"⚠️  Stats API returned {response.status_code}")
             
-            # Test 3: Search API (mock search)
-            test_data = {
-                'product_id': 'test_456',
-                'search_source': 'api_test'
-            }
-            
             print("\n🎉 Flask integration tests passed!")
             return True
             
@@ -117,10 +472,26 @@ if __name__ == "__main__":
     # Test database operations
     db_success = test_database_operations()
     
+    # Test the in-process price cache
+    l1_success = test_price_l1_cache()
+    
+    # Test the history write-behind queue
+    history_success = test_history_write_behind()
+    
+    # Test the stats rollups
+    rollup_success = test_search_rollups()
+    
+    # Test the history summary columns
+    summary_success = test_history_summaries()
+    
+    # Test the product snapshot store
+    snapshot_success = test_snapshot_store()
+    
     # Test Flask integration
     flask_success = test_flask_integration()
     
-    if db_success and flask_success:
+    if (db_success and l1_success and history_success and rollup_success and summary_success
+            and snapshot_success and flask_success):
         print("\n🎊 All tests completed successfully!")
         print("The database upgrade is working correctly.")
         sys.exit(0)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+Test script for the LINE webhook: immediate acknowledgement, background
+processing and the reply/push fallback (offline, against the stand-in
+Uniqlo server and a recording MessagingApi)
+"""
+import os
+import sys
+import json
+import time
+import hmac
+import base64
+import hashlib
+import threading
+
+os.environ.setdefault('LINE_CHANNEL_SECRET', 'test_secret')
+os.environ.setdefault('LINE_CHANNEL_ACCESS_TOKEN', 'test_token')
+
+from linebot.v3.messaging import ApiException
+
+import app as app_module
+from app import app
+from line_webhook import line_dispatcher, EventDeduplicator
+from database import db_manager
+from test_api import clear_test_products
+from test_crawl import stub_upstream
+
+
+class RecordingMessagingApi:
+    """Stands in for MessagingApi; records what would be sent to LINE"""
+    sent = []
+    reject_replies = False
+    instances = 0
+
+    def __init__(self, api_client):
+        RecordingMessagingApi.instances += 1
+
+    def reply_message_with_http_info(self, request):
+        if self.reject_replies:
+            raise ApiException(status=400, reason='Invalid reply token')
+        self.sent.append(('reply', request.reply_token, [message.text for message in request.messages]))
+
+    def push_message_with_http_info(self, request):
+        self.sent.append(('push', request.to, [message.text for message in request.messages]))
+
+
+def message_event(text, age_seconds=0.0, event_id='01HTESTEVENT0000000000000', reply_token='reply-token'):
+    return {
+        'type': 'message',
+        'mode': 'active',
+        'timestamp': int((time.time() - age_seconds) * 1000),
+        'source': {'type': 'user', 'userId': 'Utestuser'},
+        'webhookEventId': event_id,
+        'deliveryContext': {'isRedelivery': False},
+        'replyToken': reply_token,
+        'message': {'id': '1', 'type': 'text', 'quoteToken': 'q', 'text': text}
+    }
+
+
+def webhook_body(text, age_seconds=0.0, event_id='01HTESTEVENT0000000000000'):
+    return json.dumps({'destination': 'Udestination',
+                       'events': [message_event(text, age_seconds, event_id)]})
+
+
+def use_recording_api():
+    """Give each webhook worker its own RecordingMessagingApi, as get_line_bot_api
+    does with real clients; returns a function that restores the real ones"""
+    original = app_module.get_line_bot_api
+    clients = threading.local()
+    RecordingMessagingApi.sent = []
+    RecordingMessagingApi.instances = 0
+
+    def get_recording_api():
+        if not hasattr(clients, 'api'):
+            clients.api = RecordingMessagingApi(None)
+        return clients.api
+    app_module.get_line_bot_api = get_recording_api
+
+    def restore():
+        app_module.get_line_bot_api = original
+        RecordingMessagingApi.reject_replies = False
+    return restore
+
+
+def post_webhook(client, body, secret=None):
+    secret = secret or os.environ['LINE_CHANNEL_SECRET']
+    signature = base64.b64encode(hmac.new(secret.encode(), body.encode(), hashlib.sha256).digest()).decode()
+    return client.post('/find_product', data=body, content_type='application/json',
+                       headers={'X-Line-Signature': signature})
+
+
+def test_webhook_acknowledges_before_crawl():
+    """The webhook returns 200 at once; the reply is sent when the crawl finishes"""
+    print("🧪 Testing asynchronous LINE webhook")
+    print("=" * 40)
+
+    clear_test_products(['470015', '470016', '470017'])
+    restore = use_recording_api()
+    try:
+        with stub_upstream(delay=0.5), app.test_client() as client:
+            started = time.perf_counter()
+            response = post_webhook(client, webhook_body('470015', event_id='01HTESTEVENT0000000000001'))
+            elapsed = time.perf_counter() - started
+            assert response.status_code == 200
+            assert elapsed < 0.3 and RecordingMessagingApi.sent == []
+            print(f"✅ Webhook acknowledged in {elapsed * 1000:.0f}ms, before the crawl")
+
+            assert line_dispatcher.wait_idle()
+            kind, token, texts = RecordingMessagingApi.sent[0]
+            assert kind == 'reply' and token == 'reply-token' and '日圓' in texts[0]
+            print("✅ Reply sent with the reply token once the crawl finished")
+
+            # An event close to its reply token's expiry is answered by push
+            RecordingMessagingApi.sent = []
+            post_webhook(client, webhook_body('470016', age_seconds=55, event_id='01HTESTEVENT0000000000002'))
+            assert line_dispatcher.wait_idle()
+            assert RecordingMessagingApi.sent[0][:2] == ('push', 'Utestuser')
+            print("✅ Expiring reply token -> push API")
+
+            # A rejected reply token also falls back to push
+            RecordingMessagingApi.sent = []
+            RecordingMessagingApi.reject_replies = True
+            post_webhook(client, webhook_body('470017', event_id='01HTESTEVENT0000000000003'))
+            assert line_dispatcher.wait_idle()
+            assert RecordingMessagingApi.sent[0][:2] == ('push', 'Utestuser')
+            print("✅ Rejected reply token -> push API")
+
+            response = post_webhook(client, webhook_body('470015', event_id='01HTESTEVENT0000000000004'), secret='wrong-secret')
+            assert response.status_code == 400
+            print("✅ Bad signature rejected")
+
+            metrics = client.get('/api/metrics').get_json()['line_webhook']
+            assert metrics['processed'] >= 3 and metrics['pushes'] >= 2
+            print(f"✅ Webhook metrics: {metrics}")
+    finally:
+        restore()
+
+    clear_test_products(['470015', '470016', '470017'])
+    return True
+
+
+def test_cached_price_skips_negative_cache():
+    """A cached product is answered without a negative-cache lookup"""
+    print("\n🧪 Testing cached LINE replies")
+    print("=" * 40)
+
+    clear_test_products(['470000'])
+    restore = use_recording_api()
+    try:
+        with stub_upstream(), app.test_client() as client:
+            app_module.crawl_and_cache('470000')
+            lookups = dict(db_manager.negative_cache_stats)
+            post_webhook(client, webhook_body('470000', event_id='01HTESTCACHED000000000000'))
+            assert line_dispatcher.wait_idle()
+
+        assert '日圓' in RecordingMessagingApi.sent[0][2][0]
+        assert db_manager.negative_cache_stats['hits'] == lookups['hits']
+        assert db_manager.negative_cache_stats['misses'] == lookups['misses']
+        print("✅ Cached price replied without checking the negative cache")
+    finally:
+        restore()
+
+    clear_test_products(['470000'])
+    return True
+
+
+def test_multi_event_batch_runs_concurrently():
+    """Events of one webhook body are handled in parallel, capped per request"""
+    print("\n🧪 Testing multi-event webhook payloads")
+    print("=" * 40)
+
+    product_ids = [f"4700{i:02d}" for i in range(4, 10)]
+    clear_test_products(product_ids)
+    restore = use_recording_api()
+    original_cap = line_dispatcher.per_request
+    line_dispatcher.per_request = 3
+    try:
+        body = json.dumps({'destination': 'Udestination', 'events': [
+            message_event(product_id, event_id=f"01HTESTBATCH{i:013d}", reply_token=f"token-{i}")
+            for i, product_id in enumerate(product_ids)
+        ]})
+        with stub_upstream(delay=0.4), app.test_client() as client:
+            started = time.perf_counter()
+            assert post_webhook(client, body).status_code == 200
+            assert line_dispatcher.wait_idle()
+            elapsed = time.perf_counter() - started
+
+        tokens = sorted(token for _, token, _ in RecordingMessagingApi.sent)
+        assert tokens == sorted(f"token-{i}" for i in range(6))
+        # 6 crawls of ~0.4s, 3 at a time: about two crawl times, not six
+        assert elapsed < 6 * 0.4
+        assert RecordingMessagingApi.instances <= 3
+        print(f"✅ 6 events answered in {elapsed:.2f}s with {RecordingMessagingApi.instances} messaging clients")
+    finally:
+        line_dispatcher.per_request = original_cap
+        restore()
+
+    clear_test_products(product_ids)
+    return True
+
+
+def test_messaging_client_per_thread():
+    """get_line_bot_api reuses one MessagingApi per thread, never shared across threads"""
+    print("\n🧪 Testing per-thread messaging clients")
+    print("=" * 40)
+
+    api = app_module.get_line_bot_api()
+    assert api is app_module.get_line_bot_api()
+    other = []
+    worker = threading.Thread(target=lambda: other.extend([app_module.get_line_bot_api(),
+                                                           app_module.get_line_bot_api()]))
+    worker.start()
+    worker.join()
+    assert other[0] is other[1] and other[0] is not api
+    print("✅ Same client within a thread, a different one on another thread")
+    return True
+
+
+def test_redelivered_events_are_dropped():
+    """A redelivered webhookEventId is neither crawled nor answered again"""
+    print("\n🧪 Testing webhook event de-duplication")
+    print("=" * 40)
+
+    clear_test_products(['470018'])
+    restore = use_recording_api()
+    try:
+        body = webhook_body('470018', event_id='01HTESTREDELIVERY00000000')
+        with stub_upstream(delay=0.2), app.test_client() as client:
+            duplicates = line_dispatcher.stats()['duplicates']
+            assert post_webhook(client, body).status_code == 200
+            # LINE redelivers while the first delivery is still being handled
+            assert post_webhook(client, body).status_code == 200
+            assert line_dispatcher.wait_idle()
+            post_webhook(client, body)
+            assert line_dispatcher.wait_idle()
+
+            assert len(RecordingMessagingApi.sent) == 1
+            assert line_dispatcher.stats()['duplicates'] == duplicates + 2
+            print(f"✅ 3 deliveries -> 1 reply, {line_dispatcher.stats()['duplicates'] - duplicates} duplicates dropped")
+    finally:
+        restore()
+
+    # Workers sharing the database see each other's events
+    event_id = f"01HTESTSHARED{int(time.time() * 1000):012d}"
+    worker_a, worker_b = EventDeduplicator(window_seconds=60), EventDeduplicator(window_seconds=60)
+    worker_a.db_manager = worker_b.db_manager = db_manager
+    assert worker_a.claim(event_id) and not worker_b.claim(event_id)
+    assert EventDeduplicator(window_seconds=60).claim(event_id)  # memory-only workers don't share
+    print("✅ Event claimed by one worker is dropped by another through the database")
+
+    clear_test_products(['470018'])
+    return True
+
+
+if __name__ == "__main__":
+    success = (test_webhook_acknowledges_before_crawl() and test_cached_price_skips_negative_cache()
+               and test_multi_event_batch_runs_concurrently() and test_messaging_client_per_thread()
+               and test_redelivered_events_are_dropped())
+    sys.exit(0 if success else 1)
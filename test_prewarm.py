@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Test script for the popularity-driven cache pre-warm scheduler
+"""
+import sys
+from datetime import datetime, timedelta
+
+from prewarm import PrewarmScheduler
+from revalidate import price_refresher
+from database import db_manager, PriceCache, SearchHistory
+
+TEST_USER = 'prewarm-test'
+TEST_PRODUCTS = ['pw0001', 'pw0002', 'pw0003']
+
+
+def seed_searches(product_id, count, hours_ago):
+    searched_at = datetime.utcnow() - timedelta(hours=hours_ago)
+    with db_manager.get_session() as session:
+        session.add_all([
+            SearchHistory(product_id=product_id, search_timestamp=searched_at, search_source='web',
+                          user_id=TEST_USER, is_successful=True)
+            for _ in range(count)
+        ])
+        session.commit()
+
+
+def clear_test_data():
+    with db_manager.get_session() as session:
+        session.query(SearchHistory).filter(SearchHistory.user_id == TEST_USER).delete()
+        session.query(PriceCache).filter(PriceCache.product_id.in_(TEST_PRODUCTS)).delete()
+        session.commit()
+    for product_id in TEST_PRODUCTS:
+        db_manager.evict_price_l1(product_id)
+
+
+def test_demand_ranking_decays():
+    """Recent searches outweigh a larger number of older ones"""
+    print("🧪 Testing decayed demand ranking")
+    print("=" * 40)
+
+    clear_test_data()
+    try:
+        seed_searches('pw0001', 40, hours_ago=0)
+        seed_searches('pw0002', 60, hours_ago=24)
+        seed_searches('pw0003', 20, hours_ago=0)
+
+        scheduler = PrewarmScheduler(half_life_hours=6)
+        scheduler.bind_database(db_manager)
+        scheduler.ingest()
+        scores = dict(scheduler.top_products(limit=1000))
+        assert scores['pw0001'] > scores['pw0003'] > scores['pw0002']
+        assert abs(scores['pw0002'] - 60 / 16) < 0.1
+        print(f"✅ 60 searches a day ago score {scores['pw0002']:.2f}, 20 searches now {scores['pw0003']:.2f}")
+
+        # Only new rows are read on the next pass, and old scores keep decaying
+        seed_searches('pw0003', 5, hours_ago=0)
+        scheduler.ingest(datetime.utcnow() + timedelta(hours=6))
+        later = dict(scheduler.top_products(limit=1000))
+        assert abs(later['pw0001'] - scores['pw0001'] / 2) < 0.5
+        assert later['pw0003'] > scores['pw0003'] / 2
+        print(f"✅ Scores halve after one half-life: pw0001 {scores['pw0001']:.1f} -> {later['pw0001']:.1f}")
+    finally:
+        clear_test_data()
+    return True
+
+
+def test_prewarm_within_budget():
+    """Top products about to expire are refreshed, up to the per-minute budget"""
+    print("\n🧪 Testing pre-warm budget and warm-hit ratio")
+    print("=" * 40)
+
+    clear_test_data()
+    try:
+        seed_searches('pw0001', 500, hours_ago=0)
+        seed_searches('pw0002', 400, hours_ago=0)
+        seed_searches('pw0003', 300, hours_ago=0)
+        # pw0001 is cached well beyond the lead time, the others are not cached
+        db_manager.cache_price_data('pw0001', {'serial_number': 'pw0001'}, cache_hours=1)
+
+        refreshed = []
+        scheduler = PrewarmScheduler(top_n=3, budget_per_minute=1)
+        scheduler.bind_database(db_manager)
+        scheduler.refresh_fn = refreshed.append
+
+        scheduled = scheduler.run_once()
+        assert price_refresher.wait_idle()
+        assert scheduled == ['pw0002'] and refreshed == ['pw0002']
+        assert scheduler.stats()['budget_exhausted'] == 1
+        print(f"✅ Budget of 1 crawl/minute spent on the hottest expiring product: {scheduled}")
+
+        for _ in range(3):
+            scheduler.record_lookup('pw0001', fresh_hit=True)
+        scheduler.record_lookup('pw0003', fresh_hit=False)
+        scheduler.record_lookup('not-trending', fresh_hit=False)
+        stats = scheduler.stats()
+        assert stats['warm_hit_ratio'] == 0.75
+        print(f"✅ Warm-hit ratio over top products: {stats['warm_hit_ratio']}")
+    finally:
+        clear_test_data()
+    return True
+
+
+if __name__ == "__main__":
+    success = test_demand_ranking_decays() and test_prewarm_within_budget()
+    sys.exit(0 if success else 1)
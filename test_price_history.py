@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Test script for the per-variant price/stock history: change-only writes,
+downsampling into hourly/daily buckets and the history endpoint
+"""
+import os
+import sys
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, select
+
+os.environ.setdefault('LINE_CHANNEL_SECRET', 'test_secret')
+os.environ.setdefault('LINE_CHANNEL_ACCESS_TOKEN', 'test_token')
+
+from app import app
+from database import db_manager, PriceObservation, VariantPriceState
+from price_history import PriceHistoryRecorder
+from test_query_plans import assert_uses_index
+
+
+def crawl_result(product_id, variants):
+    """A crawl result with ``variants`` as {l2_id: (price, stock)}"""
+    return {'serial_number': product_id, 'price_jp': 1990, 'product_list': [
+        {'id': l2_id, 'color': 'BLACK', 'size': 'M', 'price': price, 'stock': stock}
+        for l2_id, (price, stock) in variants.items()
+    ]}
+
+
+def clear_price_history(product_ids):
+    with db_manager.get_session() as session:
+        for model in (PriceObservation, VariantPriceState):
+            session.query(model).filter(model.product_id.in_(product_ids)).delete(synchronize_session=False)
+        session.commit()
+
+
+def count_statements():
+    """Start counting SQL statements; returns a function that stops and reports the count"""
+    statements = []
+
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(db_manager.engine, 'before_cursor_execute', before_execute)
+
+    def stop():
+        event.remove(db_manager.engine, 'before_cursor_execute', before_execute)
+        return len(statements)
+    return stop
+
+
+def test_only_changes_are_written():
+    """Repeated crawls with the same values write nothing; a change writes one row"""
+    print("🧪 Testing change-only price observations")
+    print("=" * 40)
+
+    clear_price_history(['PH0001'])
+    recorder = PriceHistoryRecorder()
+    recorder.bind_database(db_manager)
+    started = datetime(2026, 1, 1, 9, 0)
+    try:
+        variants = {'PH0001-01': (1990, 'IN_STOCK'), 'PH0001-02': (1990, 'LOW_STOCK')}
+        assert recorder.record(crawl_result('PH0001', variants), observed_at=started) == 2
+
+        stop = count_statements()
+        for minute in range(1, 11):
+            assert recorder.record(crawl_result('PH0001', variants),
+                                   observed_at=started + timedelta(minutes=minute)) == 0
+        assert stop() == 10
+        print("✅ 10 unchanged crawls -> one conditional upsert each, no observations")
+
+        variants['PH0001-02'] = (1990, 'STOCK_OUT')
+        assert recorder.record(crawl_result('PH0001', variants), observed_at=started + timedelta(minutes=20)) == 1
+
+        # Another worker starts from the state table, not from scratch
+        other = PriceHistoryRecorder()
+        other.bind_database(db_manager)
+        assert other.record(crawl_result('PH0001', variants), observed_at=started + timedelta(minutes=30)) == 0
+
+        # A change made through another worker is compared against, not a stale local copy
+        assert other.record(crawl_result('PH0001', {**variants, 'PH0001-01': (990, 'IN_STOCK')}),
+                            observed_at=started + timedelta(minutes=40)) == 1
+        assert recorder.record(crawl_result('PH0001', variants), observed_at=started + timedelta(minutes=50)) == 1
+
+        history = recorder.history('PH0001', started, started + timedelta(hours=1))
+        assert [point['stock'] for point in history['PH0001-02']] == ['LOW_STOCK', 'STOCK_OUT']
+        assert [point['price'] for point in history['PH0001-01']] == [1990, 990, 1990]
+        assert recorder.stats()['unchanged'] == 10
+        print(f"✅ Stock change recorded once; stats {recorder.stats()['observations']} observations")
+    finally:
+        clear_price_history(['PH0001'])
+    return True
+
+
+def test_downsampling():
+    """Aged change points fold into hourly, then daily buckets keeping close, min and max"""
+    print("\n🧪 Testing price history downsampling")
+    print("=" * 40)
+
+    clear_price_history(['PH0002'])
+    recorder = PriceHistoryRecorder(raw_days=7, hourly_days=90)
+    recorder.bind_database(db_manager)
+    now = datetime(2026, 6, 1, 12, 0)
+    day = now - timedelta(days=120)
+    try:
+        # Six price changes within two hours, four months ago
+        for minutes, price in [(0, 2990), (10, 1990), (20, 2490), (70, 990), (80, 1490), (100, 2990)]:
+            recorder.record(crawl_result('PH0002', {'PH0002-01': (price, 'IN_STOCK')}),
+                            observed_at=day + timedelta(minutes=minutes))
+        # A recent change stays at full resolution
+        recorder.record(crawl_result('PH0002', {'PH0002-01': (1790, 'LOW_STOCK')}), observed_at=now - timedelta(hours=1))
+
+        with db_manager.get_session() as session:
+            hourly = db_manager.downsample_price_observations(3600, now - timedelta(days=7))
+            rows = session.query(PriceObservation).filter(PriceObservation.product_id == 'PH0002').order_by(
+                PriceObservation.observed_at).all()
+            assert hourly == {'rows': 6, 'buckets': 2}
+            assert [(row.resolution, row.price, row.min_price, row.max_price, row.changes) for row in rows[:2]] == \
+                [(3600, 2490, 1990, 2990, 3), (3600, 2990, 990, 2990, 3)]
+        print("✅ 6 change points -> 2 hourly buckets (close, min, max, changes)")
+
+        result = recorder.downsample(now=now)
+        assert result['daily'] == {'rows': 2, 'buckets': 1} and result['hourly']['rows'] == 0
+        history = recorder.history('PH0002', now - timedelta(days=365), now)['PH0002-01']
+        assert history[0] == {'observed_at': day.replace(hour=0, minute=0).isoformat(), 'resolution': 86400,
+                              'price': 2990, 'stock': 'IN_STOCK', 'min_price': 990, 'max_price': 2990,
+                              'changes': 6}
+        assert history[1]['resolution'] == 0 and history[1]['price'] == 1790
+        print("✅ Hourly buckets -> 1 daily bucket; recent change kept as is")
+
+        # Buckets a later run adds to are merged, not duplicated
+        recorder.record(crawl_result('PH0002', {'PH0002-01': (590, 'IN_STOCK')}),
+                        observed_at=day + timedelta(hours=5))
+        recorder.downsample(now=now)
+        history = recorder.history('PH0002', now - timedelta(days=365), now)['PH0002-01']
+        assert len(history) == 2 and history[0]['changes'] == 7 and history[0]['min_price'] == 590
+        assert history[0]['price'] == 590
+        print("✅ Late change point merged into the existing daily bucket")
+
+        assert db_manager.acquire_lease(PriceHistoryRecorder.LEASE_KEY, 'someone-else', 60)
+        assert recorder.downsample(now=now) == {'skipped': True}
+        db_manager.release_lease(PriceHistoryRecorder.LEASE_KEY, 'someone-else')
+        print("✅ Downsampling skipped while another worker holds the lease")
+    finally:
+        clear_price_history(['PH0002'])
+    return True
+
+
+def test_history_endpoint():
+    """GET /api/products/<id>/history returns the range from one index scan"""
+    print("\n🧪 Testing price history endpoint")
+    print("=" * 40)
+
+    clear_price_history(['PH0003'])
+    recorder = PriceHistoryRecorder()
+    recorder.bind_database(db_manager)
+    started = datetime(2026, 3, 1)
+    try:
+        for day, price in enumerate([2990, 1990, 2990]):
+            recorder.record(crawl_result('PH0003', {'PH0003-01': (price, 'IN_STOCK'), 'PH0003-02': (2990, 'IN_STOCK')}),
+                            observed_at=started + timedelta(days=day))
+
+        with app.test_client() as client:
+            response = client.get('/api/products/PH0003/history?from=2026-03-01T12:00:00Z&to=2026-03-05T00:00:00')
+            assert response.status_code == 200
+            data = response.get_json()
+            assert data['product_id'] == 'PH0003'
+            assert [point['price'] for point in data['variants']['PH0003-01']] == [1990, 2990]
+            assert 'PH0003-02' not in data['variants']
+            print(f"✅ Range query: {data['variants']}")
+
+            response = client.get('/api/products/PH0003/history?from=2026-01-01&to=2026-04-01&l2_id=PH0003-02')
+            assert list(response.get_json()['variants']) == ['PH0003-02']
+            print("✅ Single-variant filter")
+
+            assert client.get('/api/products/PH0003/history?from=yesterday').status_code == 400
+            assert client.get('/api/products/PH0003/history?from=2026-04-01&to=2026-03-01').status_code == 400
+            print("✅ Bad ranges rejected with 400")
+
+            assert 'price_history' in client.get('/api/metrics').get_json()
+    finally:
+        clear_price_history(['PH0003'])
+
+    if db_manager.engine.dialect.name == 'sqlite':
+        assert_uses_index(
+            'Price history range',
+            select(PriceObservation).where(PriceObservation.product_id == 'PH0003',
+                                           PriceObservation.observed_at >= started,
+                                           PriceObservation.observed_at < started + timedelta(days=30))
+            .order_by(PriceObservation.observed_at, PriceObservation.id),
+            'ix_price_observation_product_time'
+        )
+    return True
+
+
+if __name__ == "__main__":
+    success = test_only_changes_are_written() and test_downsampling() and test_history_endpoint()
+    sys.exit(0 if success else 1)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Test script asserting (with EXPLAIN QUERY PLAN) that the history and stats
+hot queries use an index, and that existing databases get new columns and indexes
+"""
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, inspect, select, func
+
+from database import (db_manager, migrate_schema, migrate_indexes, Base, SearchHistory, SearchStatsHourly,
+                      ProductSearchStats)
+
+
+def query_plan(statement):
+    """SQLite query plan of a statement, one step per line"""
+    compiled = statement.compile(dialect=db_manager.engine.dialect)
+    params = tuple(str(compiled.params[name]) for name in compiled.positiontup)
+    with db_manager.engine.connect() as connection:
+        rows = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + str(compiled), params).all()
+    return [row[-1] for row in rows]
+
+
+def assert_uses_index(name, statement, index_name):
+    plan = query_plan(statement)
+    assert any(index_name in step for step in plan), f"{name} doesn't use {index_name}: {plan}"
+    assert not any('TEMP B-TREE' in step for step in plan), f"{name} sorts in a temp b-tree: {plan}"
+    print(f"✅ {name}: {' | '.join(plan)}")
+
+
+def test_hot_queries_use_indexes():
+    """Each history and stats hot query is answered from an index, without a sort"""
+    print("🧪 Testing query plans of hot queries")
+    print("=" * 40)
+
+    if db_manager.engine.dialect.name != 'sqlite':
+        print("⚠️  Query plan checks run against SQLite only; skipped")
+        return True
+
+    cutoff = datetime.utcnow() - timedelta(hours=24)
+    assert_uses_index(
+        'User history (newest first)',
+        select(SearchHistory).where(SearchHistory.user_id == 'u', SearchHistory.is_successful == True)
+        .order_by(SearchHistory.search_timestamp.desc()).limit(50),
+        'ix_search_history_user_success_time'
+    )
+    assert_uses_index(
+        'History delete lookup',
+        select(SearchHistory.product_id, SearchHistory.search_timestamp, SearchHistory.is_successful)
+        .where(SearchHistory.user_id == 'u'),
+        'ix_search_history_user_success_time'
+    )
+    assert_uses_index(
+        'Popular products from history',
+        select(SearchHistory.product_id, func.count(SearchHistory.id)).where(SearchHistory.is_successful == True)
+        .group_by(SearchHistory.product_id),
+        'COVERING INDEX ix_search_history_success_product'
+    )
+    assert_uses_index(
+        'Searches in the last 24h',
+        select(func.count(SearchHistory.id)).where(SearchHistory.search_timestamp > cutoff),
+        'ix_search_history_timestamp'
+    )
+    assert_uses_index(
+        'Popular products from rollup',
+        select(ProductSearchStats.product_id, ProductSearchStats.successful_count)
+        .where(ProductSearchStats.successful_count > 0)
+        .order_by(ProductSearchStats.successful_count.desc()).limit(10),
+        'ix_product_search_stats_successful_count'
+    )
+    assert_uses_index(
+        'Recent hours from rollup',
+        select(func.sum(SearchStatsHourly.search_count)).where(SearchStatsHourly.hour_bucket >= cutoff),
+        'ix_search_stats_hourly_hour_bucket'
+    )
+    return True
+
+
+def test_migration_adds_missing_indexes():
+    """An existing database created before the indexes and summary columns gets them"""
+    print("\n🧪 Testing index migration of an existing database")
+    print("=" * 40)
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(f"sqlite:///{os.path.join(directory, 'old.db')}")
+        Base.metadata.create_all(bind=engine)
+        composite = ['ix_search_history_success_product', 'ix_search_history_timestamp',
+                     'ix_search_history_user_success_time']
+        summary_columns = ['page_title', 'colors', 'in_stock_sizes', 'variant_count']
+        with engine.begin() as connection:
+            for index_name in composite:
+                connection.exec_driver_sql(f"DROP INDEX {index_name}")
+            for column_name in summary_columns:
+                connection.exec_driver_sql(f"ALTER TABLE search_history DROP COLUMN {column_name}")
+
+        # Startup only adds the columns; the indexes wait for db_maintenance.py migrate
+        created = migrate_schema(engine)
+        assert created == [f"search_history.{column_name}" for column_name in summary_columns]
+        assert not set(composite) & {index['name'] for index in inspect(engine).get_indexes('search_history')}
+        assert migrate_indexes(engine) == composite
+        inspector = inspect(engine)
+        assert set(composite) <= {index['name'] for index in inspector.get_indexes('search_history')}
+        assert set(summary_columns) <= {column['name'] for column in inspector.get_columns('search_history')}
+        assert migrate_schema(engine) == [] and migrate_indexes(engine) == []
+        engine.dispose()
+    print(f"✅ Created {created} on start and the indexes on migrate; a second run is a no-op")
+    return True
+
+
+if __name__ == "__main__":
+    success = test_hot_queries_use_indexes() and test_migration_adds_missing_indexes()
+    sys.exit(0 if success else 1)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Test script for request coalescing (single-flight)
+"""
+import sys
+import time
+import tempfile
+import threading
+
+from singleflight import SingleFlight, FileLease, DatabaseLease
+from database import db_manager
+
+
+def run_concurrently(count, target):
+    results = [None] * count
+
+    def worker(index):
+        results[index] = target()
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_threads_share_one_call():
+    """Concurrent callers for one key in a worker share a single execution"""
+    print("🧪 Testing single-flight across threads")
+    print("=" * 40)
+
+    flight = SingleFlight()
+    calls = []
+
+    def slow_lookup():
+        calls.append(1)
+        time.sleep(0.3)
+        return {'serial_number': '474479'}
+
+    results = run_concurrently(10, lambda: flight.do('474479', slow_lookup))
+    assert len(calls) == 1
+    assert all(result == {'serial_number': '474479'} for result in results)
+    print(f"✅ 10 callers, 1 execution: {flight.stats()}")
+
+    # Errors reach every waiting caller, and the next call starts a new flight
+    def failing_lookup():
+        time.sleep(0.1)
+        raise ValueError("upstream down")
+
+    errors = run_concurrently(3, lambda: _capture(lambda: flight.do('474479', failing_lookup)))
+    assert all(isinstance(error, ValueError) for error in errors)
+    assert flight.do('474479', lambda: 'fresh') == 'fresh'
+    print("✅ Errors propagated to followers, key released afterwards")
+    return True
+
+
+def _capture(fn):
+    try:
+        return fn()
+    except Exception as e:
+        return e
+
+
+def test_lease_across_workers():
+    """Two workers sharing a lease crawl once; the second re-checks the cache"""
+    print("\n🧪 Testing cross-worker lease")
+    print("=" * 40)
+
+    with tempfile.TemporaryDirectory() as lock_dir:
+        leases = {
+            'file': (FileLease(lock_dir), FileLease(lock_dir)),
+            'db': (DatabaseLease(db_manager, 30), DatabaseLease(db_manager, 30)),
+        }
+        for name, (lease_a, lease_b) in leases.items():
+            workers = [SingleFlight(lease=lease_a), SingleFlight(lease=lease_b)]
+            shared_cache, crawls = {}, []
+
+            def lookup():
+                if 'test_lease_key' in shared_cache:
+                    return shared_cache['test_lease_key']
+                crawls.append(1)
+                time.sleep(0.3)
+                shared_cache['test_lease_key'] = 'crawled'
+                return 'crawled'
+
+            results = []
+            threads = [threading.Thread(target=lambda w=w: results.append(w.do('test_lease_key', lookup)))
+                       for w in workers]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            assert len(crawls) == 1
+            assert results == ['crawled', 'crawled']
+            print(f"✅ {name} lease: one crawl for two workers")
+    return True
+
+
+if __name__ == "__main__":
+    success = test_threads_share_one_call() and test_lease_across_workers()
+    sys.exit(0 if success else 1)
@@ -0,0 +1,114 @@
+"""
+Table-driven decoding of l2s payloads (product variants, stocks and prices)
+"""
+from typing import Any, Dict, List, Optional
+
+# Color codes are two digits; names are grouped by range (upper bound inclusive)
+_COLOR_RANGES = (
+    (1, 'White 白'), (8, 'Gray 灰'), (9, 'Black 黑'), (19, 'Red 紅'),
+    (29, 'Orange 橘'), (39, 'Brown 棕'), (49, 'Yellow 黃'), (59, 'Green 綠'),
+    (68, 'Blue 藍'), (69, 'Navy 海軍藍'), (79, 'Purple 紫'),
+)
+OTHER_COLOR = 'Others 其他'
+
+_SIZE_CODES = {
+    1: "XXS", 2: "XS", 3: "S", 4: "M", 5: "L", 6: "XL", 7: "XXL",
+    8: "3XL", 9: "4XL", 23: "23-25", 25: "25-27", 27: "27-29",
+    60: "60", 70: "70", 80: "80", 90: "90", 100: "100", 110: "110",
+    120: "120", 130: "130", 140: "140", 150: "150", 160: "160",
+    499: "AA 65/70", 500: "AB 65/70", 501: "CD 65/70", 502: "EF 65/70",
+    503: "AB 75/80", 504: "CD 75/80", 505: "EF 75/80",
+    506: "AB 85/90", 507: "CD 85/90", 508: "EF 85/90"
+}
+
+
+def _build_color_names():
+    names = []
+    for code in range(100):
+        names.append(next((name for upper, name in _COLOR_RANGES if code <= upper), OTHER_COLOR))
+    return tuple(names)
+
+
+# Lookup arrays indexed by the numeric color (2 digit) and size (3 digit) code
+COLOR_NAMES = _build_color_names()
+SIZE_NAMES = tuple(_SIZE_CODES.get(code, "") for code in range(1000))
+
+
+def color_name(code: int) -> str:
+    return COLOR_NAMES[code] if 0 <= code < 100 else (COLOR_NAMES[0] if code < 0 else OTHER_COLOR)
+
+
+def size_name(code: int) -> str:
+    return SIZE_NAMES[code] if 0 <= code < 1000 else ""
+
+
+class VariantTable:
+    """Variants of one product stored column by column.
+
+    Colors and sizes are kept as their numeric codes and only turned into
+    names when ``to_product_list`` builds the per-variant dicts.
+    """
+
+    __slots__ = ('ids', 'serial_alts', 'color_codes', 'size_codes', 'stocks', 'prices')
+
+    def __init__(self):
+        self.ids = []
+        self.serial_alts = []
+        self.color_codes = []
+        self.size_codes = []
+        self.stocks = []
+        self.prices = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def first_price(self) -> Optional[int]:
+        """Price of the first variant, used as the product's JP price"""
+        return self.prices[0] if self.prices else None
+
+    def to_product_list(self, serial_number: str) -> List[Dict[str, Any]]:
+        """Materialize the ``product_list`` dicts returned by the crawler"""
+        return [
+            {
+                "serial": serial_number,
+                "serial_alt": serial_alt,
+                "id": l2_id,
+                "color": color_name(color_code),
+                "size": size_name(size_code),
+                "stock": stock,
+                "price": price
+            }
+            for l2_id, serial_alt, color_code, size_code, stock, price in zip(
+                self.ids, self.serial_alts, self.color_codes, self.size_codes, self.stocks, self.prices)
+        ]
+
+
+def decode_l2s(detail_resp: Dict[str, Any]) -> VariantTable:
+    """Decode a parsed l2s response into a VariantTable.
+
+    Raises KeyError/TypeError/ValueError for payloads that aren't a
+    successful l2s response, like the per-variant loop it replaces.
+    """
+    result = detail_resp['result']
+    stocks_get = result['stocks'].get
+    prices_get = result['prices'].get
+
+    table = VariantTable()
+    ids, serial_alts = table.ids, table.serial_alts
+    color_codes, size_codes = table.color_codes, table.size_codes
+    stocks, prices = table.stocks, table.prices
+
+    for item in result['l2s']:
+        l2_id = item['l2Id']
+        ids.append(l2_id)
+        serial_alts.append(item['communicationCode'][:6])
+        color_codes.append(int(item['color']['code'][-2:]))
+        size_codes.append(int(item['size']['code'][-3:]))
+
+        stock = stocks_get(l2_id)
+        stocks.append(stock.get('statusCode', 0) if stock else 0)
+        price = prices_get(l2_id)
+        prices.append(price.get('base', {}).get('value', 0) if price else 0)
+
+    return table